@@ -0,0 +1,85 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+"""
+Benchmark the tokenizer overhead of each predict request
+
+For example:
+
+    python examples/inference/benchmark_tokenizer.py --vocab_path=./vocab.json
+
+Without the vocab_path, a vocab of vocab_size synthetic tokens is written to a temporary file.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from transformer.tokenization import tokenization
+
+
+def request_without_registry(vocab_path, text):
+    """The tokenization of a request which parses the vocab for the tokenizer and each conversion"""
+    tokenizer = tokenization.FullTokenizer(vocab_path)
+    ids = [tokenization.vocab_to_dict_key_token(vocab_path)[token] for token in tokenizer.tokenize(text)]
+    vocab = tokenization.vocab_to_dict_key_id(vocab_path)
+    return tokenization.convert_tokens_to_string([vocab[item] for item in ids])
+
+
+def request_with_registry(vocab_path, text):
+    """The tokenization of a request with the tokenizer and the vocab shared in the process"""
+    tokenizer = tokenization.get_tokenizer(vocab_path)
+    ids = tokenization.convert_tokens_to_ids(vocab_path, tokenizer.tokenize(text))
+    return tokenization.convert_tokens_to_string(tokenization.convert_ids_to_tokens(vocab_path, ids))
+
+
+def benchmark(func, vocab_path, text, num_requests):
+    """Return the average seconds of each request"""
+    start = time.perf_counter()
+    for _ in range(num_requests):
+        func(vocab_path, text)
+    return (time.perf_counter() - start) / num_requests
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vocab_path', default="", help='The vocab json file')
+    parser.add_argument('--vocab_size', default=50272, type=int, help='The size of the synthetic vocab')
+    parser.add_argument('--num_requests', default=20, type=int, help='The number of the requests to time')
+    args = parser.parse_args()
+
+    vocab_path = args.vocab_path
+    if not vocab_path:
+        words = ["hello", "world", "!", "today", "is", "a", "good", "day"]
+        vocab = {word: i for i, word in enumerate(words)}
+        vocab.update({f"token{i}": i for i in range(len(words), args.vocab_size)})
+        fd, vocab_path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(vocab, fp)
+    text = "Hello world! Today is a good day"
+    try:
+        assert request_without_registry(vocab_path, text) == request_with_registry(vocab_path, text)
+        before = benchmark(request_without_registry, vocab_path, text, args.num_requests)
+        after = benchmark(request_with_registry, vocab_path, text, args.num_requests)
+    finally:
+        if not args.vocab_path:
+            os.remove(vocab_path)
+    print(f"Without the registry: {before * 1e3:.3f} ms per request")
+    print(f"With the registry: {after * 1e6:.3f} us per request")
+
+
+if __name__ == "__main__":
+    main()
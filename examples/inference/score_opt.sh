@@ -0,0 +1,41 @@
+#!/bin/bash
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+echo "=============================================================================================================="
+echo "Please run the script as: "
+echo "bash examples/inference/score_opt.sh INPUT_FILE OUTPUT_FILE"
+echo "for example: bash examples/inference/score_opt.sh pairs.jsonl scores.jsonl"
+echo "Each line of the INPUT_FILE is a json object like {\"context\": \"Hello\", \"continuation\": \" world\"}"
+echo "=============================================================================================================="
+export GLOG_v=3
+INPUT_FILE=$1
+OUTPUT_FILE=$2
+
+python -m transformer.scoring \
+    --config=./transformer/configs/opt/opt.yaml \
+    --seq_length=1024 \
+    --parallel_mode="stand_alone" \
+    --global_batch_size=8 \
+    --vocab_size=50272 \
+    --hidden_size=2560 \
+    --ckpt_path="./converted_mindspore_opt.ckpt" \
+    --vocab_path="./vocab.json" \
+    --num_layers=32 \
+    --num_heads=32 \
+    --input_file="${INPUT_FILE}" \
+    --output_file="${OUTPUT_FILE}" \
+    --full_batch=False \
+    --device_target="Ascend" > score_opt.log 2>&1 &
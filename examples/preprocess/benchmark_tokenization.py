@@ -0,0 +1,177 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+"""
+Benchmark the BERT tokenization on a GLUE or SQuAD corpus
+
+For example, with the vocab.txt of BERT and the SQuAD dev set or a GLUE tsv file:
+
+    python examples/preprocess/benchmark_tokenization.py --vocab_path=./vocab.txt --input_file=./dev-v1.1.json
+    python examples/preprocess/benchmark_tokenization.py --vocab_path=./vocab.txt --input_file=./MNLI/dev_matched.tsv
+
+Without the input_file, a synthetic corpus is used, and also a synthetic vocab without the vocab_path.
+"""
+import argparse
+import json
+import os
+import random
+import string
+import tempfile
+import time
+
+from tasks.nlp import tokenization
+
+
+class LegacyWordpieceTokenizer(tokenization.WordpieceTokenizer):
+    """The longest match by shrinking the end one char at a time, the reference of the WordpieceTokenizer"""
+    def tokenize(self, tokens):
+        output_tokens = []
+        tokens = tokenization.convert_to_unicode(tokens)
+        for token in tokenization.whitespace_tokenize(tokens):
+            len_chars = len(token)
+            start = 0
+            end = len_chars
+            while start < len_chars:
+                while start < end:
+                    substr = "".join(token[start:end])
+                    if start != 0:
+                        substr = "##" + substr
+                    if substr in self.vocab_dict:
+                        output_tokens.append(substr)
+                        start = end
+                        end = len_chars
+                    else:
+                        end = end - 1
+                if start == end and start != len_chars:
+                    output_tokens.append("[UNK]")
+                    break
+        return output_tokens
+
+
+class LegacyBasicTokenizer(tokenization.BasicTokenizer):
+    """The separate passes over the text calling unicodedata for each char, the reference of the BasicTokenizer"""
+    def tokenize(self, text):
+        text = self._clean_text(text)
+        text = self._tokenize_chinese_chars(text)
+        split_tokens = []
+        for token in tokenization.whitespace_tokenize(text):
+            if self.do_lower_case:
+                token = token.lower()
+                token = self._run_strip_accents(token)
+            split_tokens.extend(self._run_split_on_punc(token))
+        return tokenization.whitespace_tokenize(" ".join(split_tokens))
+
+
+def read_corpus(input_file):
+    """Read the texts of the SQuAD json file, or the text fields of each line of the GLUE tsv or text file"""
+    if input_file.endswith(".json"):
+        with open(input_file, "r") as reader:
+            data = json.load(reader)["data"]
+        texts = []
+        for entry in data:
+            for paragraph in entry["paragraphs"]:
+                texts.append(paragraph["context"])
+                texts.extend(qa["question"] for qa in paragraph["qas"])
+        return texts
+    texts = []
+    with open(input_file, "r") as reader:
+        for line in reader:
+            texts.extend(field for field in line.rstrip("\n").split("\t") if " " in field)
+    return texts
+
+
+def synthetic_corpus(num_texts, seed=0):
+    """Write a vocab.txt with the frequent words and the pieces of the others, and return its path and the texts"""
+    rng = random.Random(seed)
+    words = ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 14))) for _ in range(40000)]
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]"] + list(string.ascii_lowercase + string.punctuation)
+    vocab += ["##" + char for char in string.ascii_lowercase]
+    vocab += words[:10000]
+    vocab += sorted({word[:rng.randint(1, 4)] for word in words[10000:]})
+    vocab += sorted({"##" + word[start:start + rng.randint(2, 4)] for word in words[10000:]
+                     for start in range(1, len(word) - 1, 3)})
+    fd, vocab_path = tempfile.mkstemp(suffix=".txt")
+    with os.fdopen(fd, "w") as writer:
+        writer.write("\n".join(dict.fromkeys(vocab)) + "\n")
+    # The words follow the Zipf distribution as the natural text
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    texts = [" ".join(rng.choices(words, weights, k=rng.randint(10, 60))) + "." for _ in range(num_texts)]
+    # Some of the texts have the accented letters and the CJK chars
+    for i in range(0, num_texts, 10):
+        texts[i] = texts[i].replace("e", "\u00e9", 3) + " \u4e2d\u6587\u6587\u672c\u3002"
+    return vocab_path, texts
+
+
+def timeit(func, items):
+    """Return the outputs of the func over the items and the seconds"""
+    start = time.perf_counter()
+    outputs = [func(item) for item in items]
+    return outputs, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_path", default="", help="The vocab.txt of BERT")
+    parser.add_argument("--input_file", default="", help="The SQuAD json file, or the GLUE tsv file")
+    parser.add_argument("--num_texts", default=5000, type=int, help="The number of the synthetic texts")
+    args = parser.parse_args()
+
+    if args.input_file:
+        if not args.vocab_path:
+            raise ValueError("The vocab_path should be set with the input_file.")
+        texts = read_corpus(args.input_file)
+        tokenizer = tokenization.FullTokenizer(args.vocab_path)
+    else:
+        vocab_path, texts = synthetic_corpus(args.num_texts)
+        try:
+            tokenizer = tokenization.FullTokenizer(args.vocab_path or vocab_path)
+        finally:
+            os.remove(vocab_path)
+    print(f"{len(texts)} texts")
+    legacy_basic = LegacyBasicTokenizer(tokenizer.do_lower_case)
+    tokenizer.basic_tokenize.tokenize("warm up \u00e9")
+    ascii_texts = [text for text in texts if text.isascii()]
+    for name, items in (("all texts", texts), ("ASCII texts", ascii_texts)):
+        expected, legacy_time = timeit(legacy_basic.tokenize, items)
+        outputs, table_time = timeit(tokenizer.basic_tokenize.tokenize, items)
+        assert outputs == expected, "The outputs of the BasicTokenizer differ from the reference"
+        print(f"basic tokenization of {name}: {len(items)} texts, per char {len(items) / legacy_time:,.0f} texts/s, "
+              f"tables {len(items) / table_time:,.0f} texts/s, {legacy_time / table_time:.2f}x")
+
+    words = [word for text in texts for word in tokenizer.basic_tokenize.tokenize(text)]
+
+    legacy = LegacyWordpieceTokenizer(tokenizer.vocab_dict)
+    tokenizer.wordpiece_tokenize.tokenize("warm up")
+    split_words = [word for word in words if word not in tokenizer.vocab_dict]
+    for name, items in (("all words", words), ("words not in the vocab", split_words)):
+        expected, legacy_time = timeit(legacy.tokenize, items)
+        outputs, trie_time = timeit(tokenizer.wordpiece_tokenize.tokenize, items)
+        assert outputs == expected, "The outputs of the WordpieceTokenizer differ from the reference"
+        print(f"WordPiece of {name}: {len(items)} words, substring lookup {len(items) / legacy_time:,.0f} words/s, "
+              f"trie {len(items) / trie_time:,.0f} words/s, {legacy_time / trie_time:.2f}x")
+
+    uncached = tokenization.FullTokenizer(tokenizer.vocab_dict, tokenizer.do_lower_case, cache_size=0)
+    uncached.tokenize("warm up")
+    expected, uncached_time = timeit(uncached.tokenize, texts)
+    outputs, cached_time = timeit(tokenizer.tokenize, texts)
+    assert outputs == expected, "The outputs of the word cache differ from the tokenization of each word"
+    stats = tokenizer.cache_stats()
+    print(f"full tokenization: {len(texts)} texts, no cache {len(texts) / uncached_time:,.0f} texts/s, "
+          f"word cache {len(texts) / cached_time:,.0f} texts/s, {uncached_time / cached_time:.2f}x, "
+          f"hit rate {stats['hit_rate']:.1%} of {stats['size']} cached words")
+
+
+if __name__ == "__main__":
+    main()
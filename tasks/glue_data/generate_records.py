@@ -23,7 +23,7 @@ import numpy as np
 
 from mindspore.mindrecord import FileWriter
 from mindspore.log import logging
-import transformer.tokenization.bert_tokenization as tokenization
+from tasks.nlp import tokenization
 
 
 class InputExample:
@@ -115,11 +115,7 @@ class DataProcessor:
             return lines
 
     def process_text(self, text):
-        if self.use_spm:
-            token_text = tokenization.preprocess_text(text, do_lower_case=self.do_lower_case)
-        else:
-            token_text = tokenization.convert_to_unicode(text)
-        return token_text
+        return tokenization.convert_to_unicode(text)
 
 
 class MnliProcessor(DataProcessor):
@@ -571,8 +567,18 @@ class ClassificationConverter:
         self.label_list = label_list
         self.max_seq_length = max_seq_length
 
-    def convert_single_example(self, example, tokenizer, task_name):
-        """Converts a single `InputExample` into a single `InputFeatures`."""
+    @staticmethod
+    def example_texts(example, task_name):
+        """The texts of the example to tokenize, the text_b is tokenized only if it is not empty."""
+        if isinstance(example, PaddingInputExample):
+            return []
+        return [example.text_a, example.text_b] if example.text_b else [example.text_a]
+
+    def convert_single_example(self, example, tokenizer, task_name, example_tokens=None):
+        """
+        Converts a single `InputExample` into a single `InputFeatures`. The example_tokens are the tokens of the
+        example_texts, which are tokenized here if they are None.
+        """
         max_seq_length = self.max_seq_length
         label_list = self.label_list
 
@@ -590,10 +596,10 @@ class ClassificationConverter:
             for (i, label) in enumerate(label_list):
                 label_map[label] = i
 
-        tokens_a = tokenizer.tokenize(example.text_a)
-        tokens_b = None
-        if example.text_b:
-            tokens_b = tokenizer.tokenize(example.text_b)
+        if example_tokens is None:
+            example_tokens = [tokenizer.tokenize(text) for text in self.example_texts(example, task_name)]
+        tokens_a = example_tokens[0]
+        tokens_b = example_tokens[1] if example.text_b else None
 
         if tokens_b:
             # Modifies `tokens_a` and `tokens_b` in place so that the total
@@ -640,7 +646,7 @@ class ClassificationConverter:
             tokens.append("[SEP]")
             segment_ids.append(1)
 
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
+        input_ids = _convert_tokens_to_ids(tokenizer, tokens)
 
         # The mask has 1 for real tokens and 0 for padding tokens. Only real
         # tokens are attended to.
@@ -750,7 +756,13 @@ class TranslationConverter:
         mask = mask * down_matrix
         return mask
 
-    def convert_single_example(self, example, tokenizer, task_name):
+    def example_texts(self, example, task_name):
+        """The texts of the example to tokenize, the prefixed text_a and the target label."""
+        if isinstance(example, PaddingInputExample):
+            return []
+        return [self._prepand_prefix(example.text_a), '[START] ' + _label_text(example, task_name) + ' [EOD]']
+
+    def convert_single_example(self, example, tokenizer, task_name, example_tokens=None):
         """
         Converts a single `InputExample` into a single `InputFeatures`.
         For example, the convert CoLA Task to the format like
@@ -758,29 +770,26 @@ class TranslationConverter:
         Processed input: cola sentence: John made Bill Master of himself
         Original target: 1
         Processed target: acceptable
+        The example_tokens are the tokens of the example_texts, which are tokenized here if they are None.
         """
 
         if isinstance(example, PaddingInputExample):
             return self._generate_zeros_feature()
 
-        example.text_a = self._prepand_prefix(example.text_a)
-        tokens_a = tokenizer.tokenize(example.text_a)
+        if example_tokens is None:
+            example_tokens = [tokenizer.tokenize(text) for text in self.example_texts(example, task_name)]
+        tokens_a, label = example_tokens
 
         if len(tokens_a) > self.src_seq_length:
             tokens_a = tokens_a[:self.src_seq_length]
 
-        if task_name != 'cola':
-            label = example.label
-        else:
-            label_mapper = {"0": 'negative', "1": 'positive'}
-            label = label_mapper[example.label]
-        label = tokenizer.convert_tokens_to_ids(tokenizer.tokenize('[START] ' + label + ' [EOD]'))
+        label = _convert_tokens_to_ids(tokenizer, label)
         if len(label) > self.tgt_seq_length + 1:
             label = label[:self.tgt_seq_length + 1]
         else:
             label += [0] * (self.tgt_seq_length + 1 - len(label))
 
-        source_eos_ids = tokenizer.convert_tokens_to_ids(tokens_a)
+        source_eos_ids = _convert_tokens_to_ids(tokenizer, tokens_a)
         if len(source_eos_ids) > self.src_seq_length:
             source_eos_ids = source_eos_ids[:self.src_seq_length]
         else:
@@ -823,7 +832,13 @@ class GeneratorConverter:
         }
         return sample
 
-    def convert_single_example(self, example, tokenizer, task_name):
+    def example_texts(self, example, task_name):
+        """The texts of the example to tokenize, the prefixed text_a and the target label."""
+        if isinstance(example, PaddingInputExample):
+            return []
+        return [self._prepand_prefix(example.text_a), _label_text(example, task_name) + ' [EOD]']
+
+    def convert_single_example(self, example, tokenizer, task_name, example_tokens=None):
         """
         Converts a single `InputExample` into a single `InputFeatures`.
         For example, the convert CoLA Task to the format like
@@ -831,24 +846,20 @@ class GeneratorConverter:
         Processed input: cola sentence: John made Bill Master of himself
         Original target: 1
         Processed target: acceptable
+        The example_tokens are the tokens of the example_texts, which are tokenized here if they are None.
         """
 
         if isinstance(example, PaddingInputExample):
             return self._generate_zeros_feature()
 
-        example.text_a = self._prepand_prefix(example.text_a)
-        tokens_a = tokenizer.tokenize(example.text_a)
+        if example_tokens is None:
+            example_tokens = [tokenizer.tokenize(text) for text in self.example_texts(example, task_name)]
+        tokens_a, label = example_tokens
 
         if len(tokens_a) > self.max_seq_length:
             tokens_a = tokens_a[:self.max_seq_length]
 
-        if task_name != 'cola':
-            label = example.label
-        else:
-            label_mapper = {"0": 'negative', "1": 'positive'}
-            label = label_mapper[example.label]
-        label = tokenizer.tokenize(label + ' [EOD]')
-        text = tokenizer.convert_tokens_to_ids(tokens_a + label)
+        text = _convert_tokens_to_ids(tokenizer, tokens_a + label)
         if len(text) > self.max_seq_length:
             text = text[:self.max_seq_length]
         else:
@@ -867,16 +878,33 @@ def file_based_convert_examples_to_features(
     writer.add_schema(converter.schema, "Preprocessed dataset")
     data = []
 
+    # Tokenize the texts of all the examples in a batch, then split the tokens back to each example
+    texts = [converter.example_texts(example, task_name) for example in examples]
+    tokens = iter(tokenizer.tokenize_batch([text for example_texts in texts for text in example_texts]))
     for (ex_index, example) in enumerate(examples):
         if ex_index % 10000 == 0:
             logging.info("Writing example %d of %d" % (ex_index, len(examples)))
-        record = converter.convert_single_example(example, tokenizer, task_name)
+        example_tokens = [next(tokens) for _ in texts[ex_index]]
+        record = converter.convert_single_example(example, tokenizer, task_name, example_tokens)
         data.append(record)
     print(f"Processed total {len(data)} examples.")
     writer.write_raw_data(data)
     writer.commit()
 
 
+def _convert_tokens_to_ids(tokenizer, tokens):
+    """Converts the tokens to the ids with the vocab of the tokenizer."""
+    return [tokenizer.vocab_dict[token] for token in tokens]
+
+
+def _label_text(example, task_name):
+    """The target text of the label, the labels of CoLA are mapped to words."""
+    if task_name != 'cola':
+        return example.label
+    label_mapper = {"0": 'negative', "1": 'positive'}
+    return label_mapper[example.label]
+
+
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
     """Truncates a sequence pair in place to the maximum length."""
 
@@ -942,6 +970,9 @@ def main():
     }
     convert = {'bert': ClassificationConverter, 'gpt': GeneratorConverter, 't5': TranslationConverter}
     args_opt = get_argument()
+    if args_opt.spm_model_file:
+        raise ValueError("The SentencePiece model is not supported, please use the WordPiece vocab.txt as the "
+                         "vocab_path.")
     task_name = args_opt.task_name.lower()
     processor = processors[task_name](
         use_spm=bool(args_opt.spm_model_file),
@@ -955,8 +986,8 @@ def main():
         print(f"mkdir -p {output_dir}")
         os.makedirs(output_dir, exist_ok=True)
 
-    tokenizer = tokenization.FullTokenizer(
-        vocab_file=args_opt.vocab_path, do_lower_case=args_opt.do_lower_case, spm_model_file=args_opt.spm_model_file)
+    do_lower_case = args_opt.do_lower_case.lower() == "true"
+    tokenizer = tokenization.get_tokenizer(args_opt.vocab_path, do_lower_case=do_lower_case)
 
     convert_class = convert[args_opt.format]
     if args_opt.format == 't5':
@@ -191,7 +191,7 @@ def run_squad(args_opt):
         from tasks.nlp.question_answering.src.create_squad_data import read_squad_examples, convert_examples_to_features
         from tasks.nlp.question_answering.src.squad_get_predictions import write_predictions
         from tasks.nlp.question_answering.src.squad_postprocess import squad_postprocess
-        tokenizer = tokenization.FullTokenizer(vocab_file=args_opt.vocab_file_path, do_lower_case=True)
+        tokenizer = tokenization.get_tokenizer(args_opt.vocab_file_path, do_lower_case=True)
         eval_examples = read_squad_examples(args_opt.eval_json_path, False)
         eval_features = convert_examples_to_features(
             examples=eval_examples,
@@ -17,7 +17,7 @@
 
 import collections
 import json
-from  tasks.nlp.bert_downstream.src import tokenization
+from tasks.nlp import tokenization
 
 
 class SquadExample():
@@ -53,12 +53,15 @@ class InputFeatures():
                  segment_ids,
                  start_position=None,
                  end_position=None,
-                 is_impossible=None):
+                 is_impossible=None,
+                 token_offsets=None):
         self.unique_id = unique_id
         self.example_index = example_index
         self.doc_span_index = doc_span_index
         self.tokens = tokens
         self.token_to_orig_map = token_to_orig_map
+        # The (start, end) of the chars of each document token in its original word
+        self.token_offsets = token_offsets
         self.token_is_max_context = token_is_max_context
         self.input_ids = input_ids
         self.input_mask = input_mask
@@ -159,27 +162,60 @@ def _check_is_max_context(doc_spans, cur_span_index, position):
             best_span_index = span_index
     return cur_span_index == best_span_index
 
-def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer,
-                         orig_answer_text):
-    """Returns tokenized answer spans that better match the annotated answer."""
-    tok_answer_text = " ".join(tokenizer.tokenize(orig_answer_text))
 
-    for new_start in range(input_start, input_end + 1):
-        for new_end in range(input_end, new_start - 1, -1):
-            text_span = " ".join(doc_tokens[new_start:(new_end + 1)])
-            if text_span == tok_answer_text:
-                return (new_start, new_end)
+def _lower_in_place(text):
+    """Lower case the chars of the text one by one, the chars whose lower case is longer, such as 'İ', are kept so
+    that the chars stay in place"""
+    return "".join(char.lower() if len(char.lower()) == 1 else char for char in text)
+
 
+def _improve_answer_span(doc_tokens, input_start, input_end, all_doc_tokens, tok_to_orig_index, tok_offsets,
+                         orig_answer_text, do_lower_case=True):
+    """Returns tokenized answer spans that better match the annotated answer."""
+    # Find the answer in the original words of the span joined by the spaces, and take the first occurrence whose
+    # chars start with a token which is not a part of a word, and end with a token
+    orig_start = tok_to_orig_index[input_start]
+    orig_end = tok_to_orig_index[input_end]
+    span_text = " ".join(doc_tokens[orig_start:(orig_end + 1)])
+    answer_text = " ".join(tokenization.whitespace_tokenize(orig_answer_text))
+    if not answer_text:
+        return (input_start, input_end)
+    if do_lower_case:
+        span_text = _lower_in_place(span_text)
+        answer_text = _lower_in_place(answer_text)
+
+    word_starts = [0]
+    for word in doc_tokens[orig_start:orig_end]:
+        word_starts.append(word_starts[-1] + len(word) + 1)
+    token_starts = {}
+    token_ends = {}
+    for i in range(input_start, input_end + 1):
+        word_start = word_starts[tok_to_orig_index[i] - orig_start]
+        if not all_doc_tokens[i].startswith("##"):
+            token_starts.setdefault(word_start + tok_offsets[i][0], i)
+        token_ends[word_start + tok_offsets[i][1]] = i
+
+    answer_start = span_text.find(answer_text)
+    while answer_start != -1:
+        new_start = token_starts.get(answer_start)
+        new_end = token_ends.get(answer_start + len(answer_text))
+        if new_start is not None and new_end is not None and new_end >= new_start:
+            return (new_start, new_end)
+        answer_start = span_text.find(answer_text, answer_start + 1)
     return (input_start, input_end)
 
 
 def convert_examples_to_features(examples, tokenizer, max_seq_length, doc_stride,
-                                 max_query_length, is_training, vocab_file):
+                                 max_query_length, is_training, vocab_file, num_workers=None):
     """Loads a data file into a list of `InputBatch`s."""
     unique_id = 1000000000
     output = []
+    # The questions and the distinct words of the documents are tokenized in a batch by the worker processes
+    all_query_tokens = tokenizer.tokenize_batch([example.question_text for example in examples], num_workers)
+    doc_words = list(dict.fromkeys(token for example in examples for token in example.doc_tokens))
+    doc_word_tokens = dict(zip(doc_words, tokenizer.tokenize_batch(doc_words, num_workers, with_offsets=True)))
     for (example_index, example) in enumerate(examples):
-        query_tokens = tokenizer.tokenize(example.question_text)
+        query_tokens = all_query_tokens[example_index]
 
         if len(query_tokens) > max_query_length:
             query_tokens = query_tokens[0:max_query_length]
@@ -187,12 +223,14 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length, doc_stride
         tok_to_orig_index = []
         orig_to_tok_index = []
         all_doc_tokens = []
+        all_doc_offsets = []
         for (i, token) in enumerate(example.doc_tokens):
             orig_to_tok_index.append(len(all_doc_tokens))
-            sub_tokens = tokenizer.tokenize(token)
-            for sub_token in sub_tokens:
+            sub_tokens, sub_offsets = doc_word_tokens[token]
+            for sub_token, sub_offset in zip(sub_tokens, sub_offsets):
                 tok_to_orig_index.append(i)
                 all_doc_tokens.append(sub_token)
+                all_doc_offsets.append(sub_offset)
 
         tok_start_position = None
         tok_end_position = None
@@ -206,8 +244,8 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length, doc_stride
             else:
                 tok_end_position = len(all_doc_tokens) - 1
             (tok_start_position, tok_end_position) = _improve_answer_span(
-                all_doc_tokens, tok_start_position, tok_end_position, tokenizer,
-                example.orig_answer_text)
+                example.doc_tokens, tok_start_position, tok_end_position, all_doc_tokens, tok_to_orig_index,
+                all_doc_offsets, example.orig_answer_text, tokenizer.do_lower_case)
 
         # The -3 accounts for [CLS], [SEP] and [SEP]
         max_tokens_for_doc = max_seq_length - len(query_tokens) - 3
@@ -230,6 +268,7 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length, doc_stride
         for (doc_span_index, doc_span) in enumerate(doc_spans):
             tokens = []
             token_to_orig_map = {}
+            token_offsets = {}
             token_is_max_context = {}
             segment_ids = []
             tokens.append("[CLS]")
@@ -243,6 +282,7 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length, doc_stride
             for i in range(doc_span.length):
                 split_token_index = doc_span.start + i
                 token_to_orig_map[len(tokens)] = tok_to_orig_index[split_token_index]
+                token_offsets[len(tokens)] = all_doc_offsets[split_token_index]
 
                 is_max_context = _check_is_max_context(doc_spans, doc_span_index, split_token_index)
                 token_is_max_context[len(tokens)] = is_max_context
@@ -301,7 +341,8 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length, doc_stride
                 segment_ids=segment_ids,
                 start_position=start_position,
                 end_position=end_position,
-                is_impossible=example.is_impossible)
+                is_impossible=example.is_impossible,
+                token_offsets=token_offsets)
 
             # Run callback
             output.append(feature)
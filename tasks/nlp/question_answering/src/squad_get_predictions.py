@@ -18,7 +18,7 @@
 import math
 import collections
 import six
-from tasks.nlp.bert_downstream.src import tokenization
+from tasks.nlp import tokenization
 
 
 def get_prelim_predictions(features, unique_id_to_result, n_best_size, max_answer_length):
@@ -82,21 +82,26 @@ def get_nbest(prelim_predictions, features, example, n_best_size, do_lower_case)
             break
         feature = features[pred.feature_index]
         if pred.start_index > 0:  # this is a non-null prediction
-            tok_tokens = feature.tokens[pred.start_index:(pred.end_index + 1)]
             orig_doc_start = feature.token_to_orig_map[pred.start_index]
             orig_doc_end = feature.token_to_orig_map[pred.end_index]
             orig_tokens = example.doc_tokens[orig_doc_start:(orig_doc_end + 1)]
-            tok_text = " ".join(tok_tokens)
-
-            # De-tokenize WordPieces that have been split off.
-            tok_text = tok_text.replace(" ##", "")
-            tok_text = tok_text.replace("##", "")
-
-            # Clean whitespace
-            tok_text = tok_text.strip()
-            tok_text = " ".join(tok_text.split())
             orig_text = " ".join(orig_tokens)
-            final_text = get_final_text(tok_text, orig_text, do_lower_case)
+            if feature.token_offsets is not None:
+                # Cut the original words from the first char of the start token to the last char of the end token
+                orig_end = len(orig_text) - len(orig_tokens[-1]) + feature.token_offsets[pred.end_index][1]
+                final_text = orig_text[feature.token_offsets[pred.start_index][0]:orig_end]
+            else:
+                tok_tokens = feature.tokens[pred.start_index:(pred.end_index + 1)]
+                tok_text = " ".join(tok_tokens)
+
+                # De-tokenize WordPieces that have been split off.
+                tok_text = tok_text.replace(" ##", "")
+                tok_text = tok_text.replace("##", "")
+
+                # Clean whitespace
+                tok_text = tok_text.strip()
+                tok_text = " ".join(tok_text.split())
+                final_text = get_final_text(tok_text, orig_text, do_lower_case)
             if final_text in seen_predictions:
                 continue
 
@@ -59,7 +59,7 @@ def submit(model=None, path="", vocab_file="", use_crf="", label_file="", tag_to
     """
     submit task
     """
-    tokenizer_ = tokenization.FullTokenizer(vocab_file=vocab_file)
+    tokenizer_ = tokenization.get_tokenizer(vocab_file)
     data = []
     for line in open(path):
         if not line.strip():
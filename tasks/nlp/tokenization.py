@@ -17,9 +17,15 @@
 Tokenization.
 """
 
+import multiprocessing
+import os
+import re
 import unicodedata
 import collections
 
+import numpy as np
+
+
 def convert_to_unicode(text):
     """
     Convert text into unicode type.
@@ -69,6 +75,79 @@ def vocab_to_dict_key_id(vocab_file):
     return vocab
 
 
+class Vocab:
+    """
+    The maps between the tokens and the ids of a vocab file, which are built when they are used for the first time.
+
+    Args:
+        vocab_file: path to vocab.txt.
+    """
+    def __init__(self, vocab_file):
+        self.vocab_file = vocab_file
+        self._token_to_id = None
+        self._id_to_token = None
+
+    @property
+    def token_to_id(self):
+        """The dict whose key is token"""
+        if self._token_to_id is None:
+            self._token_to_id = vocab_to_dict_key_token(self.vocab_file)
+        return self._token_to_id
+
+    @property
+    def id_to_token(self):
+        """The dict whose key is id"""
+        if self._id_to_token is None:
+            self._id_to_token = vocab_to_dict_key_id(self.vocab_file)
+        return self._id_to_token
+
+
+# The vocabs and the tokenizers shared in the process, keyed by the real path of the vocab file
+_VOCABS = {}
+_TOKENIZERS = {}
+
+
+def _file_stamp(vocab_file):
+    """The modification time and the size of the file, the cached vocab is reloaded if they change"""
+    stat = os.stat(vocab_file)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def get_vocab(vocab_file):
+    """
+    Get the Vocab of the vocab file shared in the process, so that the file is parsed only once.
+    Args:
+        vocab_file: path to vocab.txt.
+
+    Returns:
+        the Vocab of the file.
+    """
+    key = os.path.realpath(vocab_file)
+    stamp = _file_stamp(key)
+    item = _VOCABS.get(key)
+    if item is None or item[0] != stamp:
+        item = _VOCABS[key] = (stamp, Vocab(key))
+    return item[1]
+
+
+def get_tokenizer(vocab_file, do_lower_case=True):
+    """
+    Get the FullTokenizer of the vocab file shared in the process, which uses the map of the shared Vocab.
+    Args:
+        vocab_file: path to vocab.txt.
+        do_lower_case: whether to lower case the input text. Default: True.
+
+    Returns:
+        the FullTokenizer of the file.
+    """
+    vocab = get_vocab(vocab_file)
+    key = (vocab.vocab_file, do_lower_case)
+    item = _TOKENIZERS.get(key)
+    if item is None or item[0] is not vocab:
+        item = _TOKENIZERS[key] = (vocab, FullTokenizer(vocab.token_to_id, do_lower_case))
+    return item[1]
+
+
 def whitespace_tokenize(text):
     """Runs basic whitespace cleaning and splitting on a piece of text."""
     text = text.strip()
@@ -88,7 +167,7 @@ def convert_tokens_to_ids(vocab_file, tokens):
     Returns:
         list of ids.
     """
-    vocab_dict = vocab_to_dict_key_token(vocab_file)
+    vocab_dict = get_vocab(vocab_file).token_to_id
     output = []
     for token in tokens:
         output.append(vocab_dict[token])
@@ -105,22 +184,112 @@ def convert_ids_to_tokens(vocab_file, ids):
     Returns:
         list of tokens.
     """
-    vocab_dict = vocab_to_dict_key_id(vocab_file)
+    vocab_dict = get_vocab(vocab_file).id_to_token
     output = []
     for id1 in ids:
         output.append(vocab_dict[id1])
     return output
 
 
+# The tokenizer and the texts of the batch of a pool worker, set by its initializer
+_WORKER_STATE = None
+# The batches smaller than this for each worker are tokenized in the process, as the pool costs more than it saves
+_MIN_TEXTS_PER_WORKER = 256
+
+
+def _tokenize_texts(tokenizer, texts):
+    """The tokens of each text"""
+    return [tokenizer.tokenize(text) for text in texts]
+
+
+def _tokenize_texts_with_offsets(tokenizer, texts):
+    """The tokens and the offsets of each text"""
+    return [tokenizer.tokenize_with_offsets(text) for text in texts]
+
+
+def _encode_texts(tokenizer, texts):
+    """The ids of all the texts joined together, and the number of the ids of each text"""
+    vocab_dict = tokenizer.vocab_dict
+    ids = []
+    lengths = np.zeros(len(texts), np.int64)
+    for i, text in enumerate(texts):
+        tokens = tokenizer.tokenize(text)
+        ids.extend(vocab_dict[token] for token in tokens)
+        lengths[i] = len(tokens)
+    return np.array(ids, np.int32), lengths
+
+
+def _init_worker(tokenizer, texts):
+    """Keep the tokenizer and the texts of the batch in the pool worker"""
+    global _WORKER_STATE
+    _WORKER_STATE = (tokenizer, texts)
+
+
+def _run_chunk(args):
+    """Run the func over a chunk of the texts of the batch of the pool worker"""
+    func, start, end = args
+    tokenizer, texts = _WORKER_STATE
+    return func(tokenizer, texts[start:end])
+
+
+def _map_chunks(tokenizer, func, texts, num_workers):
+    """
+    Run the func over the contiguous chunks of the texts in a pool of forked processes, and return the outputs of
+    the chunks in order. The tokenizer and the texts are the arguments of the initializer of the workers, which the
+    forked workers inherit without pickling, so only the bounds of each chunk and its outputs are sent between the
+    processes.
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = min(num_workers, len(texts) // _MIN_TEXTS_PER_WORKER)
+    if num_workers <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        return [func(tokenizer, texts)]
+    # Build the lazy tables in the parent process, so that the workers share them instead of building their own
+    _basic_tables()
+    tokenizer.wordpiece_tokenize.tokenize("")
+    # Several chunks for each worker balance the load of the texts of different lengths
+    step = -(-len(texts) // (num_workers * 4))
+    chunks = [(func, start, min(start + step, len(texts))) for start in range(0, len(texts), step)]
+    with multiprocessing.get_context("fork").Pool(num_workers, initializer=_init_worker,
+                                                  initargs=(tokenizer, texts)) as pool:
+        return pool.map(_run_chunk, chunks)
+
+
 class FullTokenizer():
     """
     Full tokenizer
+
+    Args:
+        vocab_file: path to vocab.txt, or a dict whose key is token and value is id.
+        do_lower_case: whether to lower case the input text. Default: True.
+        cache_size: the number of the most recently used words whose tokens are cached, 0 to disable the cache
+            and None for no limit. Default: 65536.
     """
-    def __init__(self, vocab_file, do_lower_case=True):
-        self.vocab_dict = vocab_to_dict_key_token(vocab_file)
+    def __init__(self, vocab_file, do_lower_case=True, cache_size=65536):
+        self.vocab_dict = vocab_file if isinstance(vocab_file, dict) else vocab_to_dict_key_token(vocab_file)
         self.do_lower_case = do_lower_case
         self.basic_tokenize = BasicTokenizer(do_lower_case)
         self.wordpiece_tokenize = WordpieceTokenizer(self.vocab_dict)
+        self.cache_size = cache_size
+        self._init_cache()
+
+    def _init_cache(self):
+        """Create the empty word cache, which maps each word to its tokens in the order of the last use"""
+        # Most of the words of the natural text are repeats, so the tokens of each word are cached
+        self._cache = collections.OrderedDict()
+        self._cache_hits = 0
+        self._cache_misses = 0
+
+    def __getstate__(self):
+        """The word cache is not pickled, the unpickled tokenizer starts with an empty cache"""
+        state = self.__dict__.copy()
+        for key in ("_cache", "_cache_hits", "_cache_misses"):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
 
     def tokenize(self, text):
         """
@@ -133,11 +302,129 @@ class FullTokenizer():
         """
         tokens_ret = []
         text = convert_to_unicode(text)
-        for tokens in self.basic_tokenize.tokenize(text):
-            wordpiece_tokens = self.wordpiece_tokenize.tokenize(tokens)
-            tokens_ret.extend(wordpiece_tokens)
+        for word in self.basic_tokenize.split_words(text):
+            tokens_ret.extend(self._tokenize_word(word))
         return tokens_ret
 
+    def tokenize_with_offsets(self, text):
+        """
+        Do full tokenization, and find the chars of the text which each token comes from.
+        Args:
+            text: str of text.
+
+        Returns:
+            tokens: list of tokens, the same as the output of tokenize.
+            offsets: list of the (start, end) of each token, which comes from text[start:end]. A word piece covers
+                the chars of its part of the word, and a [UNK] covers the rest of its basic token.
+        """
+        tokens_ret = []
+        offsets = []
+        text = convert_to_unicode(text)
+        for word, positions in self.basic_tokenize.split_words_with_positions(text):
+            tokens, spans = self._tokenize_word_with_spans(word)
+            tokens_ret.extend(tokens)
+            offsets.extend((positions[start], positions[end - 1] + 1) for start, end in spans)
+        return tokens_ret, offsets
+
+    def _tokenize_word_with_spans(self, word):
+        """The word pieces of a word of split_words, and the (start, end) of the chars of the word of each piece"""
+        basic_tokens = self.basic_tokenize.tokenize_word(word)
+        # The position in the word of each char of the basic tokens. The lower case and the accents of a few chars
+        # depend on the chars around them, and then each piece covers the whole word.
+        char_positions = []
+        for i, char in enumerate(word):
+            char_positions.extend([i] * sum(len(token) for token in self.basic_tokenize.tokenize_word(char)))
+        aligned = len(char_positions) == sum(len(token) for token in basic_tokens)
+        tokens = []
+        spans = []
+        start = 0
+        for token in basic_tokens:
+            token_end = start + len(token)
+            for i, piece in enumerate(self.wordpiece_tokenize.tokenize(token)):
+                if piece == "[UNK]":
+                    end = token_end
+                else:
+                    end = start + (len(piece) - 2 if i else len(piece))
+                tokens.append(piece)
+                spans.append((char_positions[start], char_positions[end - 1] + 1) if aligned else (0, len(word)))
+                start = end
+            start = token_end
+        return tokens, spans
+
+    def _tokenize_word(self, word):
+        """The word pieces of a word of split_words, looked up in the word cache first"""
+        tokens = self._cache.get(word)
+        if tokens is not None:
+            self._cache_hits += 1
+            self._cache.move_to_end(word)
+            return tokens
+        self._cache_misses += 1
+        tokens = self._tokenize_word_uncached(word)
+        if self.cache_size is None or self.cache_size > 0:
+            self._cache[word] = tokens
+            if self.cache_size is not None and len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return tokens
+
+    def _tokenize_word_uncached(self, word):
+        """The word pieces of the tokens of a word of split_words"""
+        tokens = []
+        for token in self.basic_tokenize.tokenize_word(word):
+            tokens.extend(self.wordpiece_tokenize.tokenize(token))
+        return tuple(tokens)
+
+    def cache_stats(self):
+        """
+        The stats of the word cache.
+
+        Returns:
+            dict of the number of the "hits" and "misses" of the cache, the "hit_rate", the number of the cached
+            words "size" and the "max_size".
+        """
+        lookups = self._cache_hits + self._cache_misses
+        return {"hits": self._cache_hits, "misses": self._cache_misses,
+                "hit_rate": self._cache_hits / lookups if lookups else 0.0,
+                "size": len(self._cache), "max_size": self.cache_size}
+
+    def clear_cache(self):
+        """Clear the word cache and its stats"""
+        self._init_cache()
+
+    def tokenize_batch(self, texts, num_workers=None, with_offsets=False):
+        """
+        Do full tokenization of a batch of texts in a pool of worker processes.
+        Args:
+            texts: list of str.
+            num_workers: the number of the worker processes, the number of the cpus if None. The small batches
+                and the platforms without fork are tokenized in the current process. Default: None.
+            with_offsets: whether to return the output of tokenize_with_offsets for each text. Default: False.
+
+        Returns:
+            list of the tokens of each text, in the order of the texts.
+        """
+        texts = list(texts)
+        func = _tokenize_texts_with_offsets if with_offsets else _tokenize_texts
+        return [tokens for chunk in _map_chunks(self, func, texts, num_workers) for tokens in chunk]
+
+    def encode_batch(self, texts, num_workers=None):
+        """
+        Tokenize a batch of texts and convert the tokens to ids in a pool of worker processes.
+        Args:
+            texts: list of str.
+            num_workers: the number of the worker processes, the number of the cpus if None. Default: None.
+
+        Returns:
+            ids: numpy.ndarray of int32, the ids of all the texts joined together.
+            offsets: numpy.ndarray of int64 with length len(texts) + 1, the ids of the i-th text are
+                ids[offsets[i]:offsets[i + 1]].
+        """
+        texts = list(texts)
+        chunks = _map_chunks(self, _encode_texts, texts, num_workers)
+        ids = np.concatenate([chunk_ids for chunk_ids, _ in chunks])
+        offsets = np.zeros(len(texts) + 1, np.int64)
+        np.cumsum(np.concatenate([lengths for _, lengths in chunks]), out=offsets[1:])
+        return ids, offsets
+
 
 class BasicTokenizer():
     """
@@ -155,20 +442,90 @@ class BasicTokenizer():
         Returns:
             a list of tokens split from text
         """
-        text = self._clean_text(text)
-        text = self._tokenize_chinese_chars(text)
-
-        orig_tokens = whitespace_tokenize(text)
-        split_tokens = []
-        for token in orig_tokens:
+        if text.isascii():
+            # The ASCII text has no CJK char and no accent, so the chars are cleaned and the punctuations are
+            # split in a single translation
+            text = text.translate(_ASCII_TABLE)
             if self.do_lower_case:
-                token = token.lower()
-                token = self._run_strip_accents(token)
-            aaa = self._run_split_on_punc(token)
-            split_tokens.extend(aaa)
+                text = text.lower()
+            return text.split()
+        split_tokens = []
+        for word in self.split_words(text):
+            split_tokens.extend(self.tokenize_word(word))
+        return split_tokens
 
-        output_tokens = whitespace_tokenize(" ".join(split_tokens))
-        return output_tokens
+    def split_words(self, text):
+        """
+        Clean the text and split it at the whitespaces and around the CJK chars. The tokens of the text are the
+        tokens of each word by tokenize_word joined together.
+        Args:
+            text: text in unicode.
+
+        Returns:
+            a list of words split from text
+        """
+        if text.isascii():
+            return text.translate(_ASCII_TABLE).split()
+        if max(text) > "\uffff":
+            # The tables only cover the chars in the basic multilingual plane
+            text = self._clean_text(text)
+        else:
+            text = text.translate(_basic_tables().clean)
+        return _CHINESE_CHAR_PATTERN.sub(r" \g<0> ", text).split()
+
+    def split_words_with_positions(self, text):
+        """
+        Split the text into the same words as split_words, with the position in text of each char of each word.
+        Args:
+            text: text in unicode.
+
+        Returns:
+            a list of the words and the lists of the positions of their chars
+        """
+        tables = _basic_tables()
+        words = []
+        chars = []
+        positions = []
+        for i, char in enumerate(text):
+            char = self._clean_text(char) if char > "\uffff" else tables.clean.get(ord(char), char)
+            if not char:
+                continue
+            if char.isspace() or self._is_chinese_char(ord(char)):
+                if chars:
+                    words.append(("".join(chars), positions))
+                    chars, positions = [], []
+                if not char.isspace():
+                    words.append((char, [i]))
+                continue
+            chars.append(char)
+            positions.append(i)
+        if chars:
+            words.append(("".join(chars), positions))
+        return words
+
+    def tokenize_word(self, word):
+        """
+        Lower case the word, strip its accents and split its punctuations.
+        Args:
+            word: a word of split_words.
+
+        Returns:
+            a list of tokens split from word
+        """
+        if word.isascii():
+            if self.do_lower_case:
+                word = word.lower()
+            return _ASCII_PUNCTUATION_PATTERN.findall(word)
+        tables = _basic_tables()
+        if self.do_lower_case:
+            word = unicodedata.normalize("NFD", word.lower())
+            if max(word) > "\uffff":
+                word = self._run_strip_accents(word)
+            else:
+                word = tables.mark.sub("", word)
+        if max(word, default="") > "\uffff":
+            return self._run_split_on_punc(word)
+        return tables.punctuation.findall(word)
 
     def _run_strip_accents(self, text):
         """Strips accents from a piece of text."""
@@ -247,12 +604,38 @@ class BasicTokenizer():
         return False
 
 
+# The key of the trie node which marks the end of a vocab word, which is never a char of the text
+_TRIE_END = ""
+
+
+def _build_wordpiece_tries(vocab):
+    """
+    Build the prefix tries of the vocab words for the first piece of a word, and of the vocab words without
+    the "##" for the other pieces. Each node is a dict from the next char to the child node.
+    """
+    word_trie = {}
+    subword_trie = {}
+    for word in vocab:
+        tries = [(word_trie, word)]
+        if word.startswith("##"):
+            tries.append((subword_trie, word[2:]))
+        for node, chars in tries:
+            for char in chars:
+                node = node.setdefault(char, {})
+            node[_TRIE_END] = True
+    return word_trie, subword_trie
+
+
 class WordpieceTokenizer():
     """
     Wordpiece tokenizer
+
+    The longest vocab word at each position is found by walking the prefix tries of the vocab once, instead of
+    looking up each shorter substring in the vocab. The tries are built at the first tokenization.
     """
     def __init__(self, vocab):
         self.vocab_dict = vocab
+        self._tries = None
 
     def tokenize(self, tokens):
         """
@@ -265,25 +648,35 @@ class WordpieceTokenizer():
         """
         output_tokens = []
         tokens = convert_to_unicode(tokens)
+        if self._tries is None:
+            self._tries = _build_wordpiece_tries(self.vocab_dict)
+        word_trie, subword_trie = self._tries
         for token in whitespace_tokenize(tokens):
-            chars = list(token)
-            len_chars = len(chars)
+            # Most of the words are in the vocab as a whole
+            if token in self.vocab_dict:
+                output_tokens.append(token)
+                continue
+            len_chars = len(token)
             start = 0
-            end = len_chars
+            trie = word_trie
             while start < len_chars:
-                while start < end:
-                    substr = "".join(token[start:end])
-                    if start != 0:
-                        substr = "##" + substr
-                    if substr in self.vocab_dict:
-                        output_tokens.append(substr)
-                        start = end
-                        end = len_chars
-                    else:
-                        end = end - 1
-                if start == end and start != len_chars:
+                # Walk the trie from the start, the last vocab word passed is the longest match
+                node = trie
+                end = start
+                i = start
+                for char in token[start:]:
+                    node = node.get(char)
+                    if node is None:
+                        break
+                    i += 1
+                    if _TRIE_END in node:
+                        end = i
+                if end == start:
                     output_tokens.append("[UNK]")
                     break
+                output_tokens.append(token[start:end] if start == 0 else "##" + token[start:end])
+                start = end
+                trie = subword_trie
         return output_tokens
 
 
@@ -291,8 +684,7 @@ def _is_whitespace(char):
     """Checks whether `chars` is a whitespace character."""
     # \t, \n, and \r are technically control characters but we treat them
     # as whitespace since they are generally considered as such.
-    whitespace_char = [" ", "\t", "\n", "\r"]
-    if char in whitespace_char:
+    if char in " \t\n\r":
         return True
     cat = unicodedata.category(char)
     if cat == "Zs":
@@ -304,8 +696,7 @@ def _is_control(char):
     """Checks whether `chars` is a control character."""
     # These are technically control characters but we count them as whitespace
     # characters.
-    control_char = ["\t", "\n", "\r"]
-    if char in control_char:
+    if char in "\t\n\r":
         return False
     cat = unicodedata.category(char)
     if cat in ("Cc", "Cf"):
@@ -327,3 +718,84 @@ def _is_punctuation(char):
     if cat.startswith("P"):
         return True
     return False
+
+
+# The class flags of the chars in the basic multilingual plane
+_WHITESPACE = 1
+_CONTROL = 2
+_PUNCTUATION = 4
+_MARK = 8
+
+# Any CJK char is a single token, the same ranges as BasicTokenizer._is_chinese_char
+_CHINESE_CHAR_PATTERN = re.compile("[\u4E00-\u9FFF\u3400-\u4DBF\U00020000-\U0002A6DF\U0002A700-\U0002B73F"
+                                   "\U0002B740-\U0002B81F\U0002B820-\U0002CEAF\uF900-\uFAFF\U0002F800-\U0002FA1F]")
+_ASCII_PUNCTUATION = "!-/:-@\\[-`{-~"
+_ASCII_PUNCTUATION_PATTERN = re.compile(f"[{_ASCII_PUNCTUATION}]|[^{_ASCII_PUNCTUATION}]+")
+
+
+def _build_ascii_table():
+    """The translation of the ASCII chars which removes the control chars and splits the punctuations"""
+    table = {}
+    for cp in range(128):
+        char = chr(cp)
+        if cp == 0 or _is_control(char):
+            table[cp] = None
+        elif _is_whitespace(char):
+            table[cp] = " "
+        elif _is_punctuation(char):
+            table[cp] = f" {char} "
+    return table
+
+
+_ASCII_TABLE = _build_ascii_table()
+
+
+def _char_class_pattern(char_classes, flag):
+    """The regular expression char class of the chars with the flag"""
+    ranges = []
+    start = None
+    for cp in range(len(char_classes) + 1):
+        if cp < len(char_classes) and char_classes[cp] & flag:
+            start = cp if start is None else start
+        elif start is not None:
+            ranges.append(f"\\u{start:04x}-\\u{cp - 1:04x}")
+            start = None
+    return "".join(ranges)
+
+
+class _BasicTables:
+    """
+    The lookup tables of the BasicTokenizer for the chars in the basic multilingual plane: the class flags of
+    each char, the translation which removes the control chars and replaces the whitespaces, and the regular
+    expressions of the nonspacing marks and the punctuations.
+    """
+    def __init__(self):
+        self.char_classes = bytearray(0x10000)
+        for cp in range(0x10000):
+            char = chr(cp)
+            flags = 0
+            if _is_whitespace(char):
+                flags |= _WHITESPACE
+            if cp in (0, 0xfffd) or _is_control(char):
+                flags |= _CONTROL
+            if _is_punctuation(char):
+                flags |= _PUNCTUATION
+            if unicodedata.category(char) == "Mn":
+                flags |= _MARK
+            self.char_classes[cp] = flags
+        self.clean = {cp: None if flags & _CONTROL else " " for cp, flags in enumerate(self.char_classes)
+                      if flags & (_CONTROL | _WHITESPACE)}
+        self.mark = re.compile(f"[{_char_class_pattern(self.char_classes, _MARK)}]+")
+        punctuation = _char_class_pattern(self.char_classes, _PUNCTUATION)
+        self.punctuation = re.compile(f"[{punctuation}]|[^{punctuation}]+")
+
+
+_BASIC_TABLES = None
+
+
+def _basic_tables():
+    """Build the tables at the first use, as it takes tens of milliseconds"""
+    global _BASIC_TABLES
+    if _BASIC_TABLES is None:
+        _BASIC_TABLES = _BasicTables()
+    return _BASIC_TABLES
@@ -0,0 +1,88 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+Test module for testing the encoder output cache
+How to run this:
+pytest tests/test_encoder_cache.py
+"""
+
+from types import SimpleNamespace
+
+import numpy as np
+
+from transformer.encoder_cache import EncoderOutputCache, build_encoder_cache
+
+
+def _source(*ids):
+    """The source ids and mask of a single row"""
+    input_ids = np.zeros((1, 4), np.int32)
+    input_ids[0, :len(ids)] = ids
+    return input_ids, (input_ids > 0).astype(np.int32)
+
+
+def test_encoder_cache_hit():
+    """
+    Feature: Reuse the encoder outputs of the same sources
+    Description: Look up the sources before and after their outputs are stored, and the same ids with another mask
+    Expectation: Only the same ids with the same mask hit, and the stored output is returned as it is
+    """
+    cache = EncoderOutputCache(max_bytes=1 << 20)
+    input_ids, input_mask = _source(1, 2, 3)
+    assert cache.get(input_ids, input_mask) is None
+    output = np.ones((1, 4, 8), np.float32)
+    cache.put(input_ids, input_mask, output)
+    assert cache.get(input_ids.copy(), input_mask.copy()) is output
+    assert cache.get(input_ids, np.ones_like(input_mask)) is None
+    assert cache.get(input_ids.astype(np.int64), input_mask) is None
+    cache.put(input_ids, input_mask, np.zeros((1, 4, 8), np.float32))
+    assert cache.get(input_ids, input_mask) is output
+    assert cache.stats() == {"hits": 2, "misses": 3, "hit_rate": 0.4, "num_entries": 1, "num_bytes": output.nbytes,
+                             "evictions": 0}
+
+
+def test_encoder_cache_eviction():
+    """
+    Feature: Evict the encoder outputs over the memory budget
+    Description: Store three outputs in the budget of two after using the first one again, and an output larger
+        than the budget
+    Expectation: The least recently used output is evicted, and the output larger than the budget is not stored
+    """
+    output = np.ones((1, 4, 8), np.float32)
+    cache = EncoderOutputCache(max_bytes=2 * output.nbytes)
+    sources = [_source(i) for i in (1, 2, 3)]
+    cache.put(*sources[0], output)
+    cache.put(*sources[1], output)
+    assert cache.get(*sources[0]) is output
+    cache.put(*sources[2], output)
+    assert cache.get(*sources[1]) is None
+    assert cache.get(*sources[0]) is output
+    assert cache.get(*sources[2]) is output
+    cache.put(*_source(4), np.ones((1, 4, 32), np.float32))
+    assert cache.get(*_source(4)) is None
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["num_entries"] == 2
+    assert stats["num_bytes"] == 2 * output.nbytes
+
+
+def test_build_encoder_cache():
+    """
+    Feature: Build the encoder output cache from the configs
+    Description: Build with and without the encoder_cache_bytes
+    Expectation: The cache is only built when the encoder_cache_bytes is set
+    """
+    assert build_encoder_cache(SimpleNamespace()) is None
+    assert build_encoder_cache(SimpleNamespace(encoder_cache_bytes=0)) is None
+    assert build_encoder_cache(SimpleNamespace(encoder_cache_bytes=1024)).max_bytes == 1024
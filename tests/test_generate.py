@@ -0,0 +1,193 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+Test module for testing the text generation utils
+How to run this:
+pytest tests/test_generate.py
+"""
+
+import logging
+from types import SimpleNamespace
+
+import numpy as np
+from mindspore.common.tensor import Tensor
+
+from transformer.generate import topk_fun, sampler, batch_sampler, pad_batch_inputs, apply_penalty, \
+    sampling_distribution, SparsePenalty, sample_outputs, generate_batch
+from transformer.modules.sampling import is_greedy
+from transformer.tokenization.tokenization import IncrementalDetokenizer, convert_tokens_to_string
+
+
+def _reference_topk(logits, topk):
+    """The full sort used by the sampler before"""
+    sorted_array = sorted(enumerate(logits[0].tolist()), key=lambda x: x[1], reverse=True)[:topk]
+    index, value = zip(*sorted_array)
+    return np.array([value]), np.array([index])
+
+
+def test_topk_fun_matches_full_sort():
+    """
+    Feature: The topk used by the sampler
+    Description: Compare the partial sort with the full sort on inputs with many ties
+    Expectation: The values and the indices are the same.
+    """
+    np.random.seed(0)
+    logits = np.round(np.random.randn(1, 1000).astype(np.float32) * 3)
+    for topk in (1, 5, 100, 1000, 5000):
+        value, index = topk_fun(logits, topk)
+        ref_value, ref_index = _reference_topk(logits, topk)
+        assert np.array_equal(value, ref_value)
+        assert np.array_equal(index, ref_index)
+
+
+def test_batch_sampler():
+    """
+    Feature: The batched sampler
+    Description: Run the batched top_p and top_k sampling on a batch of the same rows
+    Expectation: Each row gives the same result as the single row sampler.
+    """
+    np.random.seed(0)
+    log_probs = np.log(np.random.dirichlet(np.ones(200), size=1)).astype(np.float32)
+    batch = np.repeat(log_probs, 3, axis=0)
+    for top_p, top_k_num in ((0.9, 1), (1.0, 4)):
+        p, p_args = sampler(log_probs, top_p, top_k_num)
+        assert np.isclose(np.sum(p), 1.0)
+        for row_p, row_args in batch_sampler(batch, top_p, top_k_num):
+            assert np.array_equal(row_p, p)
+            assert np.array_equal(row_args, p_args)
+
+
+def test_pad_batch_inputs():
+    """
+    Feature: The batch inputs of the generation
+    Description: Pad the prompts given in a list and in a left padded array
+    Expectation: Both give the same right padded ids and valid length.
+    """
+    prompts = [[5, 6, 7], [8], [9, 10, 11, 12]]
+    left_padded = np.array([[0, 5, 6, 7], [0, 0, 0, 8], [9, 10, 11, 12]])
+    expect_ids = np.array([[5, 6, 7, 0, 0, 0], [8, 0, 0, 0, 0, 0], [9, 10, 11, 12, 0, 0]])
+    for inputs, padding_side in ((prompts, 'right'), (left_padded, 'left')):
+        input_ids, valid_length = pad_batch_inputs(inputs, 6, padding_side=padding_side)
+        assert np.array_equal(input_ids, expect_ids)
+        assert np.array_equal(valid_length, [3, 1, 4])
+
+
+def test_incremental_detokenizer():
+    """
+    Feature: Test the incremental detokenizer.
+    Description: Join the fragments of the tokens one by one
+    Expectation: The text is the same as converting all the tokens together
+    """
+    tokens = ['Hello', 'Ġworld', '!', 'ĠĠ', 'Ġ', 'ab', 'ĠĠc', '', 'Ġd']
+    vocab = dict(enumerate(tokens))
+    for prefix_len in range(len(tokens)):
+        detokenizer = IncrementalDetokenizer(vocab, list(range(prefix_len)))
+        fragments = [detokenizer.add(i) for i in range(prefix_len, len(tokens))]
+        assert convert_tokens_to_string(tokens[:prefix_len]) + "".join(fragments) == convert_tokens_to_string(tokens)
+
+
+def test_sampling_distribution():
+    """
+    Feature: Test the dense sampling distribution used by the speculative decoding.
+    Description: Compare the distribution with the candidates of the batch sampler
+    Expectation: The candidates and their probabilities are the same, and the other tokens have zero probability
+    """
+    np.random.seed(0)
+    probs = np.random.dirichlet(np.ones(50), size=3)
+    frequency_list = np.random.randint(0, 3, size=(3, 50))
+    config = SimpleNamespace(frequency_penalty=0.5, presence_penalty=0.2, top_p=0.9, top_k_num=5, temperature=0.7)
+    dist = sampling_distribution(probs, frequency_list, config)
+    revised = apply_penalty(probs, frequency_list, config.frequency_penalty, config.presence_penalty)
+    for row, (p, p_args) in enumerate(batch_sampler(revised, config.top_p, config.top_k_num, config.temperature)):
+        assert np.allclose(dist[row, p_args], p)
+        assert np.count_nonzero(dist[row]) == len(p_args)
+        assert np.isclose(dist[row].sum(), 1.0)
+
+
+def test_sparse_penalty():
+    """
+    Feature: Test the sparse bookkeeping of the penalties.
+    Description: Compare the revised scores with the dense frequency list, and check the repetition penalty
+    Expectation: The scores are the same as apply_penalty, and the repetition penalty covers the prompt
+    """
+    np.random.seed(0)
+    probs = np.random.rand(3, 20).astype(np.float32)
+    frequency_list = np.zeros((3, 20), np.int32)
+    penalty = SparsePenalty(3, 20, frequency_penalty=1.5, presence_penalty=0.3)
+    for row, token in [(0, 3), (0, 3), (2, 5), (2, 7), (0, 11)]:
+        penalty.add(row, token)
+        frequency_list[row, token] += 1
+    assert np.array_equal(penalty.dense(), frequency_list)
+    assert np.array_equal(penalty.apply(probs), apply_penalty(probs, frequency_list, 1.5, 0.3))
+    rows = np.array([2, 0])
+    assert np.array_equal(penalty.apply(probs[rows], rows), apply_penalty(probs[rows], frequency_list[rows], 1.5, 0.3))
+
+    penalty = SparsePenalty(2, 20, repetition_penalty=2.0)
+    penalty.add_prompt(0, [1, 2])
+    penalty.add(1, 4)
+    scores = np.linspace(-1, 1, 40).reshape(2, 20)
+    revised = penalty.apply(scores)
+    expected = scores.copy()
+    expected[0, [1, 2]] *= 2.0
+    expected[1, 4] /= 2.0
+    assert np.allclose(revised, expected)
+
+
+class StubT5Model:
+    """The encoder output is the source, and the decoder prefers the tokens 3, 4 and 1 in order"""
+    def __init__(self):
+        self.predict_network = SimpleNamespace(use_past=False)
+
+    @staticmethod
+    def predict(*inputs):
+        if len(inputs) == 2:
+            return inputs[0]
+        log_probs = np.full((inputs[4].shape[0], 8), -5.0, np.float32)
+        log_probs[:, [3, 4, 1]] = [-0.1, -0.5, -1.0]
+        return Tensor(log_probs)
+
+
+def test_generate_t5_repetition_penalty():
+    """
+    Feature: The repetition penalty of the T5 generation with the cached encoder
+    Description: Generate from the sources with and without the most likely token
+    Expectation: The penalty covers the tokens of the source, not only the [START] token of the decoder
+    """
+    for repetition_penalty, expected in ((1.0, [3, 3]), (10.0, [4, 3])):
+        config = SimpleNamespace(frequency_penalty=0.0, presence_penalty=0.0, repetition_penalty=repetition_penalty,
+                                 top_p=1.0, top_k_num=1, greedy=True, model={'max_decode_length': 3},
+                                 logger=logging.getLogger(__name__))
+        outputs = generate_batch(StubT5Model(), 1, [[3, 5], [6]], 4, 3, 8, cache_encoder=True, config=config)
+        assert [ids.tolist() for ids in outputs] == [[0, token] for token in expected]
+
+
+def test_sample_outputs_greedy():
+    """
+    Feature: The greedy decoding
+    Description: Select the tokens from the probabilities with penalties, and from the ids of the ArgmaxSampler
+    Expectation: The tokens are the argmax of the revised scores, and the ids are returned as they are
+    """
+    config = SimpleNamespace(frequency_penalty=0.5, presence_penalty=0.1, top_p=0.9, top_k_num=5, temperature=0.7,
+                             greedy=True)
+    probs = np.array([[0.1, 0.5, 0.4], [0.6, 0.3, 0.1]], np.float32)
+    penalty = SparsePenalty(2, 3, config.frequency_penalty, config.presence_penalty)
+    penalty.add(0, 1)
+    assert is_greedy(config)
+    assert sample_outputs(Tensor(probs), np.array([0, 1]), penalty, config).tolist() == [2, 0]
+    assert sample_outputs(Tensor(probs), np.array([1]), penalty, config).tolist() == [0]
+    ids = Tensor(np.array([2, 1], np.int32))
+    assert sample_outputs(ids, np.array([1]), penalty, config).tolist() == [1]
+    assert is_greedy(SimpleNamespace(top_p=1.0, top_k_num=1))
+    assert not is_greedy(SimpleNamespace(top_p=0.9, top_k_num=1))
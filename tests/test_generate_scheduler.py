@@ -0,0 +1,135 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+Test module for testing the continuous batching scheduler
+How to run this:
+pytest tests/test_generate_scheduler.py
+"""
+
+import logging
+from types import SimpleNamespace
+
+import numpy as np
+from mindspore.common.tensor import Tensor
+
+from transformer.generate import generate_batch
+from transformer.generate_scheduler import ContinuousBatchScheduler
+
+VOCAB_SIZE = 11
+SEQ_LENGTH = 12
+END_TOKEN = 0
+
+
+class StubNetwork:
+    """The flags of the eval net"""
+    def __init__(self, use_past):
+        self.use_past = use_past
+        self.is_first_iteration = True
+
+    def add_flags_recursive(self, **flags):
+        for key, value in flags.items():
+            setattr(self, key, value)
+
+
+class StubModel:
+    """
+    A model whose next token only depends on the tokens of its row so far. With use_past, the tokens of the rows
+    are kept like the key/value cache, which the prefill graph rebuilds and the decode graph appends to.
+    """
+    def __init__(self, use_past=False):
+        self.predict_network = StubNetwork(use_past)
+        self.past_ids = None
+        self.num_calls = 0
+
+    @staticmethod
+    def _log_probs(rows):
+        log_probs = np.full((len(rows), VOCAB_SIZE), -10.0, np.float32)
+        for i, row in enumerate(rows):
+            log_probs[i, (int(np.sum(row)) * 7 + len(row)) % VOCAB_SIZE] = 0.0
+        return Tensor(log_probs)
+
+    def predict(self, input_ids, input_mask, current_index, *inputs):
+        self.num_calls += 1
+        input_ids = input_ids.asnumpy()
+        if not self.predict_network.use_past:
+            seq_length = input_ids.shape[1]
+            positions = current_index.asnumpy() - np.arange(input_ids.shape[0]) * seq_length
+            return self._log_probs([row[:position + 1] for row, position in zip(input_ids, positions)])
+        assert np.all(input_mask.asnumpy().sum(axis=1) > 0)
+        valid_length = inputs[1].asnumpy()
+        if self.predict_network.is_first_iteration:
+            self.past_ids = input_ids.copy()
+            return self._log_probs([row[:length] for row, length in zip(self.past_ids, valid_length)])
+        self.past_ids[np.arange(input_ids.shape[0]), valid_length] = input_ids[:, 0]
+        return self._log_probs([row[:position + 1] for row, position in zip(self.past_ids, valid_length)])
+
+
+def _config():
+    """The greedy decoding configs"""
+    return SimpleNamespace(frequency_penalty=0.0, presence_penalty=0.0, repetition_penalty=1.0, top_p=1.0,
+                           top_k_num=1, greedy=True, logger=logging.getLogger(__name__))
+
+
+PROMPTS = [[3], [4, 5, 6], [7, 1], [2, 2, 2, 2, 9], [8], [5, 10, 1, 1]]
+
+
+def test_scheduler_matches_generate_batch():
+    """
+    Feature: The outputs of the ContinuousBatchScheduler
+    Description: Generate the prompts through 2 slots with and without the key/value cache
+    Expectation: The output of each prompt is the same as the output of generate_batch over all the prompts, and
+        a prefill runs each time new prompts are admitted with the key/value cache
+    """
+    for use_past in (False, True):
+        expected = generate_batch(StubModel(use_past), END_TOKEN, PROMPTS, SEQ_LENGTH, SEQ_LENGTH, VOCAB_SIZE,
+                                  config=_config())
+        scheduler = ContinuousBatchScheduler(StubModel(use_past), 2, SEQ_LENGTH, VOCAB_SIZE, END_TOKEN, _config())
+        for prompt in PROMPTS:
+            scheduler.add_request(prompt)
+        outputs = scheduler.run()
+        assert [ids.tolist() for ids in outputs] == [ids.tolist() for ids in expected]
+        stats = scheduler.stats()
+        assert stats["num_finished"] == len(PROMPTS)
+        assert stats["queue_depth"] == 0
+        assert stats["num_steps"] == scheduler.model.num_calls
+        if use_past:
+            assert 3 <= stats["num_prefills"] < stats["num_steps"]
+        else:
+            assert stats["num_prefills"] == 0
+
+
+def test_scheduler_refills_free_slot():
+    """
+    Feature: The admission of the ContinuousBatchScheduler
+    Description: Run the steps of two slots with a short request, a long request and a queued request
+    Expectation: The queued request takes the slot of the short request as soon as it finishes, while the long
+        request keeps running in its slot
+    """
+    scheduler = ContinuousBatchScheduler(StubModel(use_past=True), 2, SEQ_LENGTH, VOCAB_SIZE, END_TOKEN, _config())
+    short = scheduler.add_request([4, 5, 6], max_generate_length=1)
+    long = scheduler.add_request([9], max_generate_length=5)
+    queued = scheduler.add_request([8], max_generate_length=2)
+    assert [request.request_id for request in scheduler.step()] == [short]
+    assert scheduler.slots[0] is None
+    assert scheduler.slot_occupancy == 0.5
+    assert scheduler.queue_depth == 1
+    scheduler.step()
+    assert scheduler.slots[0].request_id == queued
+    assert scheduler.slots[1].request_id == long
+    assert scheduler.queue_depth == 0
+    assert scheduler.stats()["num_prefills"] == 2
+    scheduler.run()
+    assert [request.request_id for request in scheduler.finished] == [short, queued, long]
+    assert scheduler.stats()["num_prefills"] == 2
@@ -0,0 +1,201 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+Test module for testing the sequence length buckets
+How to run this:
+pytest tests/test_length_bucket.py
+"""
+
+import logging
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from mindspore import nn, Parameter
+from mindspore.common.tensor import Tensor
+import mindspore.common.dtype as mstype
+
+from transformer import length_bucket
+from transformer.generate import generate_batch
+from transformer.length_bucket import LengthBucketedModel, build_length_bucketed_model, share_parameters
+
+VOCAB_SIZE = 11
+SEQ_LENGTH = 12
+END_TOKEN = 0
+
+
+class StubNetwork:
+    """
+    An eval net of a sequence length whose next token only depends on the tokens of its row so far. With use_past,
+    the tokens of the rows are kept like the key/value cache, which the prefill graph rebuilds and the decode graph
+    appends to. Each call records the length of the network and whether it ran the prefill graph.
+    """
+    def __init__(self, seq_length, use_past, calls):
+        self.seq_length = seq_length
+        self.use_past = use_past
+        self.is_first_iteration = True
+        self.past_ids = None
+        self.calls = calls
+
+    def add_flags_recursive(self, **flags):
+        for key, value in flags.items():
+            setattr(self, key, value)
+
+    def cells_and_names(self):
+        return []
+
+    def parameters_and_names(self):
+        return []
+
+    def set_train(self, mode):
+        return self
+
+    @staticmethod
+    def _log_probs(rows):
+        log_probs = np.full((len(rows), VOCAB_SIZE), -10.0, np.float32)
+        for i, row in enumerate(rows):
+            log_probs[i, (int(np.sum(row)) * 7 + len(row)) % VOCAB_SIZE] = 0.0
+        return Tensor(log_probs)
+
+    def __call__(self, input_ids, input_mask, current_index, *inputs):
+        input_ids = input_ids.asnumpy()
+        prefill = not self.use_past or self.is_first_iteration
+        self.calls.append((self.seq_length, prefill))
+        if prefill:
+            assert input_ids.shape[1] == self.seq_length
+        if not self.use_past:
+            positions = current_index.asnumpy() - np.arange(input_ids.shape[0]) * self.seq_length
+            return self._log_probs([row[:position + 1] for row, position in zip(input_ids, positions)])
+        valid_length = inputs[1].asnumpy()
+        if prefill:
+            self.past_ids = input_ids.copy()
+            return self._log_probs([row[:length] for row, length in zip(self.past_ids, valid_length)])
+        self.past_ids[np.arange(input_ids.shape[0]), valid_length] = input_ids[:, 0]
+        return self._log_probs([row[:position + 1] for row, position in zip(self.past_ids, valid_length)])
+
+
+class StubModel:
+    """The Model wrapping the stub network"""
+    def __init__(self, network):
+        self.predict_network = network
+
+    def predict(self, *inputs):
+        return self.predict_network(*inputs)
+
+
+@pytest.fixture(name="stub_model")
+def fixture_stub_model(monkeypatch):
+    """Wrap the networks of the buckets with the StubModel"""
+    monkeypatch.setattr(length_bucket, "Model", StubModel)
+
+
+def _config():
+    """The greedy decoding configs"""
+    return SimpleNamespace(frequency_penalty=0.0, presence_penalty=0.0, repetition_penalty=1.0, top_p=1.0,
+                           top_k_num=1, greedy=True, logger=logging.getLogger(__name__))
+
+
+def test_bucket_for_and_select(stub_model):  # pylint: disable=unused-argument
+    """
+    Feature: Select the sequence length bucket of the inputs
+    Description: Find the buckets of several lengths, and select them in turn
+    Expectation: The smallest bucket which fits the length is selected, and the eval net of each bucket is built
+        once when it is selected for the first time
+    """
+    built = []
+
+    def build_network(seq_length):
+        built.append(seq_length)
+        return StubNetwork(seq_length, False, [])
+
+    model = LengthBucketedModel(StubNetwork(SEQ_LENGTH, False, []), build_network, [8, 4, "4", 0, 16], SEQ_LENGTH)
+    assert model.bucket_list == [4, 8, SEQ_LENGTH]
+    assert model.bucket == SEQ_LENGTH
+    assert [model.bucket_for(length) for length in (1, 4, 5, 8, 9, SEQ_LENGTH)] == [4, 4, 8, 8, 12, 12]
+    with pytest.raises(ValueError):
+        model.bucket_for(SEQ_LENGTH + 1)
+    assert not built
+    for length in (3, 6, 2, 12, 7):
+        assert model.select(length) == model.bucket_for(length)
+        assert model.predict_network.seq_length == model.bucket
+    assert built == [4, 8]
+
+
+def test_build_length_bucketed_model(stub_model):  # pylint: disable=unused-argument
+    """
+    Feature: Build the bucketed model from the configs
+    Description: Build with the bucket list of the command line, of the YAML file and without it
+    Expectation: The LengthBucketedModel is only built with a bucket list
+    """
+    network = StubNetwork(SEQ_LENGTH, False, [])
+    model = build_length_bucketed_model(SimpleNamespace(bucket_list="4, 8,"), network, None, SEQ_LENGTH)
+    assert model.bucket_list == [4, 8, SEQ_LENGTH]
+    model = build_length_bucketed_model(SimpleNamespace(bucket_list=[6]), network, None, SEQ_LENGTH)
+    assert model.bucket_list == [6, SEQ_LENGTH]
+    for opt in (SimpleNamespace(bucket_list=""), SimpleNamespace()):
+        model = build_length_bucketed_model(opt, network, None, SEQ_LENGTH)
+        assert isinstance(model, StubModel)
+
+
+def test_bucket_growth_during_decoding(stub_model):  # pylint: disable=unused-argument
+    """
+    Feature: Generate with the length buckets
+    Description: Generate the prompts whose outputs outgrow the buckets, with and without the key/value cache
+    Expectation: The outputs are the same as the model of the full sequence length, the next bucket is selected as
+        soon as the longest row outgrows the bucket, and with use_past the new bucket starts with a prefill
+    """
+    prompts = [[4, 5, 6], [9]]
+    for use_past in (False, True):
+        expected = generate_batch(StubModel(StubNetwork(SEQ_LENGTH, use_past, [])), END_TOKEN, prompts, SEQ_LENGTH,
+                                  SEQ_LENGTH, VOCAB_SIZE, config=_config())
+        calls = []
+        model = LengthBucketedModel(StubNetwork(SEQ_LENGTH, use_past, calls),
+                                    lambda seq_length, past=use_past: StubNetwork(seq_length, past, calls),
+                                    [4, 8], SEQ_LENGTH)
+        outputs = generate_batch(model, END_TOKEN, prompts, SEQ_LENGTH, SEQ_LENGTH, VOCAB_SIZE, config=_config())
+        assert [ids.tolist() for ids in outputs] == [ids.tolist() for ids in expected]
+        max_length = max(len(ids) for ids in outputs)
+        assert max_length > 8
+        buckets = [bucket for bucket, _ in calls]
+        # Each step runs the smallest bucket which fits the longest row, from the 3 tokens of the prompt to the
+        # whole output, whose last sampled token is not appended
+        assert buckets == [model.bucket_for(length) for length in range(3, max_length + 1)]
+        prefills = [bucket for bucket, prefill in calls if prefill]
+        assert prefills == (buckets if not use_past else [4, 8, 12])
+        assert model.stats()["num_compiles"] == (3 if not use_past else 6)
+
+
+def test_share_parameters():
+    """
+    Feature: Share the weights of the eval net of the full sequence length with the bucket
+    Description: Share the parameters between two networks whose position embedding depends on the length
+    Expectation: The same shapes are shared, the position embedding takes the leading rows, and the key/value
+        cache is kept
+    """
+    class Net(nn.Cell):
+        """A network with the weights, the position embedding and the cache of a sequence length"""
+        def __init__(self, seq_length, value):
+            super().__init__()
+            self.weight = Parameter(Tensor(np.full((2, 3), value), mstype.float32), name="weight")
+            self.position = Parameter(Tensor(np.arange(seq_length * 3).reshape(seq_length, 3) * value,
+                                             mstype.float32), name="position")
+            self.key_past = Parameter(Tensor(np.full((seq_length, 3), value), mstype.float32), name="key_past")
+
+    source = Net(8, 1.0)
+    network = Net(4, 2.0)
+    share_parameters(network, source)
+    assert network.weight is source.weight
+    assert np.array_equal(network.position.asnumpy(), source.position.asnumpy()[:4])
+    assert np.array_equal(network.key_past.asnumpy(), np.full((4, 3), 2.0))
@@ -0,0 +1,173 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+Test module for testing the prediction utils
+How to run this:
+pytest tests/test_predict.py
+"""
+
+import json
+import logging
+import math
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from mindspore.common.tensor import Tensor
+
+from transformer.modules.scoring import TokenLogProbs
+from transformer.predict import _sliding_windows, get_perplexity, generate_file
+
+VOCAB_SIZE = 7
+
+
+def _log_softmax(logits):
+    logits = logits - np.max(logits, axis=-1, keepdims=True)
+    return logits - np.log(np.sum(np.exp(logits), axis=-1, keepdims=True))
+
+
+class BigramScoreModel:
+    """A model whose logits of each position only depend on the input token of the position"""
+    def __init__(self):
+        self.weights = np.random.default_rng(0).standard_normal((VOCAB_SIZE, VOCAB_SIZE)).astype(np.float32)
+        self.token_log_probs = TokenLogProbs()
+
+    def predict(self, input_ids, input_mask, *inputs):
+        logits = self.weights[input_ids.asnumpy()].reshape(-1, VOCAB_SIZE)
+        return self.token_log_probs(Tensor(logits), inputs[-2], inputs[-1])
+
+    def log_prob(self, tokens):
+        """The log probability of the tokens after the first one"""
+        log_probs = _log_softmax(self.weights[tokens[:-1]])
+        return float(np.sum(log_probs[np.arange(len(tokens) - 1), tokens[1:]]))
+
+
+def test_sliding_windows_coverage():
+    """
+    Feature: The sliding windows of the perplexity
+    Description: Split the documents of several lengths with several strides and sequence lengths
+    Expectation: Every token after the first one is scored exactly once, each window has at most seq_length inputs
+        and each label is the next token of its input
+    """
+    for seq_length, stride in ((4, 4), (4, 1), (4, 3), (5, 2), (8, 3), (1, 1)):
+        for length in range(0, 20):
+            tokens = np.arange(100, 100 + length)
+            scored = []
+            for input_ids, label_ids, first in _sliding_windows(tokens, seq_length, stride):
+                assert 0 < len(input_ids) <= seq_length
+                assert np.array_equal(label_ids, input_ids + 1)
+                assert 0 <= first < len(label_ids)
+                scored.extend(label_ids[first:].tolist())
+            assert scored == tokens[1:].tolist(), (seq_length, stride, length)
+
+
+def test_get_perplexity():
+    """
+    Feature: The perplexity of the documents
+    Description: Calculate the perplexity of the documents with a bigram model and different strides
+    Expectation: The loss and the number of the tokens are the same as the log probability of the whole documents
+    """
+    model = BigramScoreModel()
+    rng = np.random.default_rng(1)
+    documents = [rng.integers(0, VOCAB_SIZE, length).tolist() for length in (1, 2, 9, 17, 30)]
+    num_tokens = sum(len(document) - 1 for document in documents)
+    loss = -sum(model.log_prob(np.array(document)) for document in documents) / num_tokens
+    for stride in (8, 5, 1):
+        outputs = get_perplexity(model, documents, seq_length=8, stride=stride, batch_size=3)
+        assert outputs["num_tokens"] == num_tokens
+        assert math.isclose(outputs["loss"], loss, rel_tol=1e-5)
+        assert math.isclose(outputs["perplexity"], math.exp(loss), rel_tol=1e-5)
+    with pytest.raises(ValueError):
+        get_perplexity(model, documents, seq_length=8, stride=9, batch_size=3)
+    with pytest.raises(ValueError):
+        get_perplexity(model, [[1]], seq_length=8, stride=8, batch_size=3)
+
+
+class StubGenerateModel:
+    """A model whose next token only depends on the tokens of its row so far"""
+    def __init__(self):
+        self.predict_network = SimpleNamespace(use_past=False)
+        self.batch_sizes = []
+
+    def predict(self, input_ids, input_mask, current_index):
+        input_ids = input_ids.asnumpy()
+        self.batch_sizes.append(input_ids.shape[0])
+        positions = current_index.asnumpy() - np.arange(input_ids.shape[0]) * input_ids.shape[1]
+        log_probs = np.full((input_ids.shape[0], 11), -10.0, np.float32)
+        for i, (row, position) in enumerate(zip(input_ids, positions)):
+            log_probs[i, (int(np.sum(row[:position + 1])) * 7 + position + 1) % 11] = 0.0
+        return Tensor(log_probs)
+
+
+def test_generate_file_stats(tmp_path):
+    """
+    Feature: The bulk generation of the prompts in a file
+    Description: Generate the JSONL prompts of different lengths in chunks, with the length sorted batches and with
+        the continuous batching
+    Expectation: The outputs keep the order and the fields of the inputs, the stats count all the prompts and the
+        generated tokens, and the padding waste is the ratio of the padding tokens in the sorted batches
+    """
+    vocab_path = tmp_path / "vocab.json"
+    vocab_path.write_text(json.dumps({token: i for i, token in enumerate("zabcdefghij")}))
+    input_file = tmp_path / "prompts.jsonl"
+    prompts = ["a b c", "d", "e f", "g h i a b"]
+    input_file.write_text("".join(json.dumps({"id": i, "prompt": prompt}) + "\n\n" for i, prompt in enumerate(prompts)))
+    outputs = {}
+    for continuous in (False, True):
+        model = StubGenerateModel()
+        opt = SimpleNamespace(arch="gpt", model={"seq_length": 12, "vocab_size": 11}, vocab_path=str(vocab_path),
+                              end_token=0, frequency_penalty=0.0, presence_penalty=0.0, top_p=1.0, top_k_num=1,
+                              greedy=True, continuous_batching=continuous, logger=logging.getLogger(__name__))
+        output_file = tmp_path / f"outputs_{continuous}.jsonl"
+        stats = generate_file(str(input_file), str(output_file), model, opt, batch_size=2, chunk_size=3)
+        lines = [json.loads(line) for line in output_file.read_text().splitlines()]
+        assert [(line["id"], line["prompt"]) for line in lines] == list(enumerate(prompts))
+        outputs[continuous] = [line["output"] for line in lines]
+        assert set(model.batch_sizes) == {2}
+        assert stats["num_prompts"] == len(prompts)
+        assert stats["num_tokens"] == sum(len(output.split()) for output in outputs[continuous])
+        assert stats["num_tokens"] > 0
+        assert stats["prompts_per_second"] > 0
+        assert stats["tokens_per_second"] == pytest.approx(
+            stats["prompts_per_second"] * stats["num_tokens"] / stats["num_prompts"])
+        assert 0 <= stats["latency_p50"] <= stats["latency_p99"]
+        if continuous:
+            assert stats["padding_waste"] == 0.0
+        else:
+            # The chunk of the lengths [3, 1, 2] runs the batches [1, 2] and [3, 3], whose padding row copies the
+            # first prompt of the batch, and the next chunk runs the batch [5, 5], 1 padding in 4 + 6 + 10 positions
+            assert stats["padding_waste"] == pytest.approx(1 / 20)
+    assert outputs[False] == outputs[True]
+
+
+def test_generate_file_invalid_line(tmp_path):
+    """
+    Feature: The validation of the prompts in the input file of the bulk generation
+    Description: Generate the JSONL files with a line without the prompt, a line with a number prompt and a line
+        which is not JSON after the blank lines and a full chunk
+    Expectation: ValueError names the number of the invalid line in the file
+    """
+    vocab_path = tmp_path / "vocab.json"
+    vocab_path.write_text(json.dumps({token: i for i, token in enumerate("zabcdefghij")}))
+    opt = SimpleNamespace(arch="gpt", model={"seq_length": 12, "vocab_size": 11}, vocab_path=str(vocab_path),
+                          end_token=0, frequency_penalty=0.0, presence_penalty=0.0, top_p=1.0, top_k_num=1,
+                          greedy=True, logger=logging.getLogger(__name__))
+    valid = json.dumps({"prompt": "a b"}) + "\n\n"
+    for invalid in ('{"id": 3}', '{"text": 3}', '["a"]', '{"prompt": '):
+        input_file = tmp_path / "prompts.jsonl"
+        input_file.write_text(valid * 3 + invalid + "\n")
+        with pytest.raises(ValueError, match="line 7 "):
+            generate_file(str(input_file), str(tmp_path / "outputs.jsonl"), StubGenerateModel(), opt, batch_size=2,
+                          chunk_size=2)
@@ -0,0 +1,169 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+Test module for testing the shared-prefix key/value cache
+How to run this:
+pytest tests/test_prefix_cache.py
+"""
+
+import numpy as np
+from mindspore import nn, Parameter, Tensor
+import mindspore.common.dtype as mstype
+
+from transformer.prefix_cache import PrefixBlock, PrefixKVCache, get_past_parameters
+
+BATCH_SIZE = 2
+NUM_HEADS = 1
+SIZE_PER_HEAD = 3
+SEQ_LENGTH = 8
+
+
+class PastLayer(nn.Cell):
+    """A layer with the key/value cache of the MindSpore Transformer"""
+    def __init__(self):
+        super().__init__()
+        self.key_past = Parameter(Tensor(np.zeros((BATCH_SIZE, NUM_HEADS, SIZE_PER_HEAD, SEQ_LENGTH)),
+                                         mstype.float32), name="key_past")
+        self.value_past = Parameter(Tensor(np.zeros((BATCH_SIZE, NUM_HEADS, SEQ_LENGTH, SIZE_PER_HEAD)),
+                                           mstype.float32), name="value_past")
+
+
+class PastNet(nn.Cell):
+    """A network of two layers with the key/value cache"""
+    def __init__(self):
+        super().__init__()
+        self.layers = nn.CellList([PastLayer(), PastLayer()])
+
+
+def _past_states(seed):
+    """The distinct random keys and values of each layer"""
+    rng = np.random.default_rng(seed)
+    return [(rng.standard_normal((BATCH_SIZE, NUM_HEADS, SIZE_PER_HEAD, SEQ_LENGTH)).astype(np.float32),
+             rng.standard_normal((BATCH_SIZE, NUM_HEADS, SEQ_LENGTH, SIZE_PER_HEAD)).astype(np.float32))
+            for _ in range(2)]
+
+
+def _set_past(network, past_states):
+    """Write the keys and values into the key/value cache of the network"""
+    for (key_past, value_past), (key, value) in zip(get_past_parameters(network), past_states):
+        key_past.set_data(Tensor(key, mstype.float32))
+        value_past.set_data(Tensor(value, mstype.float32))
+
+
+def _pad(prompts):
+    """The padded prompts and their lengths"""
+    input_ids = np.zeros((len(prompts), SEQ_LENGTH), np.int32)
+    for row, prompt in enumerate(prompts):
+        input_ids[row, :len(prompt)] = prompt
+    return input_ids, np.array([len(prompt) for prompt in prompts], np.int32)
+
+
+def _block_keys(cache, prompt):
+    """The keys of the full blocks of the prompt"""
+    return [key for key, _, _ in cache._split_blocks(np.array(prompt), len(prompt))]  # pylint: disable=protected-access
+
+
+def test_prefix_cache_store_load():
+    """
+    Feature: Store the key/value cache of the prompts and load it for the prompts with the same prefix
+    Description: Store two prompts, then load two longer prompts which extend them into a cleared network
+    Expectation: The keys and values of the cached prefix of each row are restored and the rest is zero
+    """
+    network = PastNet()
+    past_states = _past_states(0)
+    _set_past(network, past_states)
+    cache = PrefixKVCache(max_bytes=1 << 20, block_size=2)
+    cache.store(network, *_pad([[1, 2, 3, 4, 5], [1, 2, 3, 9, 9, 9]]))
+    assert cache.stats()["num_blocks"] == 4
+
+    _set_past(network, [(np.zeros_like(key), np.zeros_like(value)) for key, value in past_states])
+    prefix_length = cache.load(network, *_pad([[1, 2, 3, 4, 7, 7], [1, 2, 3, 9, 9, 9, 5]]))
+    assert prefix_length.tolist() == [4, 6]
+    # The row of the stored prompt of each position, the first block of the second row was stored from the first row
+    sources = [[0, 0, 0, 0], [0, 0, 1, 1, 1, 1]]
+    for (key_past, value_past), (key, value) in zip(get_past_parameters(network), past_states):
+        for row, source in enumerate(sources):
+            expected_key = np.zeros_like(key[row])
+            expected_value = np.zeros_like(value[row])
+            for position, source_row in enumerate(source):
+                expected_key[..., position] = key[source_row, ..., position]
+                expected_value[..., position, :] = value[source_row, ..., position, :]
+            assert np.array_equal(key_past.asnumpy()[row], expected_key)
+            assert np.array_equal(value_past.asnumpy()[row], expected_value)
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["hit_tokens"] == 10
+
+
+def test_prefix_cache_partial_prefix():
+    """
+    Feature: Match the cached blocks of a prompt
+    Description: Look up the prompts sharing a part of the cached prefix, a suffix longer than max_suffix_length
+        and a block whose key collides with another prefix
+    Expectation: Only the leading blocks of the same prefix match, the hits are counted only when the cache is
+        used, and a block of another prefix is never matched
+    """
+    network = PastNet()
+    _set_past(network, _past_states(1))
+    cache = PrefixKVCache(max_bytes=1 << 20, block_size=2, max_suffix_length=3)
+    cache.store(network, *_pad([[1, 2, 3, 4, 5, 6], [7, 8, 9]]))
+    assert [len(cache.match(prompt, len(prompt))) for prompt in
+            (np.array([1, 2, 3, 4, 5, 6, 0]), np.array([1, 2, 3, 5, 5]), np.array([3, 4, 5, 6, 1]),
+             np.array([1, 2]))] == [3, 1, 0, 0]
+
+    # The uncached suffix of the second row is too long for the decode graph
+    assert cache.load(network, *_pad([[1, 2, 3, 4, 5], [1, 2, 0, 0, 0, 0, 0]])) is None
+    assert cache.stats()["hits"] == 0
+    assert cache.stats()["misses"] == 2
+    assert cache.stats()["hit_tokens"] == 0
+    assert cache.load(network, *_pad([[1, 2, 3, 4, 5], [7, 8, 0]])).tolist() == [4, 2]
+    assert cache.stats()["hits"] == 2
+
+    # A block with the key of the prefix [5, 5] but other tokens
+    key, = _block_keys(cache, [5, 5])
+    cache.blocks[key] = PrefixBlock(key, None, (6, 6), _past_states(2))
+    assert not cache.match(np.array([5, 5, 1]), 3)
+    cache.insert(np.array([5, 5, 1, 1]), 4, _past_states(3), 0)
+    assert cache.blocks[key].tokens == (6, 6)
+    assert not cache.match(np.array([5, 5, 1, 1, 1]), 5)
+
+
+def test_prefix_cache_eviction():
+    """
+    Feature: Evict the blocks over the memory budget of the cache
+    Description: Insert the prompts over the budget after the first blocks became the least recently used
+    Expectation: The least recently used leaf blocks are evicted, and every cached block follows its whole prefix
+    """
+    past_states = _past_states(4)
+    cache = PrefixKVCache(max_bytes=1 << 20, block_size=2)
+    cache.insert(np.array([1, 2, 3, 4, 5, 6]), 6, past_states, 0)
+    block_bytes = cache.num_bytes // 3
+    cache.max_bytes = 4 * block_bytes
+    first, second, third = _block_keys(cache, [1, 2, 3, 4, 5, 6])
+    # The inner blocks are the least recently used, so only the leaf block can be evicted
+    cache.blocks.move_to_end(third)
+    cache.insert(np.array([7, 8]), 2, past_states, 1)
+    cache.insert(np.array([1, 2, 9, 9]), 4, past_states, 1)
+    assert cache.stats()["evictions"] == 1
+    assert first in cache.blocks and second in cache.blocks and third not in cache.blocks
+    for block in cache.blocks.values():
+        assert block.parent is None or block.parent in cache.blocks
+        assert block.num_children == sum(child.parent == block.key for child in cache.blocks.values())
+    assert len(cache.match(np.array([1, 2, 3, 4, 5, 6, 0]), 7)) == 2
+    assert len(cache.match(np.array([1, 2, 9, 9, 0]), 5)) == 2
+
+    cache.max_bytes = block_bytes
+    cache.insert(np.array([7, 8]), 2, past_states, 1)
+    assert cache.num_bytes == block_bytes
+    assert list(cache.blocks) == _block_keys(cache, [7, 8])
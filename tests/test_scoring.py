@@ -0,0 +1,164 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+Test module for testing the log-likelihood scoring
+How to run this:
+pytest tests/test_scoring.py
+"""
+
+import io
+import json
+import logging
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from mindspore.common.tensor import Tensor
+
+from transformer.modules.scoring import TokenLogProbs
+from transformer.scoring import score_batch, score_jsonl
+from transformer.tokenization.tokenization import FullTokenizer
+
+VOCAB_SIZE = 7
+SEQ_LENGTH = 8
+MAX_DECODE_LENGTH = 6
+START_TOKEN = 0
+
+
+def _log_softmax(logits):
+    logits = logits - np.max(logits, axis=-1, keepdims=True)
+    return logits - np.log(np.sum(np.exp(logits), axis=-1, keepdims=True))
+
+
+class StubScoreModel:
+    """
+    A bigram model whose logits of each position only depend on the input token of the position, and also on the
+    first source token for the encoder-decoder model. The log probabilities of the labels are gathered by the
+    TokenLogProbs of the eval net.
+    """
+    def __init__(self, encoder_decoder):
+        rng = np.random.default_rng(0)
+        self.encoder_decoder = encoder_decoder
+        self.weights = rng.standard_normal((VOCAB_SIZE, VOCAB_SIZE)).astype(np.float32)
+        self.source_weights = rng.standard_normal((VOCAB_SIZE, VOCAB_SIZE)).astype(np.float32)
+        self.token_log_probs = TokenLogProbs()
+        self.num_calls = 0
+
+    def logits(self, input_ids, source_ids=None):
+        """The logits of each position with shape [bs, seq_length, vocab_size]"""
+        logits = self.weights[input_ids]
+        if source_ids is not None:
+            logits = logits + self.source_weights[source_ids[:, :1]]
+        return logits
+
+    def predict(self, *inputs):
+        self.num_calls += 1
+        if self.encoder_decoder:
+            # source_ids, source_mask, None, None, target_ids, target_mask, None, True, None, label_ids, label_mask
+            assert len(inputs) == 11
+            logits = self.logits(inputs[4].asnumpy(), inputs[0].asnumpy())
+        else:
+            # input_ids, input_mask, None, True, None, None, label_ids, label_mask
+            assert len(inputs) == 8
+            logits = self.logits(inputs[0].asnumpy())
+        return self.token_log_probs(Tensor(logits.reshape(-1, VOCAB_SIZE)), inputs[-2], inputs[-1])
+
+    def reference(self, context, continuation):
+        """The log probability of each continuation token computed apart from the scoring"""
+        if self.encoder_decoder:
+            inputs = [START_TOKEN] + list(continuation[:-1])
+            log_probs = _log_softmax(self.logits(np.array([inputs]), np.array([context[-SEQ_LENGTH:]]))[0])
+        else:
+            inputs = (list(context) + list(continuation))[-(SEQ_LENGTH + 1):-1]
+            log_probs = _log_softmax(self.logits(np.array([inputs]))[0])[-len(continuation):]
+        return log_probs[np.arange(len(continuation)), continuation]
+
+
+PAIRS = [([1, 2, 3], [4]), ([5], [6, 1, 2]), ([2, 2, 2, 2, 2, 2, 2, 2, 2, 3], [1, 4]), ([3, 1], [2, 5, 6, 6])]
+
+
+def test_score_batch():
+    """
+    Feature: The log-likelihood of the continuations given the contexts
+    Description: Score the pairs of different lengths with the decoder-only and the encoder-decoder stub models,
+        in batches with the padding rows
+    Expectation: Only the continuation tokens are scored, and the log_prob is the sum of their log probabilities
+    """
+    for encoder_decoder in (False, True):
+        model = StubScoreModel(encoder_decoder)
+        contexts, continuations = zip(*PAIRS)
+        scores = score_batch(model, contexts, continuations, SEQ_LENGTH, batch_size=3,
+                             max_decode_length=MAX_DECODE_LENGTH if encoder_decoder else None,
+                             start_token=START_TOKEN)
+        assert model.num_calls == 2
+        for (context, continuation), score in zip(PAIRS, scores):
+            expected = model.reference(context, continuation)
+            assert score["num_tokens"] == len(continuation)
+            assert np.allclose(score["token_log_probs"], expected, atol=1e-5)
+            assert np.isclose(score["log_prob"], np.sum(expected), atol=1e-5)
+
+
+def test_token_log_probs_mask():
+    """
+    Feature: The TokenLogProbs of the eval net
+    Description: Gather the log probabilities of the labels with some positions masked
+    Expectation: The masked positions are 0 and excluded from the sum of each row
+    """
+    rng = np.random.default_rng(1)
+    logits = rng.standard_normal((2 * 4, VOCAB_SIZE)).astype(np.float32)
+    label_ids = np.array([[1, 2, 3, 4], [5, 6, 0, 1]], np.int32)
+    label_mask = np.array([[0, 1, 1, 0], [1, 0, 0, 1]], np.float32)
+    token_log_probs, log_probs = TokenLogProbs()(Tensor(logits), Tensor(label_ids), Tensor(label_mask))
+    expected = _log_softmax(logits)[np.arange(8), label_ids.reshape(-1)].reshape(2, 4) * label_mask
+    assert np.allclose(token_log_probs.asnumpy(), expected, atol=1e-5)
+    assert np.allclose(log_probs.asnumpy(), expected.sum(axis=1), atol=1e-5)
+
+
+def test_score_jsonl_dispatch():
+    """
+    Feature: The scoring of the JSONL pairs of each architecture
+    Description: Score the same lines with the GPT, OPT and T5 configs
+    Expectation: GPT and OPT run the inputs of the decoder-only models, T5 runs the inputs of the encoder-decoder
+        models, and each output line keeps its input fields
+    """
+    vocab = {word: i for i, word in enumerate(["[PAD]", "a", "b", "c", "d", "e", "f"])}
+    tokenizer = FullTokenizer(vocab)
+    lines = [{"context": "a b", "continuation": "c", "id": 0}, {"context": "d", "continuation": "e f a", "id": 1}]
+    for arch, encoder_decoder in (("gpt", False), ("opt", False), ("t5", True)):
+        model = StubScoreModel(encoder_decoder)
+        opt = SimpleNamespace(arch=arch, model={"seq_length": SEQ_LENGTH, "max_decode_length": MAX_DECODE_LENGTH},
+                              logger=logging.getLogger(__name__))
+        output_stream = io.StringIO()
+        input_stream = io.StringIO("".join(json.dumps(line) + "\n" for line in lines))
+        assert score_jsonl(model, tokenizer, input_stream, output_stream, opt, batch_size=2) == 2
+        outputs = [json.loads(line) for line in output_stream.getvalue().splitlines()]
+        for line, output in zip(lines, outputs):
+            assert output["id"] == line["id"]
+            context = [vocab[token] for token in line["context"].split()]
+            continuation = [vocab[token] for token in line["continuation"].split()]
+            assert np.isclose(output["log_prob"], np.sum(model.reference(context, continuation)), atol=1e-5)
+
+
+def test_score_jsonl_unknown_token():
+    """
+    Feature: The tokens of the JSONL pairs missing from the vocab
+    Description: Score a continuation with a word which is tokenized to [UNK] by a vocab without the [UNK] token
+    Expectation: ValueError names the unknown token and its text
+    """
+    tokenizer = FullTokenizer({word: i for i, word in enumerate(["[PAD]", "a", "b"])})
+    opt = SimpleNamespace(arch="gpt", model={"seq_length": SEQ_LENGTH}, logger=logging.getLogger(__name__))
+    input_stream = io.StringIO(json.dumps({"context": "a", "continuation": "b xyz"}) + "\n")
+    with pytest.raises(ValueError, match=r"'\[UNK\]' of the text 'b xyz'"):
+        score_jsonl(StubScoreModel(False), tokenizer, input_stream, io.StringIO(), opt, batch_size=2)
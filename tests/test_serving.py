@@ -0,0 +1,256 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+Test module for testing the dynamic batching of the inference server
+How to run this:
+pytest tests/test_serving.py
+"""
+
+import asyncio
+import json
+import logging
+from types import SimpleNamespace
+
+import numpy as np
+from mindspore.common.tensor import Tensor
+
+from transformer import serving
+from transformer.serving import ClassifyHandler, DynamicBatcher, GenerateHandler, InferenceServer
+
+
+class EchoHandler:
+    """Return the upper case prompts, and record the size of each batch"""
+    def __init__(self):
+        self.batch_sizes = []
+
+    @staticmethod
+    def validate(item):
+        """Raise ValueError if the item is not a {"prompt": str} request"""
+        if not isinstance(item, dict) or not isinstance(item.get("prompt"), str):
+            raise ValueError('The request should be a JSON object with the string "prompt"')
+        return item
+
+    def __call__(self, requests):
+        self.batch_sizes.append(len(requests))
+        return [{"output": item["prompt"].upper()} for item in requests]
+
+
+def test_batcher_max_batch_size():
+    """
+    Feature: The batches of the DynamicBatcher
+    Description: Submit more concurrent requests than the max batch size
+    Expectation: The full batches run without waiting, and each request gets its own result
+    """
+    async def run():
+        handler = EchoHandler()
+        batcher = DynamicBatcher(handler, max_batch_size=2, max_wait_ms=10000)
+        batcher.start()
+        try:
+            results = await asyncio.gather(*[batcher.submit({"prompt": f"p{i}"}) for i in range(4)])
+        finally:
+            await batcher.stop()
+        return handler.batch_sizes, results
+
+    batch_sizes, results = asyncio.run(asyncio.wait_for(run(), 5))
+    assert batch_sizes == [2, 2]
+    assert results == [{"output": f"P{i}"} for i in range(4)]
+
+
+def test_batcher_max_wait():
+    """
+    Feature: The batches of the DynamicBatcher
+    Description: Submit two requests together and another one after the wait time
+    Expectation: A batch which is not full runs after the wait time, and the late request runs in the next batch
+    """
+    async def run():
+        handler = EchoHandler()
+        batcher = DynamicBatcher(handler, max_batch_size=8, max_wait_ms=50)
+        batcher.start()
+        try:
+            first = asyncio.gather(batcher.submit({"prompt": "a"}), batcher.submit({"prompt": "b"}))
+            await asyncio.sleep(0.3)
+            late = await batcher.submit({"prompt": "c"})
+            return handler.batch_sizes, await first, late
+        finally:
+            await batcher.stop()
+
+    batch_sizes, first, late = asyncio.run(asyncio.wait_for(run(), 5))
+    assert batch_sizes == [2, 1]
+    assert first == [{"output": "A"}, {"output": "B"}]
+    assert late == {"output": "C"}
+
+
+def test_server_invalid_request():
+    """
+    Feature: The errors of the requests of the InferenceServer
+    Description: Send the requests without the prompt together with the valid requests
+    Expectation: The invalid requests get 400 and are not batched, the valid requests of the same batch succeed,
+        and the metrics count all the requests and the errors
+    """
+    async def run():
+        handler = EchoHandler()
+        server = InferenceServer({"/generate": DynamicBatcher(handler, max_batch_size=4, max_wait_ms=50)})
+        for batcher in server.batchers.values():
+            batcher.start()
+        try:
+            responses = await asyncio.gather(
+                server._dispatch("POST", "/generate", b'{"prompt": "a"}'),  # pylint: disable=protected-access
+                server._dispatch("POST", "/generate", b'{"text": "b"}'),  # pylint: disable=protected-access
+                server._dispatch("POST", "/generate", b'["c"]'),  # pylint: disable=protected-access
+                server._dispatch("POST", "/generate", b'{"prompt": "d"}'))  # pylint: disable=protected-access
+            metrics = await server._dispatch("GET", "/metrics", b"")  # pylint: disable=protected-access
+        finally:
+            for batcher in server.batchers.values():
+                await batcher.stop()
+        return handler.batch_sizes, responses, metrics
+
+    batch_sizes, responses, metrics = asyncio.run(asyncio.wait_for(run(), 5))
+    assert batch_sizes == [2]
+    assert [status for status, _, _ in responses] == [200, 400, 400, 200]
+    assert json.loads(responses[0][2]) == {"output": "A"}
+    assert json.loads(responses[3][2]) == {"output": "D"}
+    assert "prompt" in json.loads(responses[1][2])["error"]
+    assert metrics[0] == 200
+    lines = metrics[2].splitlines()
+    assert 'serving_requests_total{path="/generate"} 4' in lines
+    assert 'serving_errors_total{path="/generate"} 2' in lines
+    assert 'serving_latency_seconds_count{path="/generate"} 2' in lines
+
+
+def test_server_metrics():
+    """
+    Feature: The GET /metrics of the InferenceServer over HTTP
+    Description: Send the requests to two paths, then read the metrics
+    Expectation: The metrics are in the Prometheus text format, each type is declared once, and the batch size
+        histogram and the queue depth of each path are labeled by the path
+    """
+    async def request(port, method, path, body=b""):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        head, payload = response.split(b"\r\n\r\n", 1)
+        return int(head.split(b" ", 2)[1]), payload.decode("utf-8")
+
+    async def run():
+        server = InferenceServer({"/generate": DynamicBatcher(EchoHandler(), max_batch_size=4, max_wait_ms=50),
+                                  "/other": DynamicBatcher(EchoHandler(), max_batch_size=4, max_wait_ms=50)},
+                                 port=0)
+        await server.start()
+        try:
+            await asyncio.gather(*[request(server.port, "POST", "/generate", b'{"prompt": "x"}') for _ in range(3)])
+            await request(server.port, "POST", "/other", b'{"prompt": "y"}')
+            return (await request(server.port, "GET", "/metrics"), await request(server.port, "POST", "/metrics"),
+                    await request(server.port, "GET", "/missing"))
+        finally:
+            await server.stop()
+
+    (status, text), post_metrics, missing = asyncio.run(asyncio.wait_for(run(), 5))
+    assert status == 200
+    assert post_metrics[0] == 405
+    assert missing[0] == 404
+    lines = text.splitlines()
+    assert lines.count("# TYPE serving_batch_size histogram") == 1
+    for path, num_requests in (("/generate", 3), ("/other", 1)):
+        assert f'serving_queue_depth{{path="{path}"}} 0' in lines
+        assert f'serving_requests_total{{path="{path}"}} {num_requests}' in lines
+        assert f'serving_errors_total{{path="{path}"}} 0' in lines
+        assert f'serving_batch_size_bucket{{path="{path}",le="4"}} 1' in lines
+        assert f'serving_batch_size_count{{path="{path}"}} 1' in lines
+        assert f'serving_batch_size_sum{{path="{path}"}} {num_requests}' in lines
+    assert 'serving_batch_size_bucket{path="/generate",le="2"} 0' in lines
+    assert 'serving_batch_size_bucket{path="/other",le="1"} 1' in lines
+
+
+def _dispatch_together(server, path, bodies):
+    """Dispatch the bodies concurrently to the path of the server, and return the responses and the metrics"""
+    async def run():
+        for batcher in server.batchers.values():
+            batcher.start()
+        try:
+            responses = await asyncio.gather(*[server._dispatch("POST", path, body)  # pylint: disable=protected-access
+                                               for body in bodies])
+            metrics = await server._dispatch("GET", "/metrics", b"")  # pylint: disable=protected-access
+        finally:
+            for batcher in server.batchers.values():
+                await batcher.stop()
+        return responses, metrics
+
+    return asyncio.run(asyncio.wait_for(run(), 5))
+
+
+def test_generate_handler_rejects_prompt(tmp_path, monkeypatch):
+    """
+    Feature: The validation of the prompts of the GenerateHandler
+    Description: Send an empty prompt, a prompt longer than the seq_length and a prompt with an unknown token
+        together with the valid prompts
+    Expectation: The invalid prompts get 400 before they are batched, and the valid prompts of the same batch are
+        generated from their ids
+    """
+    vocab_path = tmp_path / "vocab.json"
+    vocab_path.write_text(json.dumps({token: i for i, token in enumerate("zabcdefghij")}))
+    batches = []
+
+    def generate_padded_batch(input_ids, *_):
+        batches.append(input_ids)
+        return [list(reversed(ids)) for ids in input_ids]
+
+    monkeypatch.setattr(serving, "generate_padded_batch", generate_padded_batch)
+    opt = SimpleNamespace(arch="gpt", model={"seq_length": 4}, vocab_path=str(vocab_path),
+                          logger=logging.getLogger(__name__))
+    handler = GenerateHandler(None, opt, batch_size=8)
+    server = InferenceServer({"/generate": DynamicBatcher(handler, max_batch_size=8, max_wait_ms=50)})
+    bodies = [{"prompt": "a b"}, {"prompt": " "}, {"prompt": "a b c d e"}, {"prompt": "a xyz"}, {"prompt": "c"}]
+    responses, metrics = _dispatch_together(server, "/generate", [json.dumps(body).encode() for body in bodies])
+    assert [status for status, _, _ in responses] == [200, 400, 400, 400, 200]
+    assert batches == [[[1, 2], [3]]]
+    assert json.loads(responses[0][2]) == {"output": "b a"}
+    assert json.loads(responses[4][2]) == {"output": "c"}
+    errors = [json.loads(responses[i][2])["error"] for i in (1, 2, 3)]
+    assert "empty" in errors[0]
+    assert "seq_length 4" in errors[1]
+    assert "not in the vocab" in errors[2]
+    assert 'serving_errors_total{path="/generate"} 3' in metrics[2].splitlines()
+
+
+class StubClassifyModel:
+    """The label of each row is the number of its tokens modulo 2"""
+    def predict(self, input_ids, input_mask, token_type_id):
+        num_tokens = input_mask.asnumpy().sum(axis=-1)
+        log_probs = np.full((input_ids.shape[0], 2), -10.0, np.float32)
+        log_probs[np.arange(input_ids.shape[0]), num_tokens % 2] = 0.0
+        assert np.all(token_type_id.asnumpy() <= input_mask.asnumpy())
+        return Tensor(log_probs)
+
+
+def test_classify_handler(tmp_path):
+    """
+    Feature: The /classify requests of the ClassifyHandler
+    Description: Classify a text, a pair of texts and a text with an unknown token in a batch
+    Expectation: The text with the unknown token gets 400, and the others get the label and the log probabilities
+        of the [CLS] text [SEP] text_pair [SEP] tokens
+    """
+    vocab_path = tmp_path / "vocab.json"
+    vocab_path.write_text(json.dumps({token: i for i, token in enumerate(["[PAD]", "[CLS]", "[SEP]", "a", "b"])}))
+    handler = ClassifyHandler(StubClassifyModel(), str(vocab_path), seq_length=6, batch_size=4,
+                              labels=["even", "odd"])
+    server = InferenceServer({"/classify": DynamicBatcher(handler, max_batch_size=4, max_wait_ms=50)})
+    bodies = [{"text": "a"}, {"text": "a b", "text_pair": "b"}, {"text": "a c"}]
+    responses, _ = _dispatch_together(server, "/classify", [json.dumps(body).encode() for body in bodies])
+    assert [status for status, _, _ in responses] == [200, 200, 400]
+    assert json.loads(responses[0][2]) == {"label": "odd", "log_probs": [-10.0, 0.0]}
+    assert json.loads(responses[1][2]) == {"label": "even", "log_probs": [0.0, -10.0]}
+    assert "not in the vocab" in json.loads(responses[2][2])["error"]
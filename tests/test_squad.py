@@ -0,0 +1,81 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+Test module for testing the SQuAD features
+How to run this:
+pytest tests/test_squad.py
+"""
+
+from tasks.nlp.tokenization import FullTokenizer
+from tasks.nlp.question_answering.src.create_squad_data import _improve_answer_span
+
+
+def _doc_tokens(tokenizer, doc_words):
+    """The word pieces of the words of the document, the word of each piece and the offsets of each piece"""
+    all_doc_tokens = []
+    tok_to_orig_index = []
+    all_doc_offsets = []
+    for i, word in enumerate(doc_words):
+        tokens, offsets = tokenizer.tokenize_with_offsets(word)
+        all_doc_tokens.extend(tokens)
+        tok_to_orig_index.extend([i] * len(tokens))
+        all_doc_offsets.extend(offsets)
+    return all_doc_tokens, tok_to_orig_index, all_doc_offsets
+
+
+def test_improve_answer_span():
+    """
+    Feature: The tokens of the answer of a SQuAD example
+    Description: Find the answer whose first occurrence in the span starts inside a word
+    Expectation: The later occurrence which starts and ends with the tokens is taken regardless of the case,
+        and the input span is kept when no occurrence is aligned with the tokens
+    """
+    vocab = {word: i for i, word in enumerate(["[UNK]", "con", "##cat", "##enate", "the", "cat", "."])}
+    tokenizer = FullTokenizer(vocab)
+    doc_words = ["Concatenate", "the", "Cat."]
+    all_doc_tokens, tok_to_orig_index, all_doc_offsets = _doc_tokens(tokenizer, doc_words)
+    assert all_doc_tokens == ["con", "##cat", "##enate", "the", "cat", "."]
+
+    def improve(answer_text):
+        return _improve_answer_span(doc_words, 0, len(all_doc_tokens) - 1, all_doc_tokens, tok_to_orig_index,
+                                    all_doc_offsets, answer_text)
+
+    assert improve("cat") == (4, 4)
+    assert improve("the  Cat.") == (3, 5)
+    assert improve("concatenate") == (0, 2)
+    assert improve("enate") == (0, 5)
+    assert improve("dog") == (0, 5)
+
+
+def test_improve_answer_span_lower_case():
+    """
+    Feature: The tokens of the answer of a SQuAD example with the chars whose lower case is longer
+    Description: Find the answer in a span with 'İ', whose lower case has two chars
+    Expectation: The other chars of the span are still compared regardless of the case, and the tokens after 'İ'
+        are found at their offsets
+    """
+    vocab = {word: i for i, word in enumerate(["[UNK]", "İ", "##stanbul", "the", "cat"])}
+    tokenizer = FullTokenizer(vocab, do_lower_case=False)
+    doc_words = ["İstanbul", "the", "Cat"]
+    all_doc_tokens, tok_to_orig_index, all_doc_offsets = _doc_tokens(tokenizer, doc_words)
+    assert all_doc_tokens == ["İ", "##stanbul", "the", "[UNK]"]
+
+    def improve(answer_text):
+        return _improve_answer_span(doc_words, 0, len(all_doc_tokens) - 1, all_doc_tokens, tok_to_orig_index,
+                                    all_doc_offsets, answer_text)
+
+    assert improve("THE cat") == (2, 3)
+    assert improve("İSTANBUL") == (0, 1)
+    assert improve("the") == (2, 2)
@@ -0,0 +1,48 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+Test module for testing the T5 layers
+How to run this:
+pytest tests/test_t5.py
+"""
+
+import numpy as np
+from mindspore import context
+from mindspore.common.tensor import Tensor
+import mindspore.common.dtype as mstype
+
+from transformer.models.t5.T5Transformer import TransformerEncoderLayer
+
+
+def test_t5_encoder_layer_use_past():
+    """
+    Feature: The T5 encoder layer with the key/value cache
+    Description: Build the encoder layer with use_past=True and run the first iteration on CPU
+    Expectation: The layer runs, and its output has the shape of the input and the key/value cache is filled
+    """
+    context.set_context(mode=context.PYNATIVE_MODE, device_target="CPU")
+    batch_size, seq_length, hidden_size = 2, 4, 8
+    layer = TransformerEncoderLayer(batch_size=batch_size, hidden_size=hidden_size, ffn_hidden_size=16,
+                                    num_heads=2, seq_length=seq_length, attention_dropout_rate=0.0,
+                                    hidden_dropout_rate=0.0, use_past=True)
+    layer.set_train(False)
+    layer.add_flags_recursive(is_first_iteration=True)
+    x = Tensor(np.random.default_rng(0).standard_normal((batch_size, seq_length, hidden_size)), mstype.float32)
+    input_mask = Tensor(np.ones((batch_size, seq_length, seq_length)), mstype.float32)
+    output, _, _ = layer(x, input_mask, None, Tensor([False], mstype.bool_),
+                         Tensor([seq_length] * batch_size, mstype.int32))
+    assert output.shape == (batch_size, seq_length, hidden_size)
+    assert np.any(layer.key_past.asnumpy() != 0)
+    assert np.any(layer.value_past.asnumpy() != 0)
@@ -0,0 +1,139 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+Test module for testing the tokenizers
+How to run this:
+pytest tests/test_tokenization.py
+"""
+
+import copy
+import json
+import pickle
+
+import numpy as np
+
+from transformer.tokenization.tokenization import convert_tokens_to_ids, convert_ids_to_tokens, get_tokenizer, \
+    get_vocab, BasicTokenizer, WordpieceTokenizer, FullTokenizer
+
+
+def test_tokenizer_registry(tmp_path):
+    """
+    Feature: The tokenizer and the vocab shared in the process
+    Description: Get the vocab and the tokenizer twice, then rewrite the vocab file
+    Expectation: The same objects are returned until the file changes, and the maps are consistent
+    """
+    vocab_file = tmp_path / "vocab.json"
+    vocab_file.write_text(json.dumps({"hello": 0, "world": 1, "!": 2}))
+    vocab = get_vocab(str(vocab_file))
+    assert get_vocab(str(vocab_file)) is vocab
+    assert get_tokenizer(str(vocab_file)) is get_tokenizer(str(vocab_file))
+    assert get_tokenizer(str(vocab_file)).vocab_dict is vocab.token_to_id
+    ids = convert_tokens_to_ids(str(vocab_file), get_tokenizer(str(vocab_file)).tokenize("Hello world!"))
+    assert ids == [0, 1, 2]
+    assert convert_ids_to_tokens(str(vocab_file), ids) == ["hello", "world", "!"]
+
+    vocab_file.write_text(json.dumps({"world": 0, "hello": 1, "!": 2, "[PAD]": 3}))
+    assert get_vocab(str(vocab_file)) is not vocab
+    assert convert_tokens_to_ids(str(vocab_file), ["hello", "world"]) == [1, 0]
+
+
+def test_wordpiece_longest_match():
+    """
+    Feature: The WordPiece tokenization with the prefix tries of the vocab
+    Description: Tokenize the words in the vocab, split into the pieces, and with the chars not in the vocab
+    Expectation: The longest vocab word is taken at each position, and the pieces before [UNK] are kept
+    """
+    vocab = {word: i for i, word in enumerate(["un", "una", "##ff", "##ffa", "##ble", "able", "##b", "##"])}
+    tokenizer = WordpieceTokenizer(vocab)
+    assert tokenizer.tokenize("able unaffabx") == ["able", "una", "##ffa", "##b", "[UNK]"]
+    assert tokenizer.tokenize("unffble") == ["un", "##ff", "##ble"]
+    assert tokenizer.tokenize("xun") == ["[UNK]"]
+
+
+def test_basic_tokenizer_tables():
+    """
+    Feature: The BasicTokenizer with the char class tables and the ASCII fast path
+    Description: Tokenize the ASCII text, the accented and CJK text, and the chars out of the BMP
+    Expectation: The control chars are removed, and the accents, the punctuations and the CJK chars are split
+    """
+    tokenizer = BasicTokenizer(do_lower_case=True)
+    assert tokenizer.tokenize("Hello,\tWorld!\x00 (a.b)") == ["hello", ",", "world", "!", "(", "a", ".", "b", ")"]
+    assert tokenizer.tokenize("Caf\u00e9 d\u00e9j\u00e0-vu \u4e2d\u6587") == ["cafe", "deja", "-", "vu", "\u4e2d", "\u6587"]
+    # The GREEK VARIA is not a punctuation, but its decomposition is the grave accent
+    assert tokenizer.tokenize("a\u1fefb \U00020000x\U0001f600") == ["a", "`", "b", "\U00020000", "x\U0001f600"]
+    assert BasicTokenizer(do_lower_case=False).tokenize("Caf\u00e9!") == ["Caf\u00e9", "!"]
+
+
+def test_encode_batch():
+    """
+    Feature: The batch tokenization in the worker processes
+    Description: Encode a batch large enough for two workers, and a batch tokenized in the process
+    Expectation: The ids and the offsets of each text are the same as the tokenization of the text alone
+    """
+    vocab = {word: i for i, word in enumerate(["[UNK]", "hello", "world", "!", "a", "##b"])}
+    tokenizer = FullTokenizer(vocab)
+    texts = ["hello world!", "", "ab x", "Hello"] * 200
+    ids, offsets = tokenizer.encode_batch(texts, num_workers=2)
+    assert ids.dtype == np.int32 and offsets.tolist()[:5] == [0, 3, 3, 6, 7]
+    assert ids[:7].tolist() == [1, 2, 3, 4, 5, 0, 1] and offsets[-1] == len(ids) == 1400
+    assert tokenizer.tokenize_batch(texts, num_workers=2) == [tokenizer.tokenize(text) for text in texts]
+    assert tokenizer.tokenize_batch(texts[:3]) == [["hello", "world", "!"], [], ["a", "##b", "[UNK]"]]
+
+
+def test_full_tokenizer_word_cache():
+    """
+    Feature: The word cache of the FullTokenizer
+    Description: Tokenize the repeated words with the cache bounded to two words
+    Expectation: The tokens are the same as without the cache, and the repeats are counted as the hits
+    """
+    vocab = {word: i for i, word in enumerate(["[UNK]", "hello", "world", "!", "a", "##b"])}
+    tokenizer = FullTokenizer(vocab, cache_size=2)
+    assert tokenizer.tokenize("Hello world! hello ab") == ["hello", "world", "!", "hello", "a", "##b"]
+    # Only the last two words are kept, and the words are cached before lower case
+    assert tokenizer.tokenize("ab Hello") == FullTokenizer(vocab, cache_size=0).tokenize("ab Hello")
+    assert tokenizer.cache_stats() == {"hits": 1, "misses": 6, "hit_rate": 1 / 7, "size": 2, "max_size": 2}
+    tokenizer.clear_cache()
+    assert tokenizer.cache_stats()["size"] == 0
+
+
+def test_tokenize_with_offsets():
+    """
+    Feature: The char offsets of the tokens of the FullTokenizer
+    Description: Tokenize the text with the accents, the control chars, the CJK chars and the unknown pieces
+    Expectation: Each token covers the chars of the original text which it comes from
+    """
+    vocab = {word: i for i, word in enumerate(["[UNK]", "ab", "##c", "e", "##e", "x", "\u4e2d"])}
+    tokenizer = FullTokenizer(vocab)
+    text = "Abc, \u00c9\u00e9 x\x00\u4e2d!"
+    tokens, offsets = tokenizer.tokenize_with_offsets(text)
+    assert tokens == tokenizer.tokenize(text) == ["ab", "##c", "[UNK]", "e", "##e", "x", "\u4e2d", "[UNK]"]
+    assert [text[start:end] for start, end in offsets] == ["Ab", "c", ",", "\u00c9", "\u00e9", "x", "\u4e2d", "!"]
+    # The [UNK] covers the rest of the word after the pieces found in the vocab
+    assert tokenizer.tokenize_with_offsets(" abcd") == (["ab", "##c", "[UNK]"], [(1, 3), (3, 4), (4, 5)])
+
+
+def test_full_tokenizer_pickle():
+    """
+    Feature: Pickle the FullTokenizer with the word cache
+    Description: Pickle and deep copy a tokenizer after tokenizing a text
+    Expectation: The copies tokenize the same, and start with an empty cache of the same size
+    """
+    vocab = {word: i for i, word in enumerate(["[UNK]", "hello", "world", "!", "a", "##b"])}
+    tokenizer = FullTokenizer(vocab, cache_size=8)
+    assert tokenizer.tokenize("hello ab") == ["hello", "a", "##b"]
+    for restored in (pickle.loads(pickle.dumps(tokenizer)), copy.deepcopy(tokenizer)):
+        assert restored.cache_stats() == {"hits": 0, "misses": 0, "hit_rate": 0.0, "size": 0, "max_size": 8}
+        assert restored.tokenize("Hello world! ab") == ["hello", "world", "!", "a", "##b"]
+    assert tokenizer.cache_stats()["size"] == 2
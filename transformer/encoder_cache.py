@@ -0,0 +1,119 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+"""
+Encoder output cache for the encoder-decoder models
+"""
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+class EncoderOutputCache:
+    """
+    Keep the encoder outputs of the recent sources across the generation requests, so that the same source
+    decoded again, for example with different decoding settings, does not run the encoder again. The outputs
+    are kept as the Tensors returned by the model, and the least recently used ones are evicted when their
+    total size exceeds max_bytes.
+
+    Args:
+        max_bytes(int): The memory budget of the cached encoder outputs in bytes.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.outputs = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(input_ids, input_mask):
+        """The digest of the ids and the mask with their shapes"""
+        digest = hashlib.sha1()
+        for item in (input_ids, input_mask):
+            item = np.ascontiguousarray(item)
+            digest.update(str((item.shape, item.dtype)).encode())
+            digest.update(item.tobytes())
+        return digest.hexdigest()
+
+    def get(self, input_ids, input_mask):
+        """
+        Find the encoder output of the inputs
+
+        Args:
+            input_ids(numpy.ndarray): The source ids with shape [batch_size, seq_length].
+            input_mask(numpy.ndarray): The source mask with shape [batch_size, seq_length].
+
+        Returns:
+            encoder_output: the cached encoder output, or None if it is not cached
+        """
+        key = self._key(input_ids, input_mask)
+        item = self.outputs.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.outputs.move_to_end(key)
+        return item[0]
+
+    def put(self, input_ids, input_mask, encoder_output):
+        """
+        Store the encoder output of the inputs
+
+        Args:
+            input_ids(numpy.ndarray): The source ids with shape [batch_size, seq_length].
+            input_mask(numpy.ndarray): The source mask with shape [batch_size, seq_length].
+            encoder_output(Tensor): The output of the encoder.
+        """
+        key = self._key(input_ids, input_mask)
+        if key in self.outputs:
+            self.outputs.move_to_end(key)
+            return
+        num_bytes = int(encoder_output.nbytes)
+        if num_bytes > self.max_bytes:
+            return
+        self.outputs[key] = (encoder_output, num_bytes)
+        self.num_bytes += num_bytes
+        while self.num_bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self.outputs.popitem(last=False)
+            self.num_bytes -= evicted_bytes
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Get the statistics of the cache
+
+        Returns:
+            stats: dict of the hit and miss counters and the memory usage
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "num_entries": len(self.outputs),
+                "num_bytes": self.num_bytes,
+                "evictions": self.evictions}
+
+
+def build_encoder_cache(opt):
+    """
+    Return the EncoderOutputCache if the encoder_cache_bytes is set, else None
+    """
+    max_bytes = getattr(opt, 'encoder_cache_bytes', 0)
+    if not max_bytes:
+        return None
+    return EncoderOutputCache(max_bytes)
@@ -23,162 +23,941 @@ import mindspore.common.dtype as mstype
 from mindspore.common.tensor import Tensor
 from mindspore.ops import operations as P
 
+from transformer.length_bucket import LengthBucketedModel
+from transformer.modules.sampling import is_greedy
+
 
 def topk_fun(logits, topk=5):
-    """Get topk"""
-    target_column = logits[0].tolist()
-    sorted_array = [(k, v) for k, v in enumerate(target_column)]
-    sorted_array.sort(key=lambda x: x[1], reverse=True)
-    topk_array = sorted_array[:topk]
-    index, value = zip(*topk_array)
-    index = np.array([index])
-    value = np.array([value])
+    """
+    Get the topk values and indices of each row of logits.
+
+    The result is sorted by value in descending order and ties are broken by the smaller index first, which
+    is the same order as a stable full sort. Only the topk candidates are sorted, the rest of the row is
+    partitioned away with argpartition.
+
+    Inputs:
+        logits(numpy.ndarray): The scores with shape [batch_size, vocab_size].
+        topk(int): The number of the candidates to keep. It is clipped to vocab_size.
+
+    Returns:
+        value: numpy.ndarray of float64 with shape [batch_size, topk]
+        index: numpy.ndarray of int64 with shape [batch_size, topk]
+    """
+    logits = np.asarray(logits)
+    if logits.ndim == 1:
+        logits = logits.reshape(1, -1)
+    vocab_size = logits.shape[-1]
+    topk = min(topk, vocab_size)
+    if topk < vocab_size:
+        index = np.argpartition(-logits, topk - 1, axis=-1)[:, :topk]
+    else:
+        index = np.tile(np.arange(vocab_size), (logits.shape[0], 1))
+    value = np.take_along_axis(logits, index, axis=-1)
+
+    # argpartition may pick any of the candidates equal to the kth value, so the rows which have ties
+    # crossing the boundary are refilled with the smallest indices
+    kth_value = value.min(axis=-1, keepdims=True)
+    tie_rows = np.flatnonzero(np.count_nonzero(logits == kth_value, axis=-1) !=
+                              np.count_nonzero(value == kth_value, axis=-1))
+    for row in tie_rows:
+        greater = np.flatnonzero(logits[row] > kth_value[row])
+        equal = np.flatnonzero(logits[row] == kth_value[row])[:topk - len(greater)]
+        index[row] = np.concatenate((greater, equal))
+        value[row] = logits[row][index[row]]
+
+    order = np.lexsort((index, -value), axis=-1)
+    index = np.take_along_axis(index, order, axis=-1)
+    value = np.take_along_axis(value, order, axis=-1).astype(np.float64)
     return value, index
 
 
-def sampler(log_probs_revised, top_p, top_k_num, use_pynative=False):
+def _top_p_filter(sorted_logits, index, top_p):
+    """Keep the smallest prefix of each sorted row whose cumulative probability reaches top_p"""
+    cumsum_logits = np.cumsum(sorted_logits, axis=-1)
+    top_p_num = np.minimum(np.count_nonzero(cumsum_logits < top_p, axis=-1) + 1, sorted_logits.shape[-1])
+    outputs = []
+    for row, num in enumerate(top_p_num):
+        # The sequential cumsum gives the same normalizer as summing the kept probabilities one by one
+        outputs.append((sorted_logits[row, :num] / cumsum_logits[row, num - 1], index[row, :num]))
+    return outputs
+
+
+def _top_k_filter(sorted_logits, index):
+    """Normalize the topk probabilities of each row"""
+    top_k_num = sorted_logits.shape[-1]
+    normalizer = np.cumsum(sorted_logits, axis=-1)[:, -1]
+    outputs = []
+    for row in range(sorted_logits.shape[0]):
+        probs = sorted_logits[row]
+        # Avoid rounding error
+        if normalizer[row] == 0:
+            probs = np.full(top_k_num, 1 / top_k_num)
+            outputs.append((probs / np.cumsum(probs)[-1], index[row]))
+        else:
+            outputs.append((probs / normalizer[row], index[row]))
+    return outputs
+
+
+def apply_penalty(log_probs, frequency_list, frequency_penalty, presence_penalty):
+    """
+    Revise the log_probs with frequency and presence penalty to eliminate duplicate in generated results
+
+    Inputs:
+        log_probs(numpy.ndarray): The scores with shape [batch_size, vocab_size].
+        frequency_list(numpy.ndarray): The count of each generated token with shape [batch_size, vocab_size].
+        frequency_penalty(float): The penalty for each time the token has appeared.
+        presence_penalty(float): The penalty if the token has appeared at least once.
+
+    Returns:
+        log_probs_revised: numpy.ndarray with shape [batch_size, vocab_size]
+    """
+    return log_probs - frequency_list * frequency_penalty - (frequency_list > 0) * presence_penalty
+
+
+class SparsePenalty:
+    """
+    Keep the generated tokens of each row sparsely for the frequency and presence penalties, so that the penalties
+    only revise the scores of the tokens already generated instead of the whole vocabulary of each row. The
+    revised scores are the same as apply_penalty with the dense frequency list.
+
+    The repetition penalty also covers the tokens of the prompt. The score of a token in the prompt or generated
+    before is divided by the repetition_penalty if it is positive, else multiplied, and it is applied before the
+    frequency and presence penalties.
+
+    Args:
+        batch_size(int): The number of the rows.
+        vocab_size(int): The vocabulary length of the model.
+        frequency_penalty(float): The penalty for each time the token has appeared. Default: 0.0.
+        presence_penalty(float): The penalty if the token has appeared at least once. Default: 0.0.
+        repetition_penalty(float): The penalty of the tokens in the prompt or generated before, 1.0 means no
+            penalty. Default: 1.0.
+    """
+    def __init__(self, batch_size, vocab_size, frequency_penalty=0.0, presence_penalty=0.0, repetition_penalty=1.0):
+        self.vocab_size = vocab_size
+        self.frequency_penalty = frequency_penalty
+        self.presence_penalty = presence_penalty
+        self.repetition_penalty = repetition_penalty
+        self.counts = [{} for _ in range(batch_size)]
+        self.prompt_tokens = [set() for _ in range(batch_size)]
+
+    @classmethod
+    def from_config(cls, batch_size, vocab_size, config):
+        """Build the penalty with the penalties of the inference configurations"""
+        return cls(batch_size, vocab_size, config.frequency_penalty, config.presence_penalty,
+                   getattr(config, 'repetition_penalty', 1.0))
+
+    def add_prompt(self, row, token_ids):
+        """Record the tokens of the prompt of the row for the repetition penalty"""
+        self.prompt_tokens[row] = set(np.asarray(token_ids).reshape(-1).tolist())
+
+    def add(self, row, token_id):
+        """Count a generated token of the row"""
+        counts = self.counts[row]
+        token_id = int(token_id)
+        counts[token_id] = counts.get(token_id, 0) + 1
+
+    def reset(self, row):
+        """Clear the prompt and the generated tokens of the row"""
+        self.counts[row] = {}
+        self.prompt_tokens[row] = set()
+
+    def apply(self, log_probs, rows=None):
+        """
+        Revise the scores of the rows with the penalties
+
+        Inputs:
+            log_probs(numpy.ndarray): The scores with shape [len(rows), vocab_size].
+            rows(numpy.ndarray): The rows of the penalty for each row of the log_probs. Default: all the rows.
+
+        Returns:
+            log_probs_revised: numpy.ndarray with shape [len(rows), vocab_size]
+        """
+        rows = range(len(self.counts)) if rows is None else rows
+        revised = np.array(log_probs, np.float64)
+        if self.repetition_penalty != 1.0:
+            row_index, token_index = [], []
+            for i, row in enumerate(rows):
+                tokens = self.prompt_tokens[row].union(self.counts[row])
+                row_index.extend([i] * len(tokens))
+                token_index.extend(tokens)
+            scores = revised[row_index, token_index]
+            revised[row_index, token_index] = np.where(scores > 0, scores / self.repetition_penalty,
+                                                       scores * self.repetition_penalty)
+        row_index, token_index, counts = [], [], []
+        for i, row in enumerate(rows):
+            row_index.extend([i] * len(self.counts[row]))
+            token_index.extend(self.counts[row].keys())
+            counts.extend(self.counts[row].values())
+        if counts:
+            revised[row_index, token_index] = revised[row_index, token_index] - \
+                np.array(counts) * self.frequency_penalty - self.presence_penalty
+        return revised
+
+    def dense(self, rows=None):
+        """
+        Get the dense frequency list of the rows, used by the sampler of the eval net
+
+        Returns:
+            frequency_list: numpy.ndarray of the count of each generated token with shape [len(rows), vocab_size]
+        """
+        rows = range(len(self.counts)) if rows is None else rows
+        frequency_list = np.zeros((len(rows), self.vocab_size), np.int32)
+        for i, row in enumerate(rows):
+            for token_id, count in self.counts[row].items():
+                frequency_list[i, token_id] = count
+        return frequency_list
+
+
+def batch_sampler(log_probs_revised, top_p, top_k_num, temperature=1.0):
+    """
+    Convert the log_probs of a batch to the candidate probabilities and indices
+
+    Inputs:
+        log_probs_revised(numpy.ndarray): The revised scores with shape [batch_size, vocab_size].
+        top_p(float): Use top_p sampling if it is less than 1.0, else top_k sampling.
+        top_k_num(int): The number of candidates for the top_k sampling.
+        temperature(float): The scores are divided by the temperature before exponentiation.
+
+    Returns:
+        outputs: list of (p, p_args) for each row. p is the normalized probability of the candidates and
+        p_args is the corresponding token ids.
+    """
+    log_probs_revised = np.array(log_probs_revised, np.float32)
+    if log_probs_revised.ndim == 1:
+        log_probs_revised = log_probs_revised.reshape(1, -1)
+    if temperature != 1.0:
+        log_probs_revised = log_probs_revised / np.float32(temperature)
+    logits = np.power(np.e, log_probs_revised)
+
+    # If top_p is less than 1.0, use top_p sampling
+    if top_p < 1.0:
+        # Only consider the 5000 largest logits to reduce computation
+        sorted_logits, index = topk_fun(logits, 5000)
+        return _top_p_filter(sorted_logits, index, top_p)
+    # if top_p is set to 1.0, use top_k sampling
+    sorted_logits, index = topk_fun(logits, top_k_num)
+    return _top_k_filter(sorted_logits, index)
+
+
+def sampler(log_probs_revised, top_p, top_k_num, use_pynative=False, temperature=1.0):
     """Convert the log_probs to probability"""
-    if use_pynative:
-        logits = P.Pow()(np.e, Tensor(log_probs_revised, mstype.float32))
-    else:
-        logits = np.power(np.e, np.array(log_probs_revised, np.float32))
+    if not use_pynative:
+        return batch_sampler(log_probs_revised, top_p, top_k_num, temperature)[0]
 
+    if temperature != 1.0:
+        log_probs_revised = np.array(log_probs_revised, np.float32) / np.float32(temperature)
+    logits = P.Pow()(np.e, Tensor(log_probs_revised, mstype.float32))
     # If top_p is less than 1.0, use top_p sampling
     if top_p < 1.0:
         # Only consider the 5000 largest logits to reduce computation
-        if use_pynative:
-            sorted_logits, index = P.TopK(sorted=True)(logits, 5000)
-            cumsum_logits = P.CumSum()(sorted_logits, 1)
-            cumsum_logits = cumsum_logits.asnumpy()
-            index = index.asnumpy()
-            sorted_logits = sorted_logits.asnumpy()
-        else:
-            sorted_logits, index = topk_fun(logits, 5000)
-            cumsum_logits = np.cumsum(sorted_logits, 1)
-        cumsum_logits = cumsum_logits[0]
-        index = index[0]
-        sorted_logits = sorted_logits[0]
-        top_p_num = sum(cumsum_logits < top_p) + 1
-        # In case the probability is smooth, the sum of 5000 largest probabilities are not large enough
-        if top_p_num == 0:
-            top_p_num = 5000
-        # Get the corresponding probs and indices
-        probs = sorted_logits[:top_p_num]
-        p_args = index[:top_p_num]
-        p = probs / sum(probs)
-        # if top_p is set to 1.0, use top_k sampling
+        sorted_logits, index = P.TopK(sorted=True)(logits, 5000)
+        return _top_p_filter(sorted_logits.asnumpy()[:1].astype(np.float64), index.asnumpy()[:1], top_p)[0]
+    # if top_p is set to 1.0, use top_k sampling
+    probs, p_args = P.TopK(sorted=True)(logits, top_k_num)
+    return _top_k_filter(probs.asnumpy()[:1].astype(np.float64), p_args.asnumpy()[:1])[0]
+
+
+def sample_tokens(log_probs, frequency_list, config):
+    """
+    Sample one token for each row of the batch
+
+    Inputs:
+        log_probs(numpy.ndarray): The scores with shape [batch_size, vocab_size].
+        frequency_list(numpy.ndarray): The count of each generated token with shape [batch_size, vocab_size].
+        config: Inference configurations.
+
+    Returns:
+        target: numpy.ndarray of the sampled token ids with shape [batch_size]
+    """
+    log_probs_revised = apply_penalty(log_probs, frequency_list, config.frequency_penalty, config.presence_penalty)
+    return _sample_revised(log_probs_revised, config)
+
+
+def _sample_revised(log_probs_revised, config):
+    """Sample one token for each row from the scores revised by the penalties"""
+    temperature = getattr(config, 'temperature', 1.0)
+    target = []
+    for p, p_args in batch_sampler(log_probs_revised, config.top_p, config.top_k_num, temperature):
+        # Random select a token as final output for this round
+        target.append(p_args[np.random.choice(len(p), p=p)])
+    return np.array(target)
+
+
+def sample_outputs(outputs, active, penalty, config):
+    """
+    Sample one token for each active row from the outputs of the eval net
+
+    The greedy decoding takes the token with the largest revised score of each row without the sampling.
+
+    Inputs:
+        outputs(Union[Tensor, tuple]): The probabilities of the whole vocabulary with shape [batch_size, vocab_size],
+            the candidate probabilities and ids selected by the TopKSampler of the eval net, or the token ids
+            selected by the ArgmaxSampler of the eval net with shape [batch_size].
+        active(numpy.ndarray): The rows to sample.
+        penalty(SparsePenalty): The generated tokens of each row for the penalties.
+        config: Inference configurations.
+
+    Returns:
+        target: numpy.ndarray of the sampled token ids of the active rows
+    """
+    if not isinstance(outputs, (tuple, list)):
+        log_probs = outputs.asnumpy()
+        if np.issubdtype(log_probs.dtype, np.integer):
+            # The tokens are already selected by the ArgmaxSampler of the eval net
+            return log_probs.reshape(-1)[active]
+        log_probs = log_probs.reshape(-1, penalty.vocab_size)
+        if is_greedy(config):
+            return np.argmax(penalty.apply(log_probs[active], active), axis=-1)
+        return _sample_revised(penalty.apply(log_probs[active], active), config)
+    # The penalties and temperature are already applied in the graph, only normalize the candidates
+    probs, index = outputs
+    probs = probs.asnumpy()[active].astype(np.float64)
+    index = index.asnumpy()[active]
+    if config.top_p < 1.0:
+        candidates = _top_p_filter(probs, index, config.top_p)
     else:
-        # Get the corresponding probs and indices
-        if use_pynative:
-            probs, p_args = P.TopK(sorted=True)(logits, top_k_num)
-            probs = probs.asnumpy()
-            p_args = p_args.asnumpy()
-        else:
-            probs, p_args = topk_fun(logits, top_k_num)
-        probs = probs[0]
-        p_args = p_args[0]
-        # Avoid rounding error
-        if sum(probs) == 0:
-            probs = np.array([1 / top_k_num for _ in range(top_k_num)])
-        p = probs / sum(probs)
-    return p, p_args
+        candidates = _top_k_filter(probs, index)
+    return np.array([p_args[np.random.choice(len(p), p=p)] for p, p_args in candidates])
 
 
-def generate(model,
-             end_token,
-             origin_inputs,
-             model_origin_max_length,
-             max_generate_length,
-             vocab_size,
-             cache_encoder,
-             config):
+def pad_batch_inputs(origin_inputs, seq_length, valid_length=None, padding_side='right', pad_token=0):
     """
-    Text generation given the model and origin inputs
+    Convert the prompts of a batch to the right padded ids used by the models
+
+    Inputs:
+        origin_inputs(Union[list, numpy.ndarray]): A list of the id lists with different lengths, or a padded
+            array with shape [batch_size, length].
+        seq_length(int): The sequence length of the model.
+        valid_length(Union[list, numpy.ndarray]): The prompt length of each row of the padded array. If None, it
+            is the number of ids which are not equal to the pad_token.
+        padding_side(str): The side where the padded array is padded, 'right' or 'left'.
+        pad_token(int): The id of the padding token.
+
+    Returns:
+        input_ids: numpy.ndarray with shape [batch_size, seq_length], the prompt of each row starts from 0.
+        valid_length: numpy.ndarray with shape [batch_size]
+    """
+    if padding_side not in ('right', 'left'):
+        raise ValueError(f"The padding_side should be 'right' or 'left', but got {padding_side}.")
+    if isinstance(origin_inputs, np.ndarray) and origin_inputs.ndim == 2:
+        if valid_length is None:
+            valid_length = np.sum(origin_inputs != pad_token, axis=-1)
+        rows = [row[:length] if padding_side == 'right' else row[row.shape[0] - length:]
+                for row, length in zip(origin_inputs, valid_length)]
+    else:
+        rows = [np.asarray(row).reshape(-1) for row in origin_inputs]
+    valid_length = np.array([len(row) for row in rows], np.int32)
+    if np.max(valid_length) > seq_length:
+        raise ValueError(f"The prompt length {np.max(valid_length)} exceeds the model seq_length {seq_length}.")
+    input_ids = np.full((len(rows), seq_length), pad_token, np.int32)
+    for i, row in enumerate(rows):
+        input_ids[i, :valid_length[i]] = row
+    return input_ids, valid_length
+
+
+def _predict_encoder(model, input_ids, input_mask, encoder_cache=None):
+    """
+    Run the encoder of the encoder-decoder model, or reuse its output from the encoder_cache
+    """
+    if encoder_cache is not None:
+        encoder_output = encoder_cache.get(input_ids, input_mask)
+        if encoder_output is not None:
+            return encoder_output
+    encoder_output = model.predict(Tensor(input_ids, mstype.int32), Tensor(input_mask, mstype.float32))
+    if encoder_cache is not None:
+        encoder_cache.put(input_ids, input_mask, encoder_output)
+    return encoder_output
+
+
+def incremental_predict(model, input_ids, input_mask, valid_length, is_first_iteration, *extra_inputs):
+    """
+    Run a single inference with the key/value cache of the model
+
+    The first iteration runs the prefill graph over the whole padded prompt and fills the cache. The following
+    iterations run the decode graph with only the latest token of each row with shape [bs, 1], whose keys and
+    values are appended to the cache at the position valid_length - 1 of the row. The extra_inputs are appended
+    to the inputs of the eval net.
+    """
+    batch_size, seq_length = input_ids.shape
+    batch_index = np.arange(batch_size)
+    if is_first_iteration:
+        model.predict_network.add_flags_recursive(is_first_iteration=True)
+        current_index = Tensor(batch_index * seq_length + valid_length - 1, mstype.int32)
+        log_probs = model.predict(Tensor(input_ids, mstype.int32), Tensor(input_mask, mstype.float32),
+                                  current_index, Tensor([False], mstype.bool_), Tensor(valid_length, mstype.int32),
+                                  *extra_inputs)
+        model.predict_network.add_flags_recursive(is_first_iteration=False)
+        return log_probs
+    inputs = input_ids[batch_index, valid_length - 1].reshape(batch_size, 1)
+    mask = input_mask[batch_index, valid_length - 1].reshape(batch_size, 1)
+    return model.predict(Tensor(inputs, mstype.int32), Tensor(mask, mstype.float32),
+                         Tensor(batch_index, mstype.int32), Tensor([True], mstype.bool_),
+                         Tensor(valid_length - 1, mstype.int32), *extra_inputs)
+
+
+def _incremental_decode(model, encoder_output, encoder_mask, input_ids, input_mask, valid_length,
+                        is_first_iteration, *extra_inputs):
+    """
+    Run a single decoder inference of the encoder-decoder model with the key/value cache of the decoder
+
+    The first iteration runs the decoder over the whole padded target, fills the self attention cache and
+    computes the keys and values of the encoder output for the cross attention. The following iterations only
+    take the latest token of each row with shape [bs, 1] and reuse the saved keys and values.
+    """
+    batch_size, seq_length = input_ids.shape
+    batch_index = np.arange(batch_size)
+    frequency_list = extra_inputs[0] if extra_inputs else None
+    encoder_mask = Tensor(encoder_mask, mstype.float32)
+    if is_first_iteration:
+        model.predict_network.add_flags_recursive(is_first_iteration=True)
+        current_index = Tensor(batch_index * seq_length + valid_length - 1, mstype.int32)
+        outputs = model.predict(None, encoder_mask, current_index, encoder_output, Tensor(input_ids, mstype.int32),
+                                Tensor(input_mask, mstype.float32), frequency_list, Tensor([False], mstype.bool_),
+                                Tensor(valid_length, mstype.int32))
+        model.predict_network.add_flags_recursive(is_first_iteration=False)
+        return outputs
+    inputs = input_ids[batch_index, valid_length - 1].reshape(batch_size, 1)
+    mask = input_mask[batch_index, valid_length - 1].reshape(batch_size, 1)
+    return model.predict(None, encoder_mask, Tensor(batch_index, mstype.int32), encoder_output,
+                         Tensor(inputs, mstype.int32), Tensor(mask, mstype.float32), frequency_list,
+                         Tensor([True], mstype.bool_), Tensor(valid_length - 1, mstype.int32))
+
+
+def generate_stream(model,
+                    end_token,
+                    origin_inputs,
+                    model_origin_max_length,
+                    max_generate_length,
+                    vocab_size,
+                    cache_encoder=False,
+                    config=None,
+                    valid_length=None,
+                    padding_side='right',
+                    pad_token=0,
+                    prefix_cache=None,
+                    encoder_cache=None):
+    """
+    Text generation of a batch of prompts which yields each token as soon as it is sampled
+
+    The inputs are the same as generate_batch. For each step, a (row, token) pair is yielded for every new token
+    appended to a row, and the end_token is not yielded. The return value of the generator is the same as the
+    outputs of generate_batch.
 
     Inputs:
         model: The model to run the prediction
         end_token(int): The model will stop generating the words when it reaches the end_token.
-        origin_inputs(list): The prompt for generation, should be a list of ids.
+        origin_inputs(Union[list, numpy.ndarray]): The prompts for generation, a list of id lists or a padded
+            array with shape [batch_size, length].
         model_origin_max_length(int): The sequence length of the model trained.
         max_generate_length(int):  The maximum of generated length.
         vocab_size(int): The vocabulary length of the model.
+        cache_encoder(bool): Run the encoder once and reuse its output for decoding, used by the T5 model.
         config: Inference configurations.
+        valid_length(Union[list, numpy.ndarray]): The prompt length of each row of the padded origin_inputs.
+        padding_side(str): The side where the padded origin_inputs is padded, 'right' or 'left'.
+        pad_token(int): The id of the padding token.
+        prefix_cache(PrefixKVCache): The cache of the keys and values of the processed prompts, only used when
+            the eval net is built with use_past=True.
+        encoder_cache(EncoderOutputCache): The cache of the encoder outputs, only used when cache_encoder is True.
 
     Returns:
-        outputs: the ids for the generated text
+        outputs: list of the ids for the generated text of each prompt
     """
-    # Get configurations for inference
-    frequency_penalty = config.frequency_penalty
-    presence_penalty = config.presence_penalty
-    top_p = config.top_p
-    top_k_num = config.top_k_num
-    use_pynative = False
+    use_past = getattr(model.predict_network, 'use_past', False) and not cache_encoder
+    use_decoder_past = getattr(model.predict_network, 'use_past', False) and cache_encoder
+    sample_on_device = getattr(model.predict_network, 'sampler', None) is not None
+    use_frequency_list = sample_on_device and getattr(model.predict_network.sampler, 'use_frequency_list', True)
 
-    _, valid_length = origin_inputs.shape
+    input_ids, valid_length = pad_batch_inputs(origin_inputs, model_origin_max_length, valid_length,
+                                               padding_side, pad_token)
+    batch_size = input_ids.shape[0]
+    batch_index = np.arange(batch_size)
     # If target length exceeds model_origin_max_length, use model_origin_max_length instead
-    target_length = valid_length + max_generate_length
-    target_length = model_origin_max_length if target_length > model_origin_max_length else target_length
-
-    # A list of the frequency of each token
-    frequency_list = np.array([[0 for _ in range(vocab_size)]])
-    pad_length = model_origin_max_length - origin_inputs.shape[-1]
-    # Pad original inputs to model_origin_max_length
-    input_ids = np.pad(origin_inputs, ((0, 0), (0, pad_length)), 'constant', constant_values=(0, 0))
-    input_mask = np.zeros_like(input_ids)
-    input_mask[0][:valid_length] = 1
+    target_length = np.minimum(valid_length + max_generate_length, model_origin_max_length)
+
+    # The generated tokens of each row for the penalties
+    penalty = SparsePenalty.from_config(batch_size, vocab_size, config)
+    if sample_on_device and penalty.repetition_penalty != 1.0:
+        raise ValueError("The repetition_penalty is not supported by the sampler of the eval net, please set "
+                         "sample_on_device=False to use it.")
+    input_mask = (np.arange(model_origin_max_length) < valid_length[:, None]).astype(np.int32)
     config.logger.info(f"input_ids is {input_ids}")
 
+    # The repetition penalty of T5 covers the source, which is replaced by the decoder inputs below
+    for row in range(batch_size):
+        penalty.add_prompt(row, input_ids[row, :valid_length[row]])
     encoder_output = None
     encoder_mask = None
-    encoder_mask = None
     if cache_encoder:
         # When do encoder and decoder prediction, the encoder can be cached to speed up the inference
-        inputs = Tensor(input_ids, mstype.int32)
         encoder_mask = copy.deepcopy(input_mask)
-        encoder_output = model.predict(inputs, Tensor(encoder_mask, mstype.float32))
-        input_ids = [[0]]
-        input_ids = np.pad(input_ids, ((0, 0), (0, config.model['max_decode_length'] - 1)),
-                           'constant', constant_values=(0, 0))
-        target_mask = np.zeros_like(input_ids)
-        target_mask[0, 0] = 1
+        encoder_output = _predict_encoder(model, input_ids, encoder_mask, encoder_cache)
+        max_decode_length = config.model['max_decode_length']
+        input_ids = np.zeros((batch_size, max_decode_length), np.int32)
+        input_mask = np.zeros_like(input_ids)
+        input_mask[:, 0] = 1
+        target_length = np.minimum(target_length, max_decode_length)
         # As the decoder is generating from [START] token
-        valid_length = 1
-    # A single loop generates one token, loop until reaching target model_origin_max_length or generating eod token
-    while valid_length < target_length:
-        inputs = Tensor(input_ids, mstype.int32)
-        # Indicate the exact token position
-        current_index = valid_length - 1 if valid_length - 1 > 0 else 0
-        current_index = Tensor([current_index], mstype.int32)
+        valid_length = np.ones(batch_size, np.int32)
+    # The decoder-only models run the smallest length bucket which fits the longest row
+    bucketed = isinstance(model, LengthBucketedModel) and not cache_encoder
+    finished = valid_length >= target_length
+    is_first_iteration = True
+    prompt_length = valid_length.copy()
+    if bucketed:
+        model.select(int(np.max(prompt_length)))
+    if use_past and prefix_cache is not None:
+        # Start from the longest cached prefix of each row, and feed the rest of the prompt to the decode graph
+        prefix_length = prefix_cache.load(model.predict_network, input_ids, valid_length)
+        if prefix_length is not None:
+            model.predict_network.add_flags_recursive(is_first_iteration=False)
+            is_first_iteration = False
+            valid_length = prefix_length + 1
+    cache_stored = prefix_cache is None or not use_past
+    # A single loop generates one token for each active row, loop until all the rows reach the target length or
+    # generate the eod token
+    while not finished.all():
+        step_ids, step_mask = input_ids, input_mask
+        if bucketed:
+            if np.max(valid_length) > model.bucket:
+                # The cache of the new bucket is filled by the prefill graph from the tokens so far
+                model.select(int(np.max(valid_length)))
+                is_first_iteration = True
+            bucket = model.bucket
+            step_ids = np.ascontiguousarray(input_ids[:, :bucket])
+            step_mask = np.ascontiguousarray(input_mask[:, :bucket])
+        seq_length = step_ids.shape[1]
+        # Indicate the exact token position of each row in the flattened logits
+        current_index = Tensor(batch_index * seq_length + np.maximum(valid_length - 1, 0), mstype.int32)
+        # The sampler in the eval net applies the penalties in the graph with the frequency list
+        extra_inputs = (Tensor(penalty.dense(), mstype.int32),) if use_frequency_list else ()
         # Call a single inference
-        if cache_encoder:
+        if use_past:
+            outputs = incremental_predict(model, step_ids, step_mask, valid_length, is_first_iteration,
+                                          *extra_inputs)
+            is_first_iteration = False
+        elif use_decoder_past:
+            outputs = _incremental_decode(model, encoder_output, encoder_mask, input_ids, input_mask, valid_length,
+                                          is_first_iteration, *extra_inputs)
+            is_first_iteration = False
+        elif cache_encoder:
             # view inputs as target_ids
-            log_probs = model.predict(None, Tensor(encoder_mask, mstype.float32), current_index, encoder_output, inputs,
-                                      Tensor(target_mask, mstype.float32))
+            outputs = model.predict(None, Tensor(encoder_mask, mstype.float32), current_index, encoder_output,
+                                    Tensor(input_ids, mstype.int32), Tensor(input_mask, mstype.float32),
+                                    *extra_inputs)
+        elif sample_on_device:
+            outputs = model.predict(Tensor(step_ids, mstype.int32), Tensor(step_mask, mstype.float32),
+                                    current_index, True, None, *extra_inputs)
         else:
-            log_probs = model.predict(inputs, Tensor(input_mask, mstype.float32))
-        # Get the revised log_probs considering frequency and presence penalty to eliminate duplicate
-        # in generated results
-        log_probs = log_probs.asnumpy().reshape(1, vocab_size)
-        log_probs_revised = log_probs - frequency_list * frequency_penalty - (frequency_list > 0) * presence_penalty
+            outputs = model.predict(Tensor(step_ids, mstype.int32), Tensor(step_mask, mstype.float32),
+                                    current_index)
 
-        p, p_args = sampler(log_probs_revised, top_p, top_k_num, use_pynative)
-        # Random select a token as final output for this round
-        target_index = np.random.choice(len(p), p=p)
-        # Stop judgment
-        if p_args[target_index] == end_token or valid_length == target_length - 1:
-            outputs = input_ids
-            break
-
-        # update frequency list
-        target = p_args[target_index]
-        frequency_list[0][target] = frequency_list[0][target] + 1
-        # Modify input_ids with newly generated token
-        input_ids[0][valid_length] = p_args[target_index]
-        if cache_encoder:
-            target_mask[0][valid_length] = 1
-        valid_length += 1
-        input_mask[0][valid_length-1] = 1
+        active = np.flatnonzero(~finished)
+        if not cache_stored and np.all(valid_length[active] >= prompt_length[active]):
+            # The rows finished without feeding the whole prompt are not stored
+            prefix_cache.store(model.predict_network, input_ids,
+                               np.where(valid_length >= prompt_length, prompt_length, 0))
+            cache_stored = True
+        # The rows still feeding the prompt from the cached prefix skip the sampling
+        prefilling = valid_length[active] < prompt_length[active]
+        valid_length[active[prefilling]] += 1
+        active = active[~prefilling]
+        targets = sample_outputs(outputs, active, penalty, config)
+        for row, target in zip(active, targets):
+            # Stop judgment
+            if target == end_token or valid_length[row] == target_length[row] - 1:
+                finished[row] = True
+                continue
+            # update frequency list
+            penalty.add(row, target)
+            # Modify input_ids with newly generated token
+            input_ids[row, valid_length[row]] = target
+            input_mask[row, valid_length[row]] = 1
+            valid_length[row] += 1
+            yield row, target
     # Return valid outputs out of padded outputs
-    length = np.sum(outputs != 0)
-    outputs = outputs[0][:length]
+    return [input_ids[row, :valid_length[row]] for row in range(batch_size)]
+
+
+def generate_batch(model,
+                   end_token,
+                   origin_inputs,
+                   model_origin_max_length,
+                   max_generate_length,
+                   vocab_size,
+                   cache_encoder=False,
+                   config=None,
+                   valid_length=None,
+                   padding_side='right',
+                   pad_token=0,
+                   prefix_cache=None,
+                   encoder_cache=None):
+    """
+    Text generation of a batch of prompts given the model and origin inputs
+
+    The prompts can have different lengths. Each row stops when it generates the end_token or reaches its target
+    length, and the finished rows are removed from the sampling. The compiled batch shape of the model is fixed,
+    so the finished rows are still fed to the model as padding until all the rows are finished.
+
+    If the eval net is built with use_past=True, the prompt is processed once by the prefill graph and each
+    new token only runs the decode graph with the key/value cache, instead of the whole padded sequence. For the
+    T5 model with cache_encoder, the decoder keeps the keys and values of both the self attention and the cross
+    attention. If the eval net is built with a sampler, only the sampling candidates are copied back from the
+    device.
+
+    Inputs:
+        model: The model to run the prediction
+        end_token(int): The model will stop generating the words when it reaches the end_token.
+        origin_inputs(Union[list, numpy.ndarray]): The prompts for generation, a list of id lists or a padded
+            array with shape [batch_size, length].
+        model_origin_max_length(int): The sequence length of the model trained.
+        max_generate_length(int):  The maximum of generated length.
+        vocab_size(int): The vocabulary length of the model.
+        cache_encoder(bool): Run the encoder once and reuse its output for decoding, used by the T5 model.
+        config: Inference configurations.
+        valid_length(Union[list, numpy.ndarray]): The prompt length of each row of the padded origin_inputs.
+        padding_side(str): The side where the padded origin_inputs is padded, 'right' or 'left'.
+        pad_token(int): The id of the padding token.
+        prefix_cache(PrefixKVCache): The cache of the keys and values of the processed prompts, only used when
+            the eval net is built with use_past=True.
+        encoder_cache(EncoderOutputCache): The cache of the encoder outputs, only used when cache_encoder is True.
+
+    Returns:
+        outputs: list of the ids for the generated text of each prompt
+    """
+    stream = generate_stream(model, end_token, origin_inputs, model_origin_max_length, max_generate_length,
+                             vocab_size, cache_encoder, config, valid_length, padding_side, pad_token, prefix_cache,
+                             encoder_cache)
+    while True:
+        try:
+            next(stream)
+        except StopIteration as outputs:
+            return outputs.value
+
+
+def generate(model,
+             end_token,
+             origin_inputs,
+             model_origin_max_length,
+             max_generate_length,
+             vocab_size,
+             cache_encoder=False,
+             config=None):
+    """
+    Text generation given the model and origin inputs
+
+    Inputs:
+        model: The model to run the prediction
+        end_token(int): The model will stop generating the words when it reaches the end_token.
+        origin_inputs(list): The prompt for generation, should be a list of ids.
+        model_origin_max_length(int): The sequence length of the model trained.
+        max_generate_length(int):  The maximum of generated length.
+        vocab_size(int): The vocabulary length of the model.
+        cache_encoder(bool): Run the encoder once and reuse its output for decoding, used by the T5 model.
+        config: Inference configurations.
+
+    Returns:
+        outputs: the ids for the generated text
+    """
+    origin_inputs = np.array(origin_inputs).reshape(1, -1)
+    outputs = generate_batch(model, end_token, [origin_inputs[0]], model_origin_max_length, max_generate_length,
+                             vocab_size, cache_encoder, config)
+    return outputs[0]
+
+
+def sampling_distribution(log_probs, frequency_list, config):
+    """
+    Get the distribution over the whole vocabulary which sample_tokens draws each row from
+
+    Inputs:
+        log_probs(numpy.ndarray): The scores with shape [batch_size, vocab_size].
+        frequency_list(numpy.ndarray): The count of each generated token with shape [batch_size, vocab_size].
+        config: Inference configurations.
+
+    Returns:
+        dist: numpy.ndarray of float64 with shape [batch_size, vocab_size]
+    """
+    log_probs_revised = apply_penalty(log_probs, frequency_list, config.frequency_penalty, config.presence_penalty)
+    temperature = getattr(config, 'temperature', 1.0)
+    dist = np.zeros(log_probs.shape, np.float64)
+    for row, (p, p_args) in enumerate(batch_sampler(log_probs_revised, config.top_p, config.top_k_num, temperature)):
+        dist[row, p_args] = p
+    return dist
+
+
+def _predict_positions(model, input_ids, valid_length, index):
+    """
+    Get the probabilities of the next tokens at the positions index with shape [batch_size, num_positions], and
+    return the probabilities with shape [batch_size, num_positions, vocab_size]
+    """
+    batch_size, seq_length = input_ids.shape
+    input_mask = (np.arange(seq_length) < valid_length[:, None]).astype(np.float32)
+    # The positions after the valid tokens are not used, keep them in the valid range
+    index = np.minimum(index, valid_length[:, None] - 1)
+    current_index = (np.arange(batch_size)[:, None] * seq_length + index).reshape(-1)
+    outputs = model.predict(Tensor(input_ids, mstype.int32), Tensor(input_mask, mstype.float32),
+                            Tensor(current_index, mstype.int32))
+    return outputs.asnumpy().reshape(batch_size, index.shape[1], -1)
+
+
+def generate_speculative(model,
+                         draft_model,
+                         end_token,
+                         origin_inputs,
+                         model_origin_max_length,
+                         max_generate_length,
+                         vocab_size,
+                         num_speculative_tokens=4,
+                         config=None,
+                         valid_length=None,
+                         padding_side='right',
+                         pad_token=0):
+    """
+    Text generation of a batch of prompts with speculative decoding
+
+    In each step, the small draft model proposes num_speculative_tokens tokens one by one, and the model scores
+    all of them in a single forward. The proposed token x is accepted with the probability min(1, p(x) / q(x)),
+    where p and q are the sampling distributions of the model and the draft model after the penalties, the
+    temperature and the top_k/top_p filters. At the first rejection, a token is sampled from the normalized
+    max(0, p - q) instead, and if all the tokens are accepted, one more token is sampled from the model. So the
+    generated text follows the same distribution as generate_batch with the model, while the model runs about
+    once for every accepted tokens + 1.
+
+    Both eval nets should be built in generate mode without use_past and the sampler, with the same batch size,
+    sequence length and vocabulary.
+
+    Inputs:
+        model: The model to run the prediction.
+        draft_model: The small model to propose the tokens, such as an OPT with 1-2 layers.
+        end_token(int): The model will stop generating the words when it reaches the end_token.
+        origin_inputs(Union[list, numpy.ndarray]): The prompts for generation, a list of id lists or a padded
+            array with shape [batch_size, length].
+        model_origin_max_length(int): The sequence length of the model trained.
+        max_generate_length(int):  The maximum of generated length.
+        vocab_size(int): The vocabulary length of the model.
+        num_speculative_tokens(int): The number of the tokens proposed by the draft model in each step.
+        config: Inference configurations.
+        valid_length(Union[list, numpy.ndarray]): The prompt length of each row of the padded origin_inputs.
+        padding_side(str): The side where the padded origin_inputs is padded, 'right' or 'left'.
+        pad_token(int): The id of the padding token.
+
+    Returns:
+        outputs: list of the ids for the generated text of each prompt
+        stats: dict of the proposed and accepted tokens, the acceptance rate and the number of the forwards
+    """
+    for net in (model.predict_network, draft_model.predict_network):
+        if getattr(net, 'use_past', False) or getattr(net, 'sampler', None) is not None:
+            raise ValueError("The speculative decoding needs the probabilities of the whole vocabulary at several "
+                             "positions, please build the eval nets without use_past and the sampler.")
+    if getattr(config, 'repetition_penalty', 1.0) != 1.0:
+        raise ValueError("The repetition_penalty is not supported by the speculative decoding yet.")
+    for item in (model, draft_model):
+        if isinstance(item, LengthBucketedModel):
+            item.select(model_origin_max_length)
+    num_tokens = num_speculative_tokens
+    input_ids, valid_length = pad_batch_inputs(origin_inputs, model_origin_max_length, valid_length,
+                                               padding_side, pad_token)
+    batch_size = input_ids.shape[0]
+    prompt_length = valid_length.copy()
+    target_length = np.minimum(valid_length + max_generate_length, model_origin_max_length)
+    frequency_list = np.zeros((batch_size, vocab_size), np.int32)
+    # The row stops without appending the token sampled at the position target_length - 1, as generate_batch
+    finished = valid_length >= target_length - 1
+    stats = {"proposed_tokens": 0, "accepted_tokens": 0, "model_forwards": 0, "draft_forwards": 0}
+
+    while not finished.all():
+        active = np.flatnonzero(~finished)
+        # The number of the tokens to propose for each row, no more than the tokens which can be appended
+        num_draft = np.where(finished, 0, np.minimum(num_tokens, target_length - 1 - valid_length))
+        draft_ids = input_ids.copy()
+        draft_length = valid_length.copy()
+        draft_frequency = np.zeros((batch_size, num_tokens + 1, vocab_size), np.int32)
+        draft_frequency[:, 0] = frequency_list
+        draft_tokens = np.zeros((batch_size, num_tokens), np.int32)
+        draft_dist = np.zeros((batch_size, num_tokens, vocab_size), np.float64)
+        for step in range(num_tokens):
+            rows = active[num_draft[active] > step]
+            if rows.size == 0:
+                break
+            probs = _predict_positions(draft_model, draft_ids, draft_length, draft_length[:, None] - 1)[:, 0]
+            stats["draft_forwards"] += 1
+            draft_dist[rows, step] = sampling_distribution(probs[rows], draft_frequency[rows, step], config)
+            draft_frequency[:, step + 1] = draft_frequency[:, step]
+            for row in rows:
+                token = np.random.choice(vocab_size, p=draft_dist[row, step])
+                draft_tokens[row, step] = token
+                draft_ids[row, draft_length[row]] = token
+                draft_length[row] += 1
+                draft_frequency[row, step + 1, token] += 1
+                # The tokens after the end_token are never used
+                if token == end_token:
+                    num_draft[row] = step + 1
+
+        # Score the proposed tokens and the token after them in a single forward of the model
+        probs = _predict_positions(model, draft_ids, draft_length,
+                                   valid_length[:, None] - 1 + np.arange(num_tokens + 1)[None, :])
+        stats["model_forwards"] += 1
+        dist = sampling_distribution(probs[active].reshape(-1, vocab_size),
+                                     draft_frequency[active].reshape(-1, vocab_size),
+                                     config).reshape(len(active), num_tokens + 1, vocab_size)
+        for i, row in enumerate(active):
+            new_tokens = []
+            for step in range(num_draft[row]):
+                token = draft_tokens[row, step]
+                p, q = dist[i, step, token], draft_dist[row, step, token]
+                stats["proposed_tokens"] += 1
+                if np.random.uniform() < min(1.0, p / q):
+                    stats["accepted_tokens"] += 1
+                    new_tokens.append(token)
+                    continue
+                residual = np.maximum(dist[i, step] - draft_dist[row, step], 0)
+                residual = residual / residual.sum() if residual.sum() > 0 else dist[i, step]
+                new_tokens.append(np.random.choice(vocab_size, p=residual))
+                break
+            else:
+                new_tokens.append(np.random.choice(vocab_size, p=dist[i, num_draft[row]]))
+            for token in new_tokens:
+                # Stop judgment
+                if token == end_token or valid_length[row] == target_length[row] - 1:
+                    finished[row] = True
+                    break
+                frequency_list[row, token] += 1
+                input_ids[row, valid_length[row]] = token
+                valid_length[row] += 1
+            if valid_length[row] >= target_length[row] - 1:
+                finished[row] = True
+
+    stats["acceptance_rate"] = stats["accepted_tokens"] / max(stats["proposed_tokens"], 1)
+    stats["tokens_per_model_forward"] = float(np.sum(valid_length - prompt_length)) / max(stats["model_forwards"], 1)
+    if config is not None and hasattr(config, 'logger'):
+        config.logger.info(f"The acceptance rate of the speculative decoding is {stats['acceptance_rate']}")
+    return [input_ids[row, :valid_length[row]] for row in range(batch_size)], stats
+
+
+def _length_penalty(length, length_penalty_weight):
+    """The length penalty of GNMT, ((5 + length) / 6) ^ weight"""
+    return np.power((5.0 + length) / 6.0, length_penalty_weight)
+
+
+def generate_beam_search(model,
+                         end_token,
+                         origin_inputs,
+                         model_origin_max_length,
+                         max_decode_length,
+                         vocab_size,
+                         beam_width=4,
+                         length_penalty_weight=1.0,
+                         valid_length=None,
+                         padding_side='right',
+                         pad_token=0,
+                         start_token=0,
+                         encoder_cache=None):
+    """
+    Beam search of a batch of source sequences for the encoder-decoder models such as T5
+
+    The encoder runs once on the source repeated for each beam and its output is reused by all the decoding steps.
+    As the beams of a source share the same encoder output, reordering the beams never needs to reorder the
+    encoder output. The eval net should be compiled with the batch size of batch_size * beam_width.
+
+    Inputs:
+        model: The model wrapping the T5 EvalNet in generate mode.
+        end_token(int): The hypothesis is finished when it generates the end_token.
+        origin_inputs(Union[list, numpy.ndarray]): The source ids, a list of id lists or a padded array with
+            shape [batch_size, length].
+        model_origin_max_length(int): The source sequence length of the model.
+        max_decode_length(int): The target sequence length of the model.
+        vocab_size(int): The vocabulary length of the model.
+        beam_width(int): The number of the beams for each source.
+        length_penalty_weight(float): The weight of the GNMT length penalty of the finished hypotheses.
+        valid_length(Union[list, numpy.ndarray]): The source length of each row of the padded origin_inputs.
+        padding_side(str): The side where the padded origin_inputs is padded, 'right' or 'left'.
+        pad_token(int): The id of the padding token.
+        start_token(int): The first input id of the decoder.
+        encoder_cache(EncoderOutputCache): The cache of the encoder outputs. Default: None.
+
+    Returns:
+        outputs: list of the ids of the best hypothesis of each source, starting with the start_token and
+        without the end_token
+    """
+    if getattr(model.predict_network, 'sampler', None) is not None:
+        raise ValueError("The beam search needs the probabilities of the whole vocabulary, "
+                         "please build the eval net without the sampler.")
+    if getattr(model.predict_network, 'use_past', False):
+        raise ValueError("The beam search reorders the beams at each step, which is not supported by the key/value "
+                         "cache, please build the eval net with use_past=False.")
+    input_ids, _ = pad_batch_inputs(origin_inputs, model_origin_max_length, valid_length, padding_side, pad_token)
+    batch_size = input_ids.shape[0]
+    num_rows = batch_size * beam_width
+    compiled_batch_size = getattr(getattr(model.predict_network, 'backbone', None), 'batch_size', num_rows)
+    if compiled_batch_size != num_rows:
+        raise ValueError(f"The eval net should be compiled with batch size {num_rows} = batch_size * beam_width, "
+                         f"but got {compiled_batch_size}.")
+
+    # Run the encoder once and reuse the output for all the steps
+    source_ids = np.repeat(input_ids, beam_width, axis=0)
+    source_mask = (source_ids != pad_token).astype(np.float32)
+    encoder_output = _predict_encoder(model, source_ids, source_mask, encoder_cache)
+    source_mask = Tensor(source_mask, mstype.float32)
+
+    target_ids = np.full((num_rows, max_decode_length), pad_token, np.int32)
+    target_ids[:, 0] = start_token
+    target_mask = np.zeros((num_rows, max_decode_length), np.float32)
+    target_mask[:, 0] = 1
+    # Only the first beam is alive at the beginning, so that the beams do not repeat the same candidates
+    scores = np.full((batch_size, beam_width), -np.inf)
+    scores[:, 0] = 0
+    hypotheses = [[] for _ in range(batch_size)]
+    done = np.zeros(batch_size, np.bool_)
+    batch_index = np.arange(batch_size)[:, None]
+
+    step = 1
+    while step < max_decode_length and not done.all():
+        current_index = Tensor(np.arange(num_rows) * max_decode_length + step - 1, mstype.int32)
+        probs = model.predict(None, source_mask, current_index, encoder_output, Tensor(target_ids, mstype.int32),
+                              Tensor(target_mask, mstype.float32))
+        with np.errstate(divide='ignore'):
+            log_probs = np.log(probs.asnumpy().reshape(batch_size, beam_width, vocab_size).astype(np.float64))
+
+        # Accumulate the log probs and keep 2 * beam_width candidates, so that at least beam_width of them
+        # do not end with the end_token
+        total = (scores[:, :, None] + log_probs).reshape(batch_size, -1)
+        candidate_scores, candidates = topk_fun(total, 2 * beam_width)
+        beam_source = candidates // vocab_size
+        tokens = candidates % vocab_size
+        is_end = tokens == end_token
+
+        # The end_token candidates ranked in the top beam_width finish the hypotheses
+        length_penalty = _length_penalty(step, length_penalty_weight)
+        for row, rank in zip(*np.nonzero(is_end[:, :beam_width])):
+            if done[row] or np.isneginf(candidate_scores[row, rank]):
+                continue
+            ids = target_ids[row * beam_width + beam_source[row, rank], :step].copy()
+            hypotheses[row].append((candidate_scores[row, rank] / length_penalty, ids))
+
+        # The best beam_width candidates which do not end are the next beams
+        keep = np.argsort(is_end, axis=-1, kind='stable')[:, :beam_width]
+        scores = np.take_along_axis(candidate_scores, keep, axis=-1)
+        beam_source = np.take_along_axis(beam_source, keep, axis=-1)
+        rows = (batch_index * beam_width + beam_source).reshape(-1)
+        target_ids = target_ids[rows]
+        target_ids[:, step] = np.take_along_axis(tokens, keep, axis=-1).reshape(-1)
+        target_mask[:, step] = 1
+
+        # A source is done when it has enough hypotheses and no alive beam can be better than them
+        for row in np.flatnonzero(~done):
+            if len(hypotheses[row]) >= beam_width:
+                worst = sorted(score for score, _ in hypotheses[row])[-beam_width]
+                done[row] = scores[row, 0] / length_penalty <= worst
+        step += 1
+
+    outputs = []
+    for row in range(batch_size):
+        if not done[row]:
+            # The decoding reaches max_decode_length before the source is done, so the alive beams are also
+            # the candidates
+            length_penalty = _length_penalty(step - 1, length_penalty_weight)
+            for beam in range(beam_width):
+                hypotheses[row].append((scores[row, beam] / length_penalty,
+                                        target_ids[row * beam_width + beam, :step]))
+        outputs.append(max(hypotheses[row], key=lambda x: x[0])[1])
     return outputs
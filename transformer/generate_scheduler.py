@@ -0,0 +1,259 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+"""
+Continuous batching scheduler for text generation
+"""
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+import numpy as np
+import mindspore.common.dtype as mstype
+from mindspore.common.tensor import Tensor
+
+from transformer.generate import SparsePenalty, sample_outputs, incremental_predict
+
+
+@dataclass
+class GenerationRequest:
+    """
+    A prompt waiting in the queue or running in a batch slot of the scheduler
+    """
+    request_id: int
+    input_ids: np.ndarray
+    max_generate_length: int
+    output_ids: np.ndarray = None
+    arrival_time: float = field(default_factory=time.time)
+    start_time: float = None
+    first_token_time: float = None
+    finish_time: float = None
+
+    @property
+    def latency(self):
+        """The time from the arrival to the finish of the request"""
+        if self.finish_time is None:
+            return None
+        return self.finish_time - self.arrival_time
+
+
+class ContinuousBatchScheduler:
+    """
+    Generate the queued prompts in the fixed batch of the eval net, and admit a new prompt into a batch slot as
+    soon as the sequence in the slot finishes instead of waiting for the whole batch to drain.
+
+    The input ids, masks, positions and generated tokens for the penalties are kept per slot. Without the
+    key/value cache, a slot is refilled by overwriting its row. With use_past=True, the cache of all the slots is
+    rebuilt by the prefill graph in the step after new prompts are admitted, as the graph resets the cache of the
+    whole batch, and the other steps run the decode graph. The number of these prefills is reported by stats, as
+    each of them processes the whole padded batch.
+
+    Args:
+        model(Model): The model wrapping the GPT or OPT EvalNet in generate mode.
+        batch_size(int): The batch size which the eval net is compiled with.
+        seq_length(int): The sequence length of the model.
+        vocab_size(int): The vocabulary length of the model.
+        end_token(int): The sequence stops when it generates the end_token.
+        config: Inference configurations used by the sampler.
+        max_generate_length(int): The default maximum of generated length for each request. Default: seq_length.
+        pad_token(int): The id to fill the free slots. Default: 0.
+    """
+    def __init__(self, model, batch_size, seq_length, vocab_size, end_token, config,
+                 max_generate_length=None, pad_token=0):
+        self.model = model
+        self.batch_size = batch_size
+        self.seq_length = seq_length
+        self.vocab_size = vocab_size
+        self.end_token = end_token
+        self.config = config
+        self.max_generate_length = seq_length if max_generate_length is None else max_generate_length
+        self.pad_token = pad_token
+        self.use_past = getattr(model.predict_network, 'use_past', False)
+        self.sample_on_device = getattr(model.predict_network, 'sampler', None) is not None
+        self.use_frequency_list = self.sample_on_device and \
+            getattr(model.predict_network.sampler, 'use_frequency_list', True)
+        self.penalty = SparsePenalty.from_config(batch_size, vocab_size, config)
+        if self.sample_on_device and self.penalty.repetition_penalty != 1.0:
+            raise ValueError("The repetition_penalty is not supported by the sampler of the eval net, please set "
+                             "sample_on_device=False to use it.")
+
+        self.queue = deque()
+        self.slots = [None] * batch_size
+        self.finished = []
+        self.num_requests = 0
+        self.num_steps = 0
+        self.num_prefills = 0
+        self.need_prefill = True
+
+        self.input_ids = np.full((batch_size, seq_length), pad_token, np.int32)
+        self.input_mask = np.zeros((batch_size, seq_length), np.int32)
+        self.valid_length = np.ones(batch_size, np.int32)
+        self.target_length = np.ones(batch_size, np.int32)
+
+    @property
+    def queue_depth(self):
+        """The number of the requests waiting for a free slot"""
+        return len(self.queue)
+
+    @property
+    def slot_occupancy(self):
+        """The ratio of the slots running a request"""
+        return sum(slot is not None for slot in self.slots) / self.batch_size
+
+    def add_request(self, input_ids, max_generate_length=None):
+        """
+        Put a prompt into the queue
+
+        Args:
+            input_ids(Union[list, numpy.ndarray]): The ids of the prompt.
+            max_generate_length(int): The maximum of generated length. Default: the one of the scheduler.
+
+        Returns:
+            request_id: int, the id to find the request in the finished results
+        """
+        input_ids = np.asarray(input_ids, np.int32).reshape(-1)
+        if not 0 < input_ids.shape[0] <= self.seq_length:
+            raise ValueError(f"The prompt length should be in (0, {self.seq_length}], but got {input_ids.shape[0]}.")
+        if max_generate_length is None:
+            max_generate_length = self.max_generate_length
+        request = GenerationRequest(self.num_requests, input_ids, max_generate_length)
+        self.num_requests += 1
+        self.queue.append(request)
+        return request.request_id
+
+    def _reset_slot(self, slot):
+        """Fill the slot with a single padding token so that it still gives a valid row to the graph"""
+        self.slots[slot] = None
+        self.input_ids[slot] = self.pad_token
+        self.input_mask[slot] = 0
+        self.input_mask[slot, 0] = 1
+        self.valid_length[slot] = 1
+        self.target_length[slot] = 1
+        self.penalty.reset(slot)
+
+    def _admit(self):
+        """Move the queued requests into the free slots"""
+        now = time.time()
+        for slot in range(self.batch_size):
+            if not self.queue:
+                break
+            if self.slots[slot] is not None:
+                continue
+            request = self.queue.popleft()
+            length = request.input_ids.shape[0]
+            self._reset_slot(slot)
+            self.slots[slot] = request
+            self.input_ids[slot, :length] = request.input_ids
+            self.input_mask[slot, :length] = 1
+            self.valid_length[slot] = length
+            self.penalty.add_prompt(slot, request.input_ids)
+            self.target_length[slot] = min(length + request.max_generate_length, self.seq_length)
+            request.start_time = now
+            self.need_prefill = True
+
+    def _finish(self, slot):
+        """Record the outputs of the slot and free it"""
+        request = self.slots[slot]
+        request.output_ids = self.input_ids[slot, :self.valid_length[slot]].copy()
+        request.finish_time = time.time()
+        self.finished.append(request)
+        self._reset_slot(slot)
+
+    def _predict(self):
+        """Run a single inference over the whole batch"""
+        extra_inputs = (Tensor(self.penalty.dense(), mstype.int32),) if self.use_frequency_list else ()
+        if self.use_past:
+            self.num_prefills += int(self.need_prefill)
+            outputs = incremental_predict(self.model, self.input_ids, self.input_mask, self.valid_length,
+                                          self.need_prefill, *extra_inputs)
+        else:
+            current_index = np.arange(self.batch_size) * self.seq_length + self.valid_length - 1
+            inputs = (Tensor(self.input_ids, mstype.int32), Tensor(self.input_mask, mstype.float32),
+                      Tensor(current_index, mstype.int32))
+            if self.sample_on_device:
+                inputs += (True, None) + extra_inputs
+            outputs = self.model.predict(*inputs)
+        self.need_prefill = False
+        return outputs
+
+    def step(self):
+        """
+        Admit the queued requests and generate one token for each running slot
+
+        Returns:
+            finished: list of GenerationRequest finished in this step
+        """
+        self._admit()
+        active = np.array([slot for slot in range(self.batch_size) if self.slots[slot] is not None], np.int32)
+        finished_num = len(self.finished)
+        # The slots whose prompt already reaches the target length finish without running the model
+        for slot in active[self.valid_length[active] >= self.target_length[active]]:
+            self._finish(slot)
+        active = active[self.valid_length[active] < self.target_length[active]]
+        if active.size == 0:
+            return self.finished[finished_num:]
+
+        outputs = self._predict()
+        self.num_steps += 1
+        now = time.time()
+        targets = sample_outputs(outputs, active, self.penalty, self.config)
+        for slot, target in zip(active, targets):
+            request = self.slots[slot]
+            if request.first_token_time is None:
+                request.first_token_time = now
+            # Stop judgment
+            if target == self.end_token or self.valid_length[slot] == self.target_length[slot] - 1:
+                self._finish(slot)
+                continue
+            self.penalty.add(slot, target)
+            self.input_ids[slot, self.valid_length[slot]] = target
+            self.input_mask[slot, self.valid_length[slot]] = 1
+            self.valid_length[slot] += 1
+        return self.finished[finished_num:]
+
+    def run(self):
+        """
+        Run the steps until the queue and the slots are empty
+
+        Returns:
+            outputs: list of the generated ids of all the finished requests ordered by the request id
+        """
+        while self.queue or any(slot is not None for slot in self.slots):
+            self.step()
+        return [request.output_ids for request in sorted(self.finished, key=lambda x: x.request_id)]
+
+    def stats(self):
+        """
+        Get the statistics of the scheduler
+
+        Returns:
+            stats: dict of the queue depth, slot occupancy, the number of the steps and the prefills, and the latency
+            percentiles
+        """
+        latency = np.array([request.latency for request in self.finished])
+        first_token = np.array([request.first_token_time - request.arrival_time for request in self.finished
+                                if request.first_token_time is not None])
+        stats = {"queue_depth": self.queue_depth,
+                 "slot_occupancy": self.slot_occupancy,
+                 "num_steps": self.num_steps,
+                 "num_prefills": self.num_prefills,
+                 "num_finished": len(self.finished)}
+        if latency.size:
+            stats["latency_mean"] = float(np.mean(latency))
+            stats["latency_p50"] = float(np.percentile(latency, 50))
+            stats["latency_p99"] = float(np.percentile(latency, 99))
+        if first_token.size:
+            stats["first_token_latency_p50"] = float(np.percentile(first_token, 50))
+        return stats
@@ -0,0 +1,159 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+"""
+Sequence length bucketed eval nets for prediction and generation
+"""
+import bisect
+import time
+
+from mindspore.common.tensor import Tensor
+from mindspore.train.model import Model
+
+
+def share_parameters(network, source):
+    """
+    Let the network use the parameters of the source network with the same names and shapes, so that the eval
+    nets of different sequence lengths keep a single copy of the weights. The parameters whose shape depends on
+    the sequence length, such as the position embedding of GPT, are copied from the leading rows of the source,
+    and the key/value cache of each network is kept.
+    """
+    source_params = dict(source.parameters_and_names())
+    for _, cell in network.cells_and_names():
+        for name, param in list(cell.parameters_dict(recurse=False).items()):
+            shared = source_params.get(param.name)
+            if shared is None or param.name.endswith(('key_past', 'value_past')):
+                continue
+            if shared.shape == param.shape:
+                setattr(cell, name, shared)
+            elif len(shared.shape) == len(param.shape) and shared.shape[1:] == param.shape[1:]:
+                param.set_data(Tensor(shared.asnumpy()[:param.shape[0]], param.dtype))
+
+
+class LengthBucketedModel:
+    """
+    Run the eval net compiled with the smallest sequence length bucket which fits the inputs, instead of always
+    padding the inputs to the sequence length of the model. The eval net of a bucket is built and compiled when
+    the bucket is used for the first time, and shares the weights of the eval net of the full sequence length.
+
+    The model is used in the same way as the Model wrapping the eval net, and the callers select the bucket by
+    the length of the inputs before each prediction and slice the inputs to the length of the bucket. The first
+    call of each graph of a bucket is counted as a compile, and its time is recorded apart from the time of the
+    other calls.
+
+    Args:
+        network(Cell): The eval net with the full sequence length.
+        build_network(Callable): Build the eval net with the given sequence length.
+        bucket_list(list): The sequence lengths of the buckets, such as [128, 256, 512]. The full sequence length
+            is always the last bucket.
+        seq_length(int): The sequence length of the network.
+    """
+    def __init__(self, network, build_network, bucket_list, seq_length):
+        self.build_network = build_network
+        self.seq_length = seq_length
+        self.bucket_list = sorted({int(item) for item in bucket_list if 0 < int(item) < seq_length}) + [seq_length]
+        self.networks = {seq_length: network}
+        self.models = {seq_length: Model(network)}
+        self.bucket = seq_length
+        self.compiled = set()
+        self.num_compiles = 0
+        self.compile_time = {}
+        self.run_time = {}
+        self.num_calls = {}
+
+    @property
+    def predict_network(self):
+        """The eval net of the selected bucket"""
+        return self.networks[self.bucket]
+
+    def bucket_for(self, length):
+        """
+        Find the smallest bucket which is not shorter than the length
+
+        Args:
+            length(int): The length of the inputs.
+
+        Returns:
+            bucket: int, the sequence length of the bucket
+        """
+        i = bisect.bisect_left(self.bucket_list, length)
+        if i == len(self.bucket_list):
+            raise ValueError(f"The length {length} exceeds the sequence length {self.seq_length} of the model.")
+        return self.bucket_list[i]
+
+    def select(self, length):
+        """
+        Select the smallest bucket which fits the length and build its eval net if it is not built yet
+
+        Args:
+            length(int): The length of the inputs.
+
+        Returns:
+            bucket: int, the sequence length of the selected bucket
+        """
+        bucket = self.bucket_for(length)
+        if bucket not in self.networks:
+            network = self.build_network(bucket)
+            share_parameters(network, self.networks[self.seq_length])
+            network.set_train(False)
+            self.networks[bucket] = network
+            self.models[bucket] = Model(network)
+        self.bucket = bucket
+        return bucket
+
+    def predict(self, *inputs):
+        """Run the eval net of the selected bucket"""
+        # The prefill and the decode graphs of use_past are compiled separately
+        graph = (self.bucket, getattr(self.predict_network, 'is_first_iteration', True))
+        start = time.time()
+        outputs = self.models[self.bucket].predict(*inputs)
+        cost = time.time() - start
+        if graph not in self.compiled:
+            self.compiled.add(graph)
+            self.num_compiles += 1
+            self.compile_time[self.bucket] = self.compile_time.get(self.bucket, 0.0) + cost
+        else:
+            self.run_time[self.bucket] = self.run_time.get(self.bucket, 0.0) + cost
+            self.num_calls[self.bucket] = self.num_calls.get(self.bucket, 0) + 1
+        return outputs
+
+    def stats(self):
+        """
+        Get the statistics of the buckets
+
+        Returns:
+            stats: dict of the number of the compiles, and the compile time, the number of the calls and the time of
+            the calls after the compile for each bucket
+        """
+        return {"num_compiles": self.num_compiles,
+                "buckets": {bucket: {"compile_time": self.compile_time.get(bucket, 0.0),
+                                     "num_calls": self.num_calls.get(bucket, 0),
+                                     "run_time": self.run_time.get(bucket, 0.0)}
+                            for bucket in self.bucket_list if bucket in self.networks}}
+
+
+def build_length_bucketed_model(opt, network, build_network, seq_length):
+    """
+    Return the LengthBucketedModel if the bucket_list is set, else the Model wrapping the network
+
+    Only the decoder-only models, GPT and OPT, select the buckets, and the other models always run the network.
+    """
+    bucket_list = getattr(opt, 'bucket_list', None)
+    if isinstance(bucket_list, str):
+        # The bucket list passed from the command line, such as --bucket_list=128,256,512
+        bucket_list = [item for item in bucket_list.split(',') if item.strip()]
+    if not bucket_list:
+        return Model(network)
+    return LengthBucketedModel(network, build_network, bucket_list, seq_length)
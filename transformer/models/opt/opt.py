@@ -20,6 +20,7 @@ from dataclasses import dataclass
 import numpy as np
 import mindspore.nn as nn
 import mindspore.common.dtype as mstype
+from mindspore.common.tensor import Tensor
 from mindspore.common.initializer import TruncatedNormal, initializer
 from mindspore.ops import operations as P
 from mindspore.ops import functional as F
@@ -29,6 +30,9 @@ from mindspore.nn.transformer.layers import _LayerNorm, _Linear
 from mindspore.nn.transformer.transformer import AttentionMask, Transformer, VocabEmbedding
 from mindspore.nn.transformer.loss import CrossEntropyLoss
 
+from transformer.modules.sampling import build_sampler
+from transformer.modules.scoring import TokenLogProbs
+
 
 @dataclass
 class OPTConfig:
@@ -48,6 +52,7 @@ class OPTConfig:
     layernorm_dtype: mstype = mstype.float32
     softmax_dtype: mstype = mstype.float16
     hidden_act: str = 'relu'
+    use_past: bool = False
     parallel_config: TransformerOpParallelConfig = default_transformer_config
 
 
@@ -60,8 +65,11 @@ class OPTModel(nn.Cell):
 
     Inputs:
         input_ids: the tokenized inputs with datatype int32
-        input_mask: the mask indicating whether each position is a valid input
-        layer_past: the previous feature map
+        input_mask: the mask indicating whether each position is a valid input, or the attention mask with
+            shape [bs, seq_length, seq_length]
+        input_position: the position of each input token. If None, it is set to be range(seq_length)
+        init_reset: False to reset the key/value cache and True to reuse it, only used when use_past is True
+        batch_valid_length: the number of the cached tokens, only used when use_past is True
 
     Returns:
         output_state: Tensor, the output logit of backbone
@@ -106,9 +114,11 @@ class OPTModel(nn.Cell):
                                        layernorm_compute_type=config.layernorm_dtype,
                                        softmax_compute_type=config.softmax_dtype,
                                        num_heads=config.num_heads,
+                                       use_past=config.use_past,
                                        parallel_config=config.parallel_config,
                                        moe_config=moe_config)
         self.use_moe = (moe_config.expert_num > 1)
+        self.use_past = config.use_past
         self.layernorm = _LayerNorm((config.hidden_size,)).to_float(config.layernorm_dtype)
         self.layernorm.shard(((config.parallel_config.data_parallel, 1, 1),))
         self.add = P.Add().shard(
@@ -116,25 +126,31 @@ class OPTModel(nn.Cell):
         self.position_add = P.Add().shard(((config.parallel_config.data_parallel, 1), ()))
         self.position_bias = 2
 
-    def construct(self, input_ids, input_mask):
+    def construct(self, input_ids, input_mask, input_position=None, init_reset=True, batch_valid_length=None):
         """OPT model"""
         input_embedding, embedding_table = self.word_embedding(input_ids)
 
         batch_size, seq_length = F.shape(input_ids)
-        input_position = F.tuple_to_array(F.make_range(seq_length))
-        input_position = P.Tile()(input_position, (batch_size, 1))
+        if input_position is None:
+            input_position = F.tuple_to_array(F.make_range(seq_length))
+            input_position = P.Tile()(input_position, (batch_size, 1))
 
         input_position = self.position_add(input_position, self.position_bias)
         position_embedding, _ = self.position_embedding(input_position)
         hidden_states = self.add(input_embedding, position_embedding)
 
         hidden_states = P.Cast()(hidden_states, mstype.float16)
-        attention_mask = self.get_attention_mask(input_mask)
+        if len(F.shape(input_mask)) == 2:
+            attention_mask = self.get_attention_mask(input_mask)
+        else:
+            attention_mask = input_mask
         moe_loss = 0
         if self.use_moe:
-            hidden_states, present_layer, _, moe_loss = self.transformer(hidden_states, attention_mask)
+            hidden_states, present_layer, _, moe_loss = self.transformer(hidden_states, attention_mask, None, None,
+                                                                         None, init_reset, batch_valid_length)
         else:
-            hidden_states, present_layer, _ = self.transformer(hidden_states, attention_mask)
+            hidden_states, present_layer, _ = self.transformer(hidden_states, attention_mask, None, None, None,
+                                                               init_reset, batch_valid_length)
         output_state = self.layernorm(hidden_states)
         if self.use_moe:
             return output_state, present_layer, embedding_table, moe_loss
@@ -183,10 +199,15 @@ class OPT(nn.Cell):
     Inputs:
         input_ids: the tokenized inputs
         input_mask: the mask indicating whether each position is a valid input
-        past: the previous feature map
+        input_position: the position of each input token. If None, it is set to be range(seq_length)
+        init_reset: False to reset the key/value cache and True to reuse it, only used when use_past is True
+        batch_valid_length: the number of the cached tokens, only used when use_past is True
+        current_index: the index of the positions in the flattened [bs * seq_length] output to compute the
+            logits. If None, the logits of all the positions are returned.
 
     Returns:
-        logits: Tensor: the logits of the corresponding inputs with shape (batch_size, seq_length, vocab_size)
+        logits: Tensor: the logits of the corresponding inputs with shape (batch_size * seq_length, vocab_size),
+            or (len(current_index), vocab_size) if current_index is given
     """
     def __init__(self, config):
         super(OPT, self).__init__()
@@ -194,16 +215,31 @@ class OPT(nn.Cell):
         self.head = OPTHead(config.hidden_size, parallel_config=config.parallel_config,
                             vocab_size=config.vocab_size)
         self.use_moe = self.backbone.use_moe
+        self.use_past = self.backbone.use_past
+        self.seq_length = config.seq_length
+        self.hidden_size = config.hidden_size
+        self.gather = P.Gather()
 
-    def construct(self, input_ids, input_mask):
+    def construct(self, input_ids, input_mask, input_position=None, init_reset=True, batch_valid_length=None,
+                  current_index=None):
         if self.use_moe:
-            output_states, _, _, moe_loss = self.backbone(input_ids, input_mask)
+            output_states, _, _, moe_loss = self.backbone(input_ids, input_mask, input_position, init_reset,
+                                                          batch_valid_length)
+            output_states = self.gather_states(output_states, current_index)
             logits = self.head(output_states)
             return logits, moe_loss
-        output_states, _, _ = self.backbone(input_ids, input_mask)
+        output_states, _, _ = self.backbone(input_ids, input_mask, input_position, init_reset, batch_valid_length)
+        output_states = self.gather_states(output_states, current_index)
         logits = self.head(output_states)
         return logits
 
+    def gather_states(self, output_states, current_index):
+        """Only keep the hidden states of the positions to predict, so the head skips the other positions"""
+        if current_index is None:
+            return output_states
+        output_states = F.reshape(output_states, (-1, self.hidden_size))
+        return self.gather(output_states, current_index, 0)
+
 
 class OPTWithLoss(nn.Cell):
     """
@@ -257,34 +293,66 @@ class EvalNet(nn.Cell):
     Args:
         backbone: backbone network of OPT2/3
         generate: enable generate mode
+        sampler: the cell to select the sampling candidates in the graph in generate mode, such as TopKSampler,
+            or the tokens, such as ArgmaxSampler. If None, return the probabilities of the whole vocabulary.
+            Default: None
+        score: return the log probabilities of the label tokens instead of the argmax when the generate mode is
+            disabled. Default: False
 
     Inputs:
         input_ids: the tokenized inpus
+        input_mask: the mask indicating whether each position is a valid input
+        current_index: the index of the positions to predict in the flattened [bs * seq_length] logits, usually
+            one for each row, only used in the generate mode
+        init_reset: False to reset the key/value cache and True to reuse it, only used when use_past is True
+        batch_valid_length: the number of the valid tokens for the first iteration, or the position of the
+            input token for the incremental iterations, only used when use_past is True
+        frequency_list: the count of each generated token with shape [bs, vocab_size], only used by the sampler
+        label_ids: the token to score at each position with shape [bs, seq_length], only used in the score mode
+        label_mask: 1 for the positions to score with shape [bs, seq_length], only used in the score mode
 
     Returns:
         outputs: Tensor, corresponding output for different tasks
     """
-    def __init__(self, backbone, generate=False):
+    def __init__(self, backbone, generate=False, sampler=None, score=False):
         super(EvalNet, self).__init__(auto_prefix=False)
         self.backbone = backbone
+        self.sampler = sampler
         self.argmax = P.Argmax()
         self.generate = generate
+        self.score = score
+        self.token_log_probs = TokenLogProbs()
         self.cast = P.Cast()
-        self.gather = P.Gather()
+        self.use_past = backbone.use_past
+        # The flag is switched by add_flags_recursive to compile the prefill graph and the decode graph
+        self.is_first_iteration = True
+        self.all_ones_attention_mask = Tensor(np.ones((1, 1, backbone.seq_length)), mstype.float32)
 
-    def construct(self, input_ids, input_mask, current_index):
+    def construct(self, input_ids, input_mask, current_index=None, init_reset=True, batch_valid_length=None,
+                  frequency_list=None, label_ids=None, label_mask=None):
         """evaluation net"""
         input_mask = self.cast(input_mask, mstype.float32)
-        logits = self.backbone(input_ids, input_mask)
+        input_position = None
+        if self.use_past and not self.is_first_iteration:
+            # The decode graph only takes the latest token, whose position is given by batch_valid_length
+            batch_size = F.shape(input_ids)[0]
+            input_position = F.reshape(batch_valid_length, (batch_size, 1))
+            input_mask = P.Tile()(self.all_ones_attention_mask, (batch_size, 1, 1))
         outputs = None
         if self.generate:
-            # we  only need to softmax the target word's logits
-            index = current_index.view(1,)
-            logits = self.gather(logits, index, 0)
-            logits = logits.view(F.shape(input_ids)[0], 1, -1)
+            # we  only need to compute and softmax the target word's logits
+            index = current_index.view(-1,)
+            logits = self.backbone(input_ids, input_mask, input_position, init_reset, batch_valid_length, index)
+            if self.sampler is not None:
+                return self.sampler(logits, frequency_list)
+            # The softmax is applied to each predicted position, which can be more than one for each row
+            logits = logits.view(F.shape(index)[0], 1, -1)
             outputs = nn.LogSoftmax()(logits)
             outputs = F.tensor_pow(np.e, outputs)
         else:
+            logits = self.backbone(input_ids, input_mask, input_position, init_reset, batch_valid_length)
+            if self.score:
+                return self.token_log_probs(logits, label_ids, label_mask)
             outputs = self.argmax(logits)
         return outputs
 
@@ -296,7 +364,7 @@ def get_opt_network(opt, model_config):
     net = OPT(model_config)
     if opt.eval:
         opt.logger.info("Detect the eval is True, return the eval net")
-        net = EvalNet(net, generate=opt.generate)
+        net = EvalNet(net, generate=opt.generate, sampler=build_sampler(opt), score=getattr(opt, 'score', False))
         return net
     loss = CrossEntropyLoss(model_config.parallel_config.dp_mp_config)
     net_with_loss = OPTWithLoss(net, loss, model_config.parallel_config)
@@ -16,6 +16,7 @@
 """OPT Predict"""
 from transformer.models.opt import OPTConfig, OPT, EvalNet
 from transformer.trainer import Trainer, TrainingConfig, parse_config
+from transformer.modules.sampling import build_sampler
 from transformer.data import create_wiki_dataset
 
 
@@ -36,7 +37,13 @@ class OPTTrainingConfig(TrainingConfig):
         self.ckpt_path = "./converted_mindspore_opt.ckpt"
         self.vocab_path = "./vocab.json"
         self.input_samples = "Hello world"
+        self.input_file = ""
+        self.output_file = "./outputs.jsonl"
         self.generate = True
+        self.sample_on_device = False
+        self.greedy = False
+        self.use_past = False
+        self.bucket_list = ""
         self.device_target = "Ascend"
 
 
@@ -46,12 +53,12 @@ class OPTPredict(Trainer):
     """
 
     def build_model_config(self):
-        model_config = OPTConfig()
+        model_config = OPTConfig(use_past=self.config.use_past)
         return model_config
 
     def build_model(self, model_config):
         net = OPT(model_config)
-        net = EvalNet(net, generate=self.config.generate)
+        net = EvalNet(net, generate=self.config.generate, sampler=build_sampler(self.config))
         return net
 
     def build_dataset(self, training_config, device_num, rank):
@@ -449,6 +449,8 @@ class T5MultiHeadAttention(Cell):
             self.tile = P.Tile().shard(((1, 1, 1, 1),))
             self.less = P.Less().shard(((1, 1, 1), (1, 1, 1)))
             self.mul1 = P.Mul().shard(((1, 1, 1, 1), (1, 1, 1, 1)))
+            self.bias_gather = P.Gather()
+            self.bias_transpose = P.Transpose()
 
     def construct(self, query_tensor, key_tensor, value_tensor, attention_mask, bias=None, key_past=None,
                   value_past=None, batch_valid_length=None):
@@ -461,29 +463,34 @@ class T5MultiHeadAttention(Cell):
                                                                                                    attention_mask)
         ori_dtype = F.dtype(query_tensor)
         query_tensor = F.cast(query_tensor, self.dtype)
-        key_tensor = F.cast(key_tensor, self.dtype)
-        value_tensor = F.cast(value_tensor, self.dtype)
         # multi head attention: query, key, value are derived from the same inputs
         query = self.dense1(query_tensor)
-        key = self.dense2(key_tensor)
-        value = self.dense3(value_tensor)
         # the returned shape is [bs, num_heads, seq_length, size_per_head]
         query = self.transpose(
             F.reshape(
                 query,
                 (batch_size, -1, self.n_head, self.size_per_head)),
             (0, 2, 1, 3))
-        # the returned shape is [bs, size_per_head, seq_length, num_heads]
-        key = self.transpose(
-            F.reshape(
-                key, (batch_size, -1, self.n_head, self.size_per_head)),
-            (0, 2, 3, 1))
-        # the returned shape is [bs, num_heads, seq_length, size_per_head]
-        value = self.transpose(
-            F.reshape(
-                value,
-                (batch_size, -1, self.n_head, self.size_per_head)),
-            (0, 2, 1, 3))
+        if self.use_past and self.cross_attention and not self.is_first_iteration:
+            # The keys and values of the encoder output are computed once by the first iteration
+            key = key_past
+            value = value_past
+        else:
+            key_tensor = F.cast(key_tensor, self.dtype)
+            value_tensor = F.cast(value_tensor, self.dtype)
+            key = self.dense2(key_tensor)
+            value = self.dense3(value_tensor)
+            # the returned shape is [bs, size_per_head, seq_length, num_heads]
+            key = self.transpose(
+                F.reshape(
+                    key, (batch_size, -1, self.n_head, self.size_per_head)),
+                (0, 2, 3, 1))
+            # the returned shape is [bs, num_heads, seq_length, size_per_head]
+            value = self.transpose(
+                F.reshape(
+                    value,
+                    (batch_size, -1, self.n_head, self.size_per_head)),
+                (0, 2, 1, 3))
         # support input shape is [bs, seq, seq] or [bs, heads, seq, seq]
         if len(F.shape(attention_mask)) == 3:
             # expand attention mask from [bs, seq, seq] -> [bs, 1, seq, seq]
@@ -491,7 +498,7 @@ class T5MultiHeadAttention(Cell):
         # key and value for current token(s)
         key_present = key
         value_present = value
-        if self.use_past:
+        if self.use_past and not self.cross_attention:
             # The first graph with the input size of (bs, seq_length)
             if self.is_first_iteration:
                 # Get the valid input length without padding
@@ -528,7 +535,7 @@ class T5MultiHeadAttention(Cell):
         layer_present = (key_present, value_present)
         # multi head attention considering attention mask
         # the return shape is [bs * seq_length, hidden_size]
-        attention, bias = self._attn(query, key, value, attention_mask, bias)
+        attention, bias = self._attn(query, key, value, attention_mask, bias, batch_valid_length)
         # Output
         output = self.projection(attention)
         output = self.dropout(output)
@@ -551,6 +558,11 @@ class T5MultiHeadAttention(Cell):
                                 [self.batch_size * self.tgt_seq_length, self.hidden_size]])
             _check_shape_equal(F.shape(attention_mask), "attention_mask", self.cls_name,
                                [self.batch_size, self.src_seq_length, self.tgt_seq_length])
+        elif self.cross_attention:
+            _check_shape_equal(F.shape(query_tensor), "query_tensor", self.cls_name,
+                               [[self.batch_size, 1, self.hidden_size], [self.batch_size, self.hidden_size]])
+            _check_shape_equal(F.shape(attention_mask), "attention_mask", self.cls_name,
+                               [self.batch_size, 1, self.tgt_seq_length])
         else:
             _check_shape_equal(F.shape(query_tensor), "query_tensor", self.cls_name,
                                [[self.batch_size, 1, self.hidden_size], [self.batch_size, self.hidden_size]])
@@ -634,7 +646,7 @@ class T5MultiHeadAttention(Cell):
             attention_probs = F.reshape(attention_probs, shape)
         return attention_probs
 
-    def _attn(self, query, key, value, attention_mask, bias):
+    def _attn(self, query, key, value, attention_mask, bias, batch_valid_length=None):
         """
         Get the weighted score along the seq_length
 
@@ -644,6 +656,8 @@ class T5MultiHeadAttention(Cell):
             value: the value matrix
             attention_mask: the attention mask matrix with shape (batch_size,
             1, seq_length, seq_length)
+            bias: the position bias shared by the layers, or None to compute it in this layer
+            batch_valid_length: the position of the query of each row in the incremental iterations
         Outputs:
             weighted_values: Tensor, the weighted sum scores
         """
@@ -656,7 +670,7 @@ class T5MultiHeadAttention(Cell):
 
         # for input size of (bs, 1) namely the second graph,
         # the shape of attention_mask matrix should be (bs, 1, 1, seq_length)
-        if self.use_past and not self.is_first_iteration:
+        if self.use_past and not self.is_first_iteration and not self.cross_attention:
             # Calculate the current total token
             current_index = self.reducesum(F.cast(self.not_equal(self.slice(key, (0, 0, 0, 0),
                                                                             (F.shape(query)[0], 1, 1, self.seq_length),
@@ -673,6 +687,9 @@ class T5MultiHeadAttention(Cell):
                 bias = self.bias_generator(self.src_seq_length, self.tgt_seq_length)
             elif self.cross_attention:
                 bias = P.ExpandDims()(self.cross_bias, 0)
+            if self.use_past and not self.is_first_iteration:
+                # Keep the bias of the query position of each row, [1, heads, seq, tgt] -> [bs, heads, 1, tgt]
+                bias = self.bias_transpose(self.bias_gather(bias, batch_valid_length, 2), (2, 1, 0, 3))
 
         score = self.add(score, bias)
         # Minus 10000 for the position where masked to exclude them from softmax
@@ -842,7 +859,7 @@ class TransformerEncoderLayer(Cell):
         key_update = None
         if self.use_past:
             # current key and value
-            key_present, value_present = layer_present
+            key_present, value_present = layer_present[0], layer_present[1]
             # update key and value calculated this step
             key_update = self.assign(self.key_past, key_present)
             value_update = self.assign(self.value_past, value_present)
@@ -946,9 +963,10 @@ class TransformerDecoderLayer(Cell):
                              .format(ffn_hidden_size, parallel_config.model_parallel))
         _check_moe_config(moe_config, parallel_config)
         self.use_moe = (moe_config.expert_num > 1)
-        if use_past:
-            raise ValueError(f"The {self.cls_name} does not support use_past=True.")
+        if use_past and self.use_moe:
+            raise ValueError(f"The {self.cls_name} does not support use_past=True with MoE.")
         self.batch_size = batch_size
+        self.is_first_iteration = True
         self.use_past = use_past
         self.softmax_compute_type = softmax_compute_type
 
@@ -1029,6 +1047,14 @@ class TransformerDecoderLayer(Cell):
             # parameters saving key and value states
             self.key_past = Parameter(Tensor(np.zeros(shape=self.key_shape), self.dtype), name="key_past")
             self.value_past = Parameter(Tensor(np.zeros(shape=self.value_shape), self.dtype), name="value_past")
+            # parameters saving the keys and values of the encoder output for the cross attention, which are
+            # computed by the first iteration and reused by the following ones
+            self.cross_key_shape = (batch_size, num_heads, size_per_head, src_seq_length)
+            self.cross_value_shape = (batch_size, num_heads, src_seq_length, size_per_head)
+            self.cross_key_past = Parameter(Tensor(np.zeros(shape=self.cross_key_shape), self.dtype),
+                                            name="cross_key_past")
+            self.cross_value_past = Parameter(Tensor(np.zeros(shape=self.cross_value_shape), self.dtype),
+                                              name="cross_value_past")
             self.tile = P.Tile().shard(((1, 1),))
             self.mul = P.Mul().shard(((1, 1, 1, 1), (1,)))
             self.assign = P.Assign().shard(((1, 1, 1, 1), (1, 1, 1, 1)))
@@ -1079,8 +1105,8 @@ class TransformerDecoderLayer(Cell):
                                                                                                encoder_output,
                                                                                                memory_mask,
                                                                                                encoder_attention_bias,
-                                                                                               self.key_past,
-                                                                                               self.value_past,
+                                                                                               self.cross_key_past,
+                                                                                               self.cross_value_past,
                                                                                                batch_valid_length)
             layer_present += cross_layer_present
             if self.post_layernorm_residual:
@@ -1100,13 +1126,17 @@ class TransformerDecoderLayer(Cell):
         key_update = None
         if self.use_past:
             # current key and value
-            key_present, value_present = layer_present
+            key_present, value_present = layer_present[0], layer_present[1]
             # update key and value calculated this step
             key_update = self.assign(self.key_past, key_present)
             value_update = self.assign(self.value_past, value_present)
             # add dependency for desired execution order
             key_update = F.depend(key_update, key_reset)
             value_update = F.depend(value_update, value_reset)
+            if self.is_first_iteration and encoder_output is not None:
+                # save the keys and values of the encoder output for the following iterations
+                key_update = F.depend(key_update, self.assign(self.cross_key_past, layer_present[2]))
+                value_update = F.depend(value_update, self.assign(self.cross_value_past, layer_present[3]))
 
         # add dependency for desired execution order
         mlp_logit = F.depend(mlp_logit, value_update)
@@ -1156,8 +1186,9 @@ class TransformerDecoderLayer(Cell):
             _check_input_dtype(F.dtype(encoder_output), "encoder_output",
                                [mstype.float32, mstype.float16], self.cls_name)
         if memory_mask is not None:
+            query_length = 1 if self.use_past and not self.is_first_iteration else self.tgt_seq_length
             _check_shape_equal(F.shape(memory_mask), "memory_mask", self.cls_name,
-                               [self.batch_size, self.tgt_seq_length, self.src_seq_length])
+                               [self.batch_size, query_length, self.src_seq_length])
             _check_input_dtype(F.dtype(memory_mask), "memory_mask",
                                [mstype.float32, mstype.float16], self.cls_name)
 
@@ -29,6 +29,8 @@ from mindspore.ops import operations as P
 from mindspore.nn.transformer.loss import CrossEntropyLoss
 from mindspore.nn.transformer import VocabEmbedding
 
+from transformer.modules.sampling import build_sampler
+from transformer.modules.scoring import TokenLogProbs
 from transformer.models.t5.T5Transformer import TransformerEncoder, TransformerDecoder, LayerNorm
 
 
@@ -55,6 +57,7 @@ class TransformerConfig:
     compute_dtype: mstype.dtype = mstype.float32
     has_relative_bias: bool = True
     scale_output: bool = True
+    use_past: bool = False
 
 
 def position_encoding(length,
@@ -258,7 +261,10 @@ class TransformerModel(nn.Cell):
             hidden_dropout_rate=config.hidden_dropout_prob,
             num_layers=config.num_hidden_layers,
             hidden_act=config.hidden_act,
+            use_past=config.use_past,
             moe_config=config.parallel_config.moe_config)
+        self.use_past = config.use_past
+        self.is_first_iteration = True
 
         self.projection = T5Head(self.hidden_size,
                                  compute_dtype=mstype.float16,
@@ -266,6 +272,7 @@ class TransformerModel(nn.Cell):
 
 
         self.cast = ops.Cast()
+        self.gather = ops.Gather()
         self.dtype = config.dtype
         self.cast_compute_type = CastWrapper(dst_type=config.compute_dtype)
         self.expand = ops.ExpandDims()
@@ -278,8 +285,18 @@ class TransformerModel(nn.Cell):
         self._create_attention_mask_from_input_mask = CreateAttentionMaskFromInputMask(config.parallel_config)
 
     def construct(self, source_ids=None, source_mask=None, target_ids=None, target_mask=None, memory_mask=None,
-                  encoder_cache=None):
-        """Transformer with encoder and decoder."""
+                  encoder_cache=None, current_index=None, init_reset=True, batch_valid_length=None):
+        """
+        Transformer with encoder and decoder.
+
+        If current_index is given, only the decoder outputs of these positions in the flattened
+        [batch_size * tgt_length] outputs are projected to the vocabulary.
+
+        If use_past is True, the first iteration runs the decoder over the whole target and saves the keys and
+        values of the self attention and the cross attention. The following iterations take only the latest
+        target token with shape [batch_size, 1] at the position batch_valid_length, and the init_reset should be
+        False for the first iteration and True for the following ones.
+        """
         if source_ids is not None:
             encoder_output = self.encoder_forward(source_ids, source_mask)
         else:
@@ -293,24 +310,31 @@ class TransformerModel(nn.Cell):
         # attention mask [batch_size, seq_length, seq_length]
         tgt_length = self.shape(target_ids)[1]
 
-        if memory_mask is None:
-            memory_mask = self.create_memory_mask(source_mask, target_mask)
-
-        if len(ops.shape(target_mask)) == 2:
-            future_mask = convert_np_to_tensor_encoder(tgt_length)
-            tgt_attention_mask = self._create_attention_mask_from_input_mask(target_mask)
-            tgt_attention_mask = self.multiply(tgt_attention_mask, self.expand(future_mask, 0))
+        if self.use_past and not self.is_first_iteration:
+            # The self attention mask of the single token is computed from the saved keys in the decoder
+            memory_mask = self.expand(self.cast(source_mask, mstype.float32), 1)
+            tgt_attention_mask = P.Ones()((self.batch_size, 1, self.max_decode_length), mstype.float32)
         else:
-            tgt_attention_mask = target_mask
+            if memory_mask is None:
+                memory_mask = self.create_memory_mask(source_mask, target_mask)
+
+            if len(ops.shape(target_mask)) == 2:
+                future_mask = convert_np_to_tensor_encoder(tgt_length)
+                tgt_attention_mask = self._create_attention_mask_from_input_mask(target_mask)
+                tgt_attention_mask = self.multiply(tgt_attention_mask, self.expand(future_mask, 0))
+            else:
+                tgt_attention_mask = target_mask
 
         # transformer decoder
         decoder_output, _ = self.tfm_decoder(self.cast_compute_type(tgt_embedding_output),
                                              self.cast_compute_type(tgt_attention_mask),
-                                             encoder_output, memory_mask)
+                                             encoder_output, memory_mask, init_reset, batch_valid_length)
         decoder_output = self.decoder_layernorm(decoder_output)
 
         if self.scale_output:
             decoder_output = decoder_output * (self.hidden_size ** -0.5)
+        if current_index is not None:
+            decoder_output = self.gather(ops.Reshape()(decoder_output, (-1, self.hidden_size)), current_index, 0)
         # calculate logits and log_probs
         log_probs = self.projection(decoder_output, embedding_table)
 
@@ -388,22 +412,39 @@ class EvalNet(nn.Cell):
     Args:
         backbone(nn.Cell): backbone network of GPT2/3
         generate(bool): enable generate mode
+        sampler(nn.Cell): the cell to select the sampling candidates in the graph in generate mode, such as
+            TopKSampler, or the tokens, such as ArgmaxSampler. If None, return the probabilities of the whole
+            vocabulary. Default: None
+        score(bool): return the log probabilities of the label tokens of the decoder instead of the argmax when
+            the generate mode is disabled. The label_ids and label_mask are given after the batch_valid_length.
+            Default: False
 
     Returns:
         outputs: Tensor, corresponding output for different tasks
     """
-    def __init__(self, backbone, generate=False):
+    def __init__(self, backbone, generate=False, sampler=None, score=False):
         super(EvalNet, self).__init__(auto_prefix=False)
         self.backbone = backbone
+        self.sampler = sampler
+        self.use_past = backbone.use_past
         self.argmax = P.Argmax()
         self.generate = generate
+        self.score = score
+        self.token_log_probs = TokenLogProbs()
         self.cast = P.Cast()
-        self.gather = P.Gather()
         self.pad_token = 0
 
     def construct(self, input_ids, input_mask, current_index=None,
-                  cache_encoder=None, target_id=None, target_mask=None):
+                  cache_encoder=None, target_id=None, target_mask=None, frequency_list=None,
+                  init_reset=True, batch_valid_length=None, label_ids=None, label_mask=None):
         """evaluation net"""
+        if self.score:
+            # Run the encoder and the decoder together, or the decoder with the given encoder output
+            input_mask = self.cast(input_mask, mstype.float32)
+            if target_mask is None:
+                target_mask = F.cast(target_id != self.pad_token, mstype.float32)
+            logits = self.backbone(input_ids, input_mask, target_id, target_mask, None, cache_encoder)
+            return self.token_log_probs(logits, label_ids, label_mask)
         if cache_encoder is None:
             input_mask = self.cast(input_mask, mstype.float32)
             outputs = self.backbone(input_ids, input_mask)
@@ -411,14 +452,17 @@ class EvalNet(nn.Cell):
             input_mask = self.cast(input_mask, mstype.float32)
             if target_mask is None:
                 target_mask = F.cast(target_id != self.pad_token, mstype.float32)
-            logits = self.backbone(None, input_mask, target_id, target_mask, None, cache_encoder)
             outputs = None
             if self.generate:
-                index = current_index.view(1,)
-                logits = self.gather(logits, index, 0)
+                index = current_index.view(-1,)
+                logits = self.backbone(None, input_mask, target_id, target_mask, None, cache_encoder, index,
+                                       init_reset, batch_valid_length)
+                if self.sampler is not None:
+                    return self.sampler(logits, frequency_list)
                 outputs = nn.LogSoftmax()(logits)
                 outputs = F.tensor_pow(np.e, outputs)
             else:
+                logits = self.backbone(None, input_mask, target_id, target_mask, None, cache_encoder)
                 outputs = self.argmax(logits)
         return outputs
 
@@ -429,7 +473,7 @@ def get_t5_network(opt, model_config):
     network = TransformerModel(config=model_config)
     if opt.eval:
         opt.logger.info("Detect the eval is True, return the eval net.")
-        net = EvalNet(network, generate=opt.generate)
+        net = EvalNet(network, generate=opt.generate, sampler=build_sampler(opt), score=getattr(opt, 'score', False))
         return net
     loss = CrossEntropyLoss(parallel_config=parallel_config.dp_mp_config)
     net_with_loss = TransformerNetworkWithLoss(network=network, loss=loss)
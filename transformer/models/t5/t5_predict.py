@@ -16,6 +16,8 @@
 """T5 Predict"""
 from transformer.models.t5 import TransformerConfig, TransformerModel, EvalNet
 from transformer.trainer import Trainer, TrainingConfig, parse_config
+from transformer.modules.sampling import build_sampler
+from transformer.encoder_cache import build_encoder_cache
 from transformer.data import create_t5_dataset
 
 
@@ -36,7 +38,13 @@ class T5TrainingConfig(TrainingConfig):
         self.ckpt_path = "./converted_mindspore_t5.ckpt"
         self.vocab_path = "./vocab.json"
         self.input_samples = "Hello world"
+        self.input_file = ""
+        self.output_file = "./outputs.jsonl"
         self.generate = True
+        self.sample_on_device = False
+        self.greedy = False
+        self.encoder_cache_bytes = 0
+        self.use_past = False
         self.device_target = "Ascend"
 
 
@@ -47,11 +55,14 @@ class T5Predict(Trainer):
 
     def build_model_config(self):
         model_config = TransformerConfig()
+        model_config.use_past = self.config.use_past
         return model_config
 
     def build_model(self, model_config):
         network = TransformerModel(config=model_config)
-        net = EvalNet(network, generate=self.config.generate)
+        net = EvalNet(network, generate=self.config.generate, sampler=build_sampler(self.config))
+        # The encoder outputs are kept across the generate calls of the predictor
+        self.encoder_cache = build_encoder_cache(self.config)
         return net
 
     def build_dataset(self, training_config, device_num, rank):
@@ -0,0 +1,138 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Sampling candidates selection in the graph."""
+import numpy as np
+import mindspore.nn as nn
+import mindspore.common.dtype as mstype
+from mindspore.ops import operations as P
+from mindspore.ops import functional as F
+
+
+class TopKSampler(nn.Cell):
+    """
+    Apply the penalties and the temperature to the logits and select the topk candidates in the graph, so that
+    only the candidates are copied to the host instead of the probabilities of the whole vocabulary. The scores
+    are computed in the same way as the sampler in transformer.generate.
+
+    Args:
+        top_k_num(int): The number of the candidates returned for each row.
+        temperature(float): The scores are divided by the temperature before exponentiation. Default: 1.0.
+        frequency_penalty(float): The penalty for each time the token has appeared. Default: 0.0.
+        presence_penalty(float): The penalty if the token has appeared at least once. Default: 0.0.
+
+    Inputs:
+        logits: the logits of the positions to predict with shape [bs, vocab_size]
+        frequency_list: the count of each generated token with shape [bs, vocab_size], or None
+
+    Returns:
+        probs: Tensor, the unnormalized probabilities of the candidates with shape [bs, top_k_num]
+        index: Tensor, the token ids of the candidates with shape [bs, top_k_num]
+    """
+    def __init__(self, top_k_num, temperature=1.0, frequency_penalty=0.0, presence_penalty=0.0):
+        super(TopKSampler, self).__init__()
+        self.top_k_num = top_k_num
+        self.temperature = temperature
+        self.frequency_penalty = frequency_penalty
+        self.presence_penalty = presence_penalty
+        # The frequency list is not needed without the penalties
+        self.use_frequency_list = bool(frequency_penalty or presence_penalty)
+        self.log_softmax = nn.LogSoftmax()
+        self.topk = P.TopK(sorted=True)
+        self.cast = P.Cast()
+        self.greater = P.Greater()
+
+    def construct(self, logits, frequency_list=None):
+        """select the candidates"""
+        logits = self.cast(F.reshape(logits, (F.shape(logits)[0], -1)), mstype.float32)
+        scores = F.tensor_pow(np.e, self.log_softmax(logits))
+        if frequency_list is not None:
+            frequency_list = self.cast(frequency_list, mstype.float32)
+            scores = scores - frequency_list * self.frequency_penalty - \
+                self.cast(self.greater(frequency_list, 0), mstype.float32) * self.presence_penalty
+        scores = F.tensor_pow(np.e, scores / self.temperature)
+        probs, index = self.topk(scores, self.top_k_num)
+        return probs, index
+
+
+class ArgmaxSampler(nn.Cell):
+    """
+    Apply the penalties to the logits and select the token with the largest score in the graph for the greedy
+    decoding, so that only the token ids are copied to the host. The temperature does not change the order of
+    the scores, so it is not applied.
+
+    Args:
+        frequency_penalty(float): The penalty for each time the token has appeared. Default: 0.0.
+        presence_penalty(float): The penalty if the token has appeared at least once. Default: 0.0.
+
+    Inputs:
+        logits: the logits of the positions to predict with shape [bs, vocab_size]
+        frequency_list: the count of each generated token with shape [bs, vocab_size], or None
+
+    Returns:
+        index: Tensor, the selected token id of each row with shape [bs]
+    """
+    def __init__(self, frequency_penalty=0.0, presence_penalty=0.0):
+        super(ArgmaxSampler, self).__init__()
+        self.frequency_penalty = frequency_penalty
+        self.presence_penalty = presence_penalty
+        # The frequency list is not needed without the penalties
+        self.use_frequency_list = bool(frequency_penalty or presence_penalty)
+        self.log_softmax = nn.LogSoftmax()
+        self.argmax = P.Argmax(output_type=mstype.int32)
+        self.cast = P.Cast()
+        self.greater = P.Greater()
+
+    def construct(self, logits, frequency_list=None):
+        """select the tokens"""
+        logits = self.cast(F.reshape(logits, (F.shape(logits)[0], -1)), mstype.float32)
+        if frequency_list is None:
+            return self.argmax(logits)
+        scores = F.tensor_pow(np.e, self.log_softmax(logits))
+        frequency_list = self.cast(frequency_list, mstype.float32)
+        scores = scores - frequency_list * self.frequency_penalty - \
+            self.cast(self.greater(frequency_list, 0), mstype.float32) * self.presence_penalty
+        return self.argmax(scores)
+
+
+def is_greedy(config):
+    """Whether the decoding selects the token with the largest score, set by the greedy or by top_k_num=1"""
+    return getattr(config, 'greedy', False) or \
+        (getattr(config, 'top_k_num', 0) == 1 and getattr(config, 'top_p', 1.0) >= 1.0)
+
+
+def build_sampler(opt):
+    """
+    Return the sampler of the eval net in the generate mode, else None
+
+    The ArgmaxSampler is returned if the greedy is set, or if the decoding is greedy and the sample_on_device is
+    enabled. The repetition penalty needs the prompt tokens, so the greedy decoding with it selects the tokens on
+    the host. Otherwise, the TopKSampler is returned if the sample_on_device is enabled, and top_p sampling keeps
+    the 5000 largest candidates, the same as the host sampler.
+    """
+    if not getattr(opt, 'generate', False):
+        return None
+    # The beam search needs the probabilities of the whole vocabulary
+    beam_search = hasattr(opt, 'model') and opt.model.get('beam_width', 1) > 1
+    if is_greedy(opt) and getattr(opt, 'repetition_penalty', 1.0) == 1.0 and not beam_search and \
+            (getattr(opt, 'greedy', False) or getattr(opt, 'sample_on_device', False)):
+        return ArgmaxSampler(frequency_penalty=opt.frequency_penalty, presence_penalty=opt.presence_penalty)
+    if not getattr(opt, 'sample_on_device', False):
+        return None
+    top_k_num = 5000 if opt.top_p < 1.0 else opt.top_k_num
+    top_k_num = min(top_k_num, opt.model['vocab_size']) if hasattr(opt, 'model') else top_k_num
+    return TopKSampler(top_k_num,
+                       temperature=getattr(opt, 'temperature', 1.0),
+                       frequency_penalty=opt.frequency_penalty,
+                       presence_penalty=opt.presence_penalty)
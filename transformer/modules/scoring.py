@@ -0,0 +1,52 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Log-likelihood of the label tokens in the graph."""
+import mindspore.nn as nn
+import mindspore.common.dtype as mstype
+from mindspore.ops import operations as P
+from mindspore.ops import functional as F
+
+
+class TokenLogProbs(nn.Cell):
+    """
+    Gather the log probability of the label token at each position in the graph, so that only the scores of the
+    labels are copied to the host instead of the logits of the whole vocabulary.
+
+    Inputs:
+        logits: the logits of all the positions with shape [bs * seq_length, vocab_size]
+        label_ids: the token to score at each position with shape [bs, seq_length]
+        label_mask: 1 for the positions to score and 0 for the others with shape [bs, seq_length]
+
+    Returns:
+        token_log_probs: Tensor, the log probability of each label token with shape [bs, seq_length], which is 0
+            at the positions not scored
+        log_probs: Tensor, the sum of the token_log_probs of each row with shape [bs]
+    """
+    def __init__(self):
+        super(TokenLogProbs, self).__init__()
+        self.log_softmax = nn.LogSoftmax()
+        self.gather = P.GatherD()
+        self.cast = P.Cast()
+        self.reduce_sum = P.ReduceSum()
+
+    def construct(self, logits, label_ids, label_mask):
+        """gather the log probabilities of the labels"""
+        batch_size, seq_length = F.shape(label_ids)
+        logits = self.cast(F.reshape(logits, (batch_size * seq_length, -1)), mstype.float32)
+        log_probs = self.log_softmax(logits)
+        labels = self.cast(F.reshape(label_ids, (batch_size * seq_length, 1)), mstype.int32)
+        token_log_probs = F.reshape(self.gather(log_probs, 1, labels), (batch_size, seq_length))
+        token_log_probs = token_log_probs * self.cast(label_mask, mstype.float32)
+        return token_log_probs, self.reduce_sum(token_log_probs, 1)
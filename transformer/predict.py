@@ -17,6 +17,10 @@
 Basic model predict/evaluation script
 """
 import argparse
+import itertools
+import json
+import math
+import time
 import numpy as np
 
 from mindspore import Tensor
@@ -27,15 +31,19 @@ from mindspore.train.model import Model
 import mindspore.communication.management as D
 from mindspore.common import set_seed
 from mindspore import load_checkpoint, load_param_into_net
+from mindspore.ops import operations as P
 
 from transformer.data import build_dataset
 from transformer.models import build_model
 from transformer.build_parallel_config import build_parallel_config
 from transformer.tokenization import tokenization
-from transformer.tokenization.tokenization import FullTokenizer
 from transformer.utils import parse_with_config, _convert_dtype_class
 from transformer.logger import get_logger
-from transformer.generate import generate
+from transformer.generate import generate_batch, generate_beam_search, generate_stream
+from transformer.generate_scheduler import ContinuousBatchScheduler
+from transformer.prefix_cache import build_prefix_cache
+from transformer.encoder_cache import build_encoder_cache
+from transformer.length_bucket import LengthBucketedModel, build_length_bucketed_model
 
 
 def set_context_env(config):
@@ -101,13 +109,25 @@ def set_auto_parallel_context_env(config):
 
 
 def get_acc(model, dataset):
-    """ calculate accuracy for input dataset """
+    """
+    calculate accuracy for input dataset
+
+    With the LengthBucketedModel, each batch runs the smallest bucket which fits its last valid position, and the
+    padded positions after the bucket are not counted.
+    """
     total_num = 0
     acc_num = 0
     for data in dataset:
         input_ids = data[0].asnumpy().astype(np.int32)
         input_mask = data[1].asnumpy().astype(np.int32)
         label = data[2].asnumpy().astype(np.int32)
+        if isinstance(model, LengthBucketedModel):
+            valid_positions = np.flatnonzero(input_mask.any(axis=0))
+            bucket = model.select(int(valid_positions[-1]) + 1 if valid_positions.size else 1)
+            if label.shape == input_ids.shape:
+                label = label[:, :bucket]
+            input_ids = np.ascontiguousarray(input_ids[:, :bucket])
+            input_mask = np.ascontiguousarray(input_mask[:, :bucket])
         logits = model.predict(Tensor(input_ids, mstype.int32), Tensor(input_mask, mstype.float32)).asnumpy()
 
         equals = label.reshape(-1) == logits
@@ -118,42 +138,352 @@ def get_acc(model, dataset):
     return acc
 
 
-def generate_words(sample, predict_model, opt):
+def _sliding_windows(tokens, seq_length, stride):
+    """
+    Split a document into the windows of at most seq_length inputs starting every stride tokens. Each window
+    predicts the next token of each input, and only the tokens not predicted by the previous windows are scored,
+    so the overlap is only used as the context.
+
+    Returns:
+        windows: generator of (input_ids, label_ids, first), the labels before the first one are not scored
+    """
+    last = len(tokens) - 1
+    scored_end = 0
+    for begin in range(0, last, stride):
+        end = min(begin + seq_length, last)
+        yield tokens[begin:end], tokens[begin + 1:end + 1], scored_end - begin
+        scored_end = end
+        if end == last:
+            break
+
+
+def get_perplexity(model, documents, seq_length, stride, batch_size, pad_token=0):
+    """
+    Calculate the perplexity of the documents with the sliding windows
+
+    The windows of all the documents are batched together for the eval net built with score=True, and the sum of
+    the log probabilities is accumulated on the device, so the host only reads it once at the end.
+
+    Inputs:
+        model: The model wrapping the eval net built with score=True.
+        documents(Iterable): The ids of each document.
+        seq_length(int): The sequence length of the model.
+        stride(int): The distance between the starts of the adjacent windows, which is not larger than seq_length.
+        batch_size(int): The batch size which the eval net is compiled with.
+        pad_token(int): The id of the padding token. Default: 0.
+
+    Returns:
+        outputs: dict of the average negative log-likelihood "loss", the "perplexity" and the "num_tokens"
+    """
+    if not 0 < stride <= seq_length:
+        raise ValueError(f"The stride should be in (0, {seq_length}], but got {stride}.")
+    windows = itertools.chain.from_iterable(_sliding_windows(np.asarray(item, np.int32), seq_length, stride)
+                                            for item in documents)
+    reduce_sum = P.ReduceSum()
+    total_log_prob = None
+    num_tokens = 0
+    while True:
+        batch = list(itertools.islice(windows, batch_size))
+        if not batch:
+            break
+        length = seq_length
+        if isinstance(model, LengthBucketedModel):
+            length = model.select(max(len(input_ids) for input_ids, _, _ in batch))
+        input_ids = np.full((batch_size, length), pad_token, np.int32)
+        input_mask = np.zeros((batch_size, length), np.int32)
+        # The padding rows keep a single valid token
+        input_mask[:, 0] = 1
+        label_ids = np.full((batch_size, length), pad_token, np.int32)
+        label_mask = np.zeros((batch_size, length), np.int32)
+        for row, (ids, labels, first) in enumerate(batch):
+            input_ids[row, :len(ids)] = ids
+            input_mask[row, :len(ids)] = 1
+            label_ids[row, :len(labels)] = labels
+            label_mask[row, first:len(labels)] = 1
+        _, log_probs = model.predict(Tensor(input_ids, mstype.int32), Tensor(input_mask, mstype.float32), None,
+                                     True, None, None, Tensor(label_ids, mstype.int32),
+                                     Tensor(label_mask, mstype.float32))
+        batch_log_prob = reduce_sum(log_probs)
+        total_log_prob = batch_log_prob if total_log_prob is None else total_log_prob + batch_log_prob
+        num_tokens += int(label_mask.sum())
+    if not num_tokens:
+        raise ValueError("The documents should have at least two tokens to calculate the perplexity.")
+    loss = -float(total_log_prob.asnumpy()) / num_tokens
+    return {"loss": loss, "perplexity": math.exp(loss), "num_tokens": num_tokens}
+
+
+def _read_documents(path):
+    """Read the documents from the JSONL file with the "text" of each line, or the text file with one per line"""
+    with open(path, 'r') as fp:
+        lines = [line for line in fp if line.strip()]
+    if path.endswith('.jsonl'):
+        return [json.loads(line)["text"] for line in lines]
+    return [line.rstrip('\n') for line in lines]
+
+
+def _tokenize_samples(samples, opt):
+    """Convert the input prompts to the lists of ids"""
+    tokenizer = tokenization.get_tokenizer(opt.vocab_path)
+    input_ids = []
+    for item in samples:
+        tokens = tokenizer.tokenize(item)
+        input_ids.append(tokenization.convert_tokens_to_ids(vocab_file=opt.vocab_path,
+                                                            tokens=tokens))
+    return input_ids
+
+
+def _generate_ids(input_ids, predict_model, opt, prefix_cache=None, encoder_cache=None):
+    """Generate the ids of a batch of the tokenized prompts with the decoding method of the configs"""
+    end_token = getattr(opt, 'end_token', 2)  # For opt model, the end_token is 2
+    if getattr(opt, 'arch', None) == 't5' and opt.model.get('beam_width', 1) > 1:
+        return generate_beam_search(predict_model,
+                                    end_token=end_token,
+                                    origin_inputs=input_ids,
+                                    model_origin_max_length=opt.model['seq_length'],
+                                    max_decode_length=opt.model['max_decode_length'],
+                                    vocab_size=opt.model["vocab_size"],
+                                    beam_width=opt.model['beam_width'],
+                                    length_penalty_weight=opt.model.get('length_penalty_weight', 1.0),
+                                    encoder_cache=encoder_cache)
+    return generate_batch(predict_model,
+                          end_token=end_token,
+                          origin_inputs=input_ids,
+                          model_origin_max_length=opt.model['seq_length'],
+                          max_generate_length=opt.model['seq_length'],
+                          vocab_size=opt.model["vocab_size"],
+                          cache_encoder=getattr(opt, 'arch', None) == 't5',
+                          config=opt,
+                          prefix_cache=prefix_cache,
+                          encoder_cache=encoder_cache)
+
+
+def _detokenize(ids, opt):
+    """Convert the ids to the text"""
+    output_samples = tokenization.convert_ids_to_tokens(vocab_file=opt.vocab_path, ids=list(ids))
+    return tokenization.convert_tokens_to_string(output_samples)
+
+
+def generate_words(sample, predict_model, opt, prefix_cache=None, encoder_cache=None):
     """
     Generate the word given the input prompt, model and configs
 
     Args:
-        sample(str): The input prompt. For example, it can be "Today is a good day, I want to".
+        sample(Union[str, list]): The input prompt. For example, it can be "Today is a good day, I want to".
+            A list of prompts will be generated together in a batch.
         predict_model(Model): the model that need to run prediction.
         opt(argparse.Namespace): The global configs.
+        prefix_cache(PrefixKVCache): The cache of the keys and values of the processed prompts. Default: None.
+        encoder_cache(EncoderOutputCache): The cache of the encoder outputs of T5. Default: None.
 
-    Inputs:
-        input_ids: the tokenized inputs
-        attention_mask: the attention mask with [bs, seq_length]. 1 means effective and 0 mean it should be masked.
-        labels:
     Returns:
-        output: Tensor, the loss of the network
+        output: str or list of str, the generated text of the prompts
     """
     # Tokenize input sentence to ids
     eval_opts = opt
-    tokenizer = FullTokenizer(eval_opts.vocab_path)
-    tokens = tokenizer.tokenize(sample)
-    input_ids = tokenization.convert_tokens_to_ids(vocab_file=eval_opts.vocab_path,
-                                                   tokens=tokens)
-    input_ids = np.array(input_ids).reshape(1, -1)
-    # eval ops
-    output_ids = generate(predict_model,
-                          end_token=2,  # For opt model, the end_token is 2
-                          origin_inputs=input_ids,
-                          model_origin_max_length=eval_opts.model['seq_length'],
-                          max_generate_length=eval_opts.model['seq_length'],
-                          vocab_size=eval_opts.model["vocab_size"],
-                          config=eval_opts)
+    samples = [sample] if isinstance(sample, str) else sample
+    input_ids = _tokenize_samples(samples, eval_opts)
+    output_ids = _generate_ids(input_ids, predict_model, eval_opts, prefix_cache, encoder_cache)
     # Decode output ids to sentence
-    output_samples = tokenization.convert_ids_to_tokens(vocab_file=eval_opts.vocab_path,
-                                                        ids=output_ids.tolist())
-    output_string = tokenization.convert_tokens_to_string(output_samples)
-    print('Output is:', output_string, flush=True)
+    output_strings = []
+    for ids in output_ids:
+        output_string = _detokenize(ids.tolist(), eval_opts)
+        print('Output is:', output_string, flush=True)
+        output_strings.append(output_string)
+    return output_strings[0] if isinstance(sample, str) else output_strings
+
+
+def generate_padded_batch(input_ids, predict_model, opt, batch_size, prefix_cache=None, encoder_cache=None):
+    """
+    Generate the tokenized prompts with the eval net compiled with the batch_size, and return the generated ids
+    without the prompts
+
+    Args:
+        input_ids(list): The ids of each prompt, no more than batch_size prompts.
+        predict_model(Model): the model that need to run prediction.
+        opt(argparse.Namespace): The global configs.
+        batch_size(int): The batch size which the eval net is compiled with.
+        prefix_cache(PrefixKVCache): The cache of the keys and values of the processed prompts. Default: None.
+        encoder_cache(EncoderOutputCache): The cache of the encoder outputs of T5. Default: None.
+
+    Returns:
+        outputs: list of the generated ids of each prompt
+    """
+    if not 0 < len(input_ids) <= batch_size:
+        raise ValueError(f"The number of the prompts should be in (0, {batch_size}], but got {len(input_ids)}.")
+    # The batch is filled with the copies of its first prompt, whose outputs are dropped
+    batch = list(input_ids) + [input_ids[0]] * (batch_size - len(input_ids))
+    output_ids = _generate_ids(batch, predict_model, opt, prefix_cache, encoder_cache)
+    cache_encoder = getattr(opt, 'arch', None) == 't5'
+    # The decoder of T5 starts from the [START] token instead of the prompt
+    return [(ids[1:] if cache_encoder else ids[len(prompt):]).tolist()
+            for prompt, ids in zip(input_ids, output_ids)]
+
+
+def _generate_continuous(input_ids, predict_model, opt, batch_size):
+    """
+    Generate the tokenized prompts with the ContinuousBatchScheduler, and return the generated ids without the
+    prompts and the latency of each prompt in seconds
+    """
+    if isinstance(predict_model, LengthBucketedModel):
+        # The scheduler keeps the rows of the full sequence length
+        predict_model.select(opt.model['seq_length'])
+    scheduler = ContinuousBatchScheduler(predict_model, batch_size, opt.model['seq_length'], opt.model["vocab_size"],
+                                         getattr(opt, 'end_token', 2), opt)
+    for ids in input_ids:
+        scheduler.add_request(ids)
+    output_ids = scheduler.run()
+    latency = [request.latency for request in sorted(scheduler.finished, key=lambda x: x.request_id)]
+    opt.logger.info(f"The continuous batching stats: {scheduler.stats()}")
+    return [ids[len(prompt):].tolist() for prompt, ids in zip(input_ids, output_ids)], latency
+
+
+def _read_prompts(lines, is_jsonl):
+    """
+    Parse the prompt records of the numbered lines, the JSONL line keeps its other fields in the output
+
+    Raises:
+        ValueError: If a JSONL line is not a JSON object with the string "prompt" or "text".
+    """
+    records = []
+    for number, line in lines:
+        if not is_jsonl:
+            prompt = line.rstrip('\n')
+            records.append(({"prompt": prompt}, prompt))
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as error:
+            raise ValueError(f"The line {number} of the input file is not valid JSON: {error}") from error
+        prompt = item.get("prompt", item.get("text")) if isinstance(item, dict) else None
+        if not isinstance(prompt, str):
+            raise ValueError(f'The line {number} of the input file should be a JSON object with the string "prompt" '
+                             'or "text"')
+        records.append((item, prompt))
+    return records
+
+
+def _write_outputs(output_stream, records, outputs):
+    """Write the records of a chunk with their generated text"""
+    for (item, _), output in zip(records, outputs):
+        item["output"] = output
+        output_stream.write(json.dumps(item) + "\n")
+    output_stream.flush()
+
+
+def generate_file(input_file, output_file, predict_model, opt, batch_size, chunk_size=10000, prefix_cache=None,
+                  encoder_cache=None):
+    """
+    Generate the words of the prompts in the input file, and write the outputs in the same order
+
+    The input is a JSONL file with the "prompt" of each line, or a text file with one prompt per line. The prompts
+    are read in chunks of chunk_size, and the prompts of a chunk are sorted by the tokenized length and generated
+    batch by batch, so that the prompts in a batch have similar lengths. With continuous_batching of the configs,
+    the prompts of a chunk of the GPT and OPT models are generated by the ContinuousBatchScheduler instead, which
+    refills the slot of each finished prompt at once. Each output line is the json object of the input line with
+    the generated text "output" following the prompt.
+
+    Args:
+        input_file(str): The path of the prompts.
+        output_file(str): The path of the JSONL outputs.
+        predict_model(Model): the model that need to run prediction.
+        opt(argparse.Namespace): The global configs.
+        batch_size(int): The batch size which the eval net is compiled with.
+        chunk_size(int): The number of the prompts sorted together. Default: 10000.
+        prefix_cache(PrefixKVCache): The cache of the keys and values of the processed prompts. Default: None.
+        encoder_cache(EncoderOutputCache): The cache of the encoder outputs of T5. Default: None.
+
+    Returns:
+        stats: dict of the prompts/sec, the generated tokens/sec, the p50/p99 latency of the prompts in seconds
+        and the padding waste, the ratio of the padding tokens in the batched prompts, which is 0 with
+        continuous_batching
+    """
+    continuous = getattr(opt, 'continuous_batching', False) and getattr(opt, 'arch', None) in ('gpt', 'opt')
+    latency = []
+    num_tokens = 0
+    num_positions = 0
+    num_padding = 0
+    start_time = time.time()
+    with open(input_file, 'r') as input_stream, open(output_file, 'w') as output_stream:
+        lines = ((number, line) for number, line in enumerate(input_stream, 1) if line.strip())
+        while True:
+            records = _read_prompts(itertools.islice(lines, chunk_size), input_file.endswith('.jsonl'))
+            if not records:
+                break
+            input_ids = _tokenize_samples([prompt for _, prompt in records], opt)
+            if continuous:
+                generated, chunk_latency = _generate_continuous(input_ids, predict_model, opt, batch_size)
+                latency.extend(chunk_latency)
+                num_tokens += sum(len(ids) for ids in generated)
+                outputs = [_detokenize(ids, opt) for ids in generated]
+                _write_outputs(output_stream, records, outputs)
+                opt.logger.info(f"Generated {len(latency)} prompts.")
+                continue
+            order = np.argsort([len(ids) for ids in input_ids], kind='stable')
+            outputs = [None] * len(records)
+            for start in range(0, len(order), batch_size):
+                rows = order[start:start + batch_size].tolist()
+                lengths = np.array([len(input_ids[row]) for row in rows] + [len(input_ids[rows[0]])] *
+                                   (batch_size - len(rows)))
+                num_positions += lengths.shape[0] * int(lengths.max())
+                num_padding += int((lengths.max() - lengths).sum())
+                batch_start = time.time()
+                generated = generate_padded_batch([input_ids[row] for row in rows], predict_model, opt, batch_size,
+                                                  prefix_cache, encoder_cache)
+                latency.extend([time.time() - batch_start] * len(rows))
+                for row, ids in zip(rows, generated):
+                    num_tokens += len(ids)
+                    outputs[row] = _detokenize(ids, opt)
+            _write_outputs(output_stream, records, outputs)
+            opt.logger.info(f"Generated {len(latency)} prompts.")
+    total_time = time.time() - start_time
+    latency = np.array(latency)
+    return {"num_prompts": int(latency.shape[0]),
+            "num_tokens": num_tokens,
+            "prompts_per_second": latency.shape[0] / total_time,
+            "tokens_per_second": num_tokens / total_time,
+            "latency_p50": float(np.percentile(latency, 50)) if latency.size else 0.0,
+            "latency_p99": float(np.percentile(latency, 99)) if latency.size else 0.0,
+            "padding_waste": num_padding / num_positions if num_positions else 0.0}
+
+
+def generate_words_stream(sample, predict_model, opt, prefix_cache=None, encoder_cache=None):
+    """
+    Generate the words given the input prompt, and yield the text of each token as soon as it is sampled
+
+    The fragments joined together are the generated text following the prompt, the same as the tail of the
+    output of generate_words. Beam search is not supported, as the beams are only decided at the end.
+
+    Args:
+        sample(Union[str, list]): The input prompt. A list of prompts will be generated together in a batch.
+        predict_model(Model): the model that need to run prediction.
+        opt(argparse.Namespace): The global configs.
+        prefix_cache(PrefixKVCache): The cache of the keys and values of the processed prompts. Default: None.
+        encoder_cache(EncoderOutputCache): The cache of the encoder outputs of T5. Default: None.
+
+    Returns:
+        fragment: str for a single prompt, or (index, str) of the prompt in the list for a batch of prompts
+    """
+    eval_opts = opt
+    samples = [sample] if isinstance(sample, str) else sample
+    input_ids = _tokenize_samples(samples, eval_opts)
+    cache_encoder = getattr(eval_opts, 'arch', None) == 't5'
+    end_token = getattr(eval_opts, 'end_token', 2)
+    vocab = tokenization.get_vocab(eval_opts.vocab_path).id_to_token
+    # The decoder of T5 starts from the [START] token instead of the prompt
+    detokenizers = [tokenization.IncrementalDetokenizer(vocab, [0] if cache_encoder else ids) for ids in input_ids]
+    stream = generate_stream(predict_model,
+                             end_token=end_token,
+                             origin_inputs=input_ids,
+                             model_origin_max_length=eval_opts.model['seq_length'],
+                             max_generate_length=eval_opts.model['seq_length'],
+                             vocab_size=eval_opts.model["vocab_size"],
+                             cache_encoder=cache_encoder,
+                             config=eval_opts,
+                             prefix_cache=prefix_cache,
+                             encoder_cache=encoder_cache)
+    for row, token_id in stream:
+        fragment = detokenizers[row].add(token_id)
+        yield fragment if isinstance(sample, str) else (row, fragment)
 
 
 def run_predict(opt):
@@ -162,25 +492,62 @@ def run_predict(opt):
     rank_id, device_num = set_auto_parallel_context_env(opt)
     parallel_config = build_parallel_config(opt)
 
+    # The perplexity is calculated from the log probabilities of the labels returned by the score mode
+    opt.score = not opt.generate and bool(getattr(opt, 'perplexity_data_path', ''))
     eval_net = build_model(opt, parallel_config)
 
     opt.logger.info(f"Start to restore from the path {opt.ckpt_path}")
     ckpt = load_checkpoint(opt.ckpt_path)
     load_param_into_net(eval_net, ckpt)
 
-    model = Model(eval_net)
+    def build_bucket_network(seq_length):
+        """Build the eval net of the length bucket"""
+        origin_seq_length = opt.model['seq_length']
+        opt.model['seq_length'] = seq_length
+        try:
+            return build_model(opt, parallel_config)
+        finally:
+            opt.model['seq_length'] = origin_seq_length
+
+    if opt.arch in ('gpt', 'opt'):
+        model = build_length_bucketed_model(opt, eval_net, build_bucket_network, opt.model['seq_length'])
+    else:
+        model = Model(eval_net)
 
     if opt.generate:
         opt.logger.info("Start to generate the words:")
-        generate_words(sample='Hello world!',
-                       predict_model=model,
-                       opt=opt)
+        prefix_cache = build_prefix_cache(opt)
+        encoder_cache = build_encoder_cache(opt)
+        if getattr(opt, 'input_file', ''):
+            batch_size = opt.model['global_batch_size'] // opt.speed_up['micro_batch_num']
+            stats = generate_file(opt.input_file, opt.output_file, model, opt, batch_size,
+                                  prefix_cache=prefix_cache, encoder_cache=encoder_cache)
+            opt.logger.info(f"The bulk generation stats: {stats}")
+        else:
+            generate_words(sample='Hello world!',
+                           predict_model=model,
+                           opt=opt,
+                           prefix_cache=prefix_cache,
+                           encoder_cache=encoder_cache)
+        if prefix_cache is not None:
+            opt.logger.info(f"The prefix cache stats: {prefix_cache.stats()}")
+        if encoder_cache is not None:
+            opt.logger.info(f"The encoder cache stats: {encoder_cache.stats()}")
+    elif opt.score:
+        opt.logger.info(f"Start to calculate the perplexity of {opt.perplexity_data_path}.")
+        documents = _tokenize_samples(_read_documents(opt.perplexity_data_path), opt)
+        batch_size = opt.model['global_batch_size'] // opt.speed_up['micro_batch_num']
+        outputs = get_perplexity(model, documents, opt.model['seq_length'], opt.perplexity_stride, batch_size)
+        opt.logger.info(f"The perplexity is {outputs['perplexity']}, the loss is {outputs['loss']} "
+                        f"over {outputs['num_tokens']} tokens")
     else:
         opt.logger.info("Start to eval on the datasets.")
         ds = build_dataset(opt, rank_id, device_num, get_eval_dataset=True)
         acc = get_acc(model, ds.create_tuple_iterator())
 
         opt.logger.info(f"The accuracy is {acc}")
+    if isinstance(model, LengthBucketedModel):
+        opt.logger.info(f"The length bucket stats: {model.stats()}")
 
 
 if __name__ == "__main__":
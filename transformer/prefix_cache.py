@@ -0,0 +1,249 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+"""
+Shared-prefix key/value cache for text generation
+"""
+from collections import OrderedDict
+
+import numpy as np
+from mindspore.common.tensor import Tensor
+
+
+def get_past_parameters(network):
+    """
+    Get the key/value cache parameters of each layer of the network built with use_past=True
+
+    Returns:
+        past_parameters: list of (key_past, value_past) Parameter of each layer
+    """
+    keys = []
+    values = []
+    for name, param in network.parameters_and_names():
+        if name.endswith('key_past'):
+            keys.append(param)
+        elif name.endswith('value_past'):
+            values.append(param)
+    return list(zip(keys, values))
+
+
+class PrefixBlock:
+    """
+    A cached block of a prompt
+
+    Args:
+        key(int): The key of the block in the cache.
+        parent(int): The key of the previous block of the prompt, None for the first block.
+        tokens(tuple): The ids of the tokens of the block.
+        states(list): The (key, value) numpy.ndarray of the positions of the block of each layer.
+    """
+    def __init__(self, key, parent, tokens, states):
+        self.key = key
+        self.parent = parent
+        self.tokens = tokens
+        self.states = states
+        self.num_bytes = sum(k.nbytes + v.nbytes for k, v in states)
+        self.num_children = 0
+
+
+class PrefixKVCache:
+    """
+    Keep the keys and values of the processed prompts, so that the prompts sharing a prefix, such as the same
+    system or template prefix, can start decoding from the longest cached prefix instead of encoding it again.
+
+    The prompts are split into blocks of block_size tokens, and each block is keyed by the hash of the key of the
+    previous block and its own tokens. A block keeps its tokens and the key of the previous block, which are
+    compared on the lookup, so a block is only reused after the same prefix even if the keys collide.
+    The key of a layer has the shape [num_heads, size_per_head, seq_length] and the value has the shape
+    [num_heads, seq_length, size_per_head] for each row in the cache of the MindSpore Transformer, and a block
+    keeps the slices of its positions of all the layers. The least recently used blocks without the cached next
+    blocks are evicted when the total size exceeds max_bytes, so a cached block always follows its whole prefix.
+
+    Args:
+        max_bytes(int): The memory budget of the cached keys and values in bytes.
+        block_size(int): The number of the tokens in a block. Default: 16.
+        max_suffix_length(int): The cache is used only if the uncached part of every prompt is not longer than
+            max_suffix_length, as the uncached tokens are processed one by one by the decode graph instead of
+            the prefill graph. Default: 32.
+    """
+    def __init__(self, max_bytes, block_size=16, max_suffix_length=32):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.max_suffix_length = max_suffix_length
+        self.blocks = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.evictions = 0
+
+    def _split_blocks(self, input_ids, length):
+        """The (key, parent key, tokens) of the full blocks of the first length tokens"""
+        blocks = []
+        parent = None
+        for start in range(0, length - self.block_size + 1, self.block_size):
+            tokens = tuple(input_ids[start:start + self.block_size].tolist())
+            key = hash((parent, tokens))
+            blocks.append((key, parent, tokens))
+            parent = key
+        return blocks
+
+    def _get(self, key, parent, tokens):
+        """The cached block of the tokens after the parent block, or None"""
+        block = self.blocks.get(key)
+        if block is None or block.parent != parent or block.tokens != tokens:
+            return None
+        return block
+
+    def match(self, input_ids, length):
+        """
+        Find the longest cached prefix of the prompt. The last token is never matched, as its logits are needed
+        to generate the next token.
+
+        Args:
+            input_ids(numpy.ndarray): The ids of the prompt.
+            length(int): The length of the prompt.
+
+        Returns:
+            blocks: list of the cached blocks of the prefix
+        """
+        blocks = []
+        for key, parent, tokens in self._split_blocks(input_ids, length - 1):
+            block = self._get(key, parent, tokens)
+            if block is None:
+                break
+            blocks.append(block)
+        # Touch from the last block to the first one, so that the least recently used blocks are the leaves
+        for block in reversed(blocks):
+            self.blocks.move_to_end(block.key)
+        return blocks
+
+    def insert(self, input_ids, length, past_states, row):
+        """
+        Store the blocks of the prompt from the key/value cache of the row
+
+        Args:
+            input_ids(numpy.ndarray): The ids of the prompt.
+            length(int): The length of the prompt.
+            past_states(list): The (key, value) numpy.ndarray of each layer with the whole batch.
+            row(int): The row of the prompt in the batch.
+        """
+        keys = []
+        for i, (key, parent, tokens) in enumerate(self._split_blocks(input_ids, length)):
+            if key in self.blocks:
+                # A different block with the same key keeps its place, and the rest of the prompt is not cached
+                if self._get(key, parent, tokens) is None:
+                    break
+                keys.append(key)
+                continue
+            start, end = i * self.block_size, (i + 1) * self.block_size
+            states = [(k[row, ..., start:end].copy(), v[row, ..., start:end, :].copy()) for k, v in past_states]
+            self.blocks[key] = PrefixBlock(key, parent, tokens, states)
+            self.num_bytes += self.blocks[key].num_bytes
+            if parent is not None:
+                self.blocks[parent].num_children += 1
+            keys.append(key)
+        # The first blocks are the most recently used, so the longest prefixes are evicted first
+        for key in reversed(keys):
+            self.blocks.move_to_end(key)
+        while self.num_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        """Evict the least recently used block without the next blocks"""
+        # The parents are touched after their children, so the first leaf is almost always the oldest block
+        key = next(key for key, block in self.blocks.items() if not block.num_children)
+        block = self.blocks.pop(key)
+        if block.parent is not None:
+            self.blocks[block.parent].num_children -= 1
+        self.num_bytes -= block.num_bytes
+        self.evictions += 1
+
+    def load(self, network, input_ids, valid_length):
+        """
+        Write the cached prefixes of the batch into the key/value cache of the network
+
+        Args:
+            network(Cell): The eval net built with use_past=True.
+            input_ids(numpy.ndarray): The padded prompts with shape [batch_size, seq_length].
+            valid_length(numpy.ndarray): The length of each prompt.
+
+        Returns:
+            prefix_length: numpy.ndarray of the number of the cached tokens of each row, or None if the cache
+            is not used for the batch and the prompts should be processed by the prefill graph
+        """
+        matches = [self.match(input_ids[row], valid_length[row]) for row in range(input_ids.shape[0])]
+        prefix_length = np.array([len(blocks) * self.block_size for blocks in matches], np.int32)
+        hit = prefix_length > 0
+        if not hit.any() or np.max(valid_length - prefix_length) > self.max_suffix_length:
+            self.misses += len(matches)
+            return None
+        self.hits += int(hit.sum())
+        self.misses += int((~hit).sum())
+        self.hit_tokens += int(prefix_length.sum())
+        for layer, (key_past, value_past) in enumerate(get_past_parameters(network)):
+            key = np.zeros(key_past.shape, np.float32)
+            value = np.zeros(value_past.shape, np.float32)
+            for row, blocks in enumerate(matches):
+                for i, block in enumerate(blocks):
+                    start, end = i * self.block_size, (i + 1) * self.block_size
+                    key[row, ..., start:end] = block.states[layer][0]
+                    value[row, ..., start:end, :] = block.states[layer][1]
+            key_past.set_data(Tensor(key, key_past.dtype))
+            value_past.set_data(Tensor(value, value_past.dtype))
+        return prefix_length
+
+    def store(self, network, input_ids, valid_length):
+        """
+        Read the key/value cache of the network after the prompts are processed and store their blocks
+
+        Args:
+            network(Cell): The eval net built with use_past=True.
+            input_ids(numpy.ndarray): The padded prompts with shape [batch_size, seq_length].
+            valid_length(numpy.ndarray): The length of each prompt.
+        """
+        if np.all(valid_length < self.block_size):
+            return
+        past_states = [(key_past.asnumpy(), value_past.asnumpy())
+                       for key_past, value_past in get_past_parameters(network)]
+        for row in range(input_ids.shape[0]):
+            self.insert(input_ids[row], valid_length[row], past_states, row)
+
+    def stats(self):
+        """
+        Get the statistics of the cache
+
+        Returns:
+            stats: dict of the hit and miss counters, the cached tokens and the memory usage
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "hit_tokens": self.hit_tokens,
+                "num_blocks": len(self.blocks),
+                "num_bytes": self.num_bytes,
+                "evictions": self.evictions}
+
+
+def build_prefix_cache(opt):
+    """
+    Return the PrefixKVCache if the prefix_cache_bytes is set for the model built with use_past=True, else None
+    """
+    max_bytes = getattr(opt, 'prefix_cache_bytes', 0)
+    use_past = opt.model.get('use_past', False) if hasattr(opt, 'model') else getattr(opt, 'use_past', False)
+    if not max_bytes or not use_past:
+        return None
+    return PrefixKVCache(max_bytes, block_size=getattr(opt, 'prefix_cache_block_size', 16))
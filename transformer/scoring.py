@@ -0,0 +1,265 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+"""
+Log-likelihood scoring of (context, continuation) pairs
+
+For example, score the pairs in a JSONL file, one {"context": str, "continuation": str} per line:
+
+    python -m transformer.scoring --config=./transformer/configs/opt/opt.yaml --input_file=pairs.jsonl \
+        --output_file=scores.jsonl --ckpt_path=./converted_mindspore_opt.ckpt --vocab_path=./vocab.json
+"""
+import argparse
+import itertools
+import json
+import sys
+
+import numpy as np
+from mindspore import load_checkpoint, load_param_into_net
+import mindspore.common.dtype as mstype
+from mindspore.common import set_seed
+from mindspore.common.tensor import Tensor
+from mindspore.train.model import Model
+
+from transformer.build_parallel_config import build_parallel_config
+from transformer.length_bucket import LengthBucketedModel, build_length_bucketed_model
+from transformer.logger import get_logger
+from transformer.models import build_model
+from transformer.predict import set_context_env, set_auto_parallel_context_env, modify_args
+from transformer.tokenization.tokenization import get_tokenizer
+from transformer.utils import parse_with_config
+
+
+def _build_decoder_row(context, continuation, seq_length):
+    """The input ids and the labels of a pair for the decoder-only models"""
+    if not context:
+        raise ValueError("The context should not be empty, as the first token has no prediction. You can use the "
+                         "end token as the context to score the whole text.")
+    if not 0 < len(continuation) <= seq_length:
+        raise ValueError(f"The continuation length should be in (0, {seq_length}], but got {len(continuation)}.")
+    # Truncate the context from the left, the last token is only a label
+    tokens = (list(context) + list(continuation))[-(seq_length + 1):]
+    return tokens[:-1], tokens[1:], len(tokens) - 1 - len(continuation)
+
+
+def score_batch(model, contexts, continuations, seq_length, batch_size, max_decode_length=None, pad_token=0,
+                start_token=0):
+    """
+    Compute the log-likelihood of each continuation given its context
+
+    The pairs are sorted by the length and scored batch by batch, and each batch takes one forward of the eval
+    net built with score=True, which gathers the log probabilities of the continuation tokens in the graph. For
+    the decoder-only models the context and the continuation are concatenated, and the context is truncated from
+    the left if they exceed the seq_length. For the encoder-decoder models the context is the source and the
+    decoder starts from the start_token.
+
+    Inputs:
+        model: The model wrapping the eval net built with score=True.
+        contexts(list): The ids of each context.
+        continuations(list): The ids of each continuation.
+        seq_length(int): The sequence length of the model, or the source length of the encoder-decoder models.
+        batch_size(int): The batch size which the eval net is compiled with.
+        max_decode_length(int): The target length of the encoder-decoder models. If None, the model is taken as a
+            decoder-only model. Default: None.
+        pad_token(int): The id of the padding token. Default: 0.
+        start_token(int): The first decoder input of the encoder-decoder models. Default: 0.
+
+    Returns:
+        outputs: list of dict for each pair, with the sum of the log probabilities "log_prob", the log
+        probability of each continuation token "token_log_probs" and the number of the tokens "num_tokens"
+    """
+    if len(contexts) != len(continuations):
+        raise ValueError(f"The number of the contexts {len(contexts)} and continuations {len(continuations)} "
+                         f"should be the same.")
+    encoder_decoder = max_decode_length is not None
+    lengths = [len(item) for item in continuations] if encoder_decoder else \
+        [min(len(x) + len(y) - 1, seq_length) for x, y in zip(contexts, continuations)]
+    order = np.argsort(lengths, kind='stable')
+    outputs = [None] * len(contexts)
+    for start in range(0, len(order), batch_size):
+        rows = order[start:start + batch_size]
+        if encoder_decoder:
+            scores = _score_encoder_decoder(model, [contexts[i] for i in rows], [continuations[i] for i in rows],
+                                            seq_length, max_decode_length, batch_size, pad_token, start_token)
+        else:
+            scores = _score_decoder(model, [contexts[i] for i in rows], [continuations[i] for i in rows],
+                                    seq_length, batch_size, pad_token)
+        for row, score in zip(rows, scores):
+            outputs[row] = score
+    return outputs
+
+
+def _collect_scores(outputs, label_mask, num_rows):
+    """Read the log probabilities of the scored positions of each row"""
+    token_log_probs, log_probs = outputs
+    token_log_probs = token_log_probs.asnumpy()
+    log_probs = log_probs.asnumpy()
+    scores = []
+    for row in range(num_rows):
+        tokens = token_log_probs[row][label_mask[row] > 0]
+        scores.append({"log_prob": float(log_probs[row]),
+                       "token_log_probs": tokens.tolist(),
+                       "num_tokens": int(tokens.shape[0])})
+    return scores
+
+
+def _score_decoder(model, contexts, continuations, seq_length, batch_size, pad_token):
+    """Score a batch of pairs with the decoder-only model"""
+    rows = [_build_decoder_row(x, y, seq_length) for x, y in zip(contexts, continuations)]
+    length = max(len(input_ids) for input_ids, _, _ in rows)
+    if isinstance(model, LengthBucketedModel):
+        seq_length = model.select(length)
+    input_ids = np.full((batch_size, seq_length), pad_token, np.int32)
+    input_mask = np.zeros((batch_size, seq_length), np.int32)
+    # The padding rows keep a single valid token
+    input_mask[:, 0] = 1
+    label_ids = np.full((batch_size, seq_length), pad_token, np.int32)
+    label_mask = np.zeros((batch_size, seq_length), np.int32)
+    for row, (ids, labels, first) in enumerate(rows):
+        input_ids[row, :len(ids)] = ids
+        input_mask[row, :len(ids)] = 1
+        label_ids[row, :len(labels)] = labels
+        label_mask[row, first:len(labels)] = 1
+    outputs = model.predict(Tensor(input_ids, mstype.int32), Tensor(input_mask, mstype.float32), None, True, None,
+                            None, Tensor(label_ids, mstype.int32), Tensor(label_mask, mstype.float32))
+    return _collect_scores(outputs, label_mask, len(rows))
+
+
+def _score_encoder_decoder(model, contexts, continuations, seq_length, max_decode_length, batch_size,
+                           pad_token, start_token):
+    """Score a batch of pairs with the encoder-decoder model"""
+    source_ids = np.full((batch_size, seq_length), pad_token, np.int32)
+    source_mask = np.zeros((batch_size, seq_length), np.int32)
+    source_mask[:, 0] = 1
+    target_ids = np.full((batch_size, max_decode_length), pad_token, np.int32)
+    target_ids[:, 0] = start_token
+    target_mask = np.zeros((batch_size, max_decode_length), np.int32)
+    target_mask[:, 0] = 1
+    label_ids = np.full((batch_size, max_decode_length), pad_token, np.int32)
+    label_mask = np.zeros((batch_size, max_decode_length), np.int32)
+    for row, (context, continuation) in enumerate(zip(contexts, continuations)):
+        if not 0 < len(continuation) <= max_decode_length:
+            raise ValueError(f"The continuation length should be in (0, {max_decode_length}], "
+                             f"but got {len(continuation)}.")
+        context = list(context)[-seq_length:]
+        source_ids[row, :len(context)] = context
+        source_mask[row, :len(context)] = 1
+        target_ids[row, 1:len(continuation)] = continuation[:-1]
+        target_mask[row, :len(continuation)] = 1
+        label_ids[row, :len(continuation)] = continuation
+        label_mask[row, :len(continuation)] = 1
+    outputs = model.predict(Tensor(source_ids, mstype.int32), Tensor(source_mask, mstype.float32), None, None,
+                            Tensor(target_ids, mstype.int32), Tensor(target_mask, mstype.float32), None, True, None,
+                            Tensor(label_ids, mstype.int32), Tensor(label_mask, mstype.float32))
+    return _collect_scores(outputs, label_mask, len(contexts))
+
+
+def _encode(tokenizer, text):
+    """
+    Convert the text to the ids with the vocab of the tokenizer
+
+    Raises:
+        ValueError: If a token of the text, such as the [UNK] of a word missing from the vocab, is not in the vocab.
+    """
+    ids = []
+    for token in tokenizer.tokenize(text):
+        if token not in tokenizer.vocab_dict:
+            raise ValueError(f"The token {token!r} of the text {text!r} is not in the vocab")
+        ids.append(tokenizer.vocab_dict[token])
+    return ids
+
+
+def score_jsonl(model, tokenizer, input_stream, output_stream, opt, batch_size, chunk_size=None):
+    """
+    Score the pairs read from the JSONL input stream and write a JSON line for each of them to the output stream
+
+    Each input line is a json object with the "context" and the "continuation" text, and its output line is the
+    same object with the "log_prob", "token_log_probs" and "num_tokens" added. The lines are read and written in
+    chunks of chunk_size, so that the outputs of a chunk are written as soon as it is scored.
+
+    Returns:
+        num_pairs: int, the number of the scored pairs
+    """
+    chunk_size = chunk_size or batch_size * 16
+    max_decode_length = opt.model.get('max_decode_length') if getattr(opt, 'arch', None) == 't5' else None
+    lines = (line for line in input_stream if line.strip())
+    num_pairs = 0
+    while True:
+        records = [json.loads(line) for line in itertools.islice(lines, chunk_size)]
+        if not records:
+            break
+        contexts = [_encode(tokenizer, item["context"]) for item in records]
+        continuations = [_encode(tokenizer, item["continuation"]) for item in records]
+        scores = score_batch(model, contexts, continuations, opt.model['seq_length'], batch_size,
+                             max_decode_length=max_decode_length)
+        for item, score in zip(records, scores):
+            item.update(score)
+            output_stream.write(json.dumps(item) + "\n")
+        output_stream.flush()
+        num_pairs += len(records)
+        opt.logger.info(f"Scored {num_pairs} pairs.")
+    return num_pairs
+
+
+def run_score(opt):
+    """Main scoring process"""
+    set_context_env(opt)
+    set_auto_parallel_context_env(opt)
+    parallel_config = build_parallel_config(opt)
+    eval_net = build_model(opt, parallel_config)
+
+    opt.logger.info(f"Start to restore from the path {opt.ckpt_path}")
+    load_param_into_net(eval_net, load_checkpoint(opt.ckpt_path))
+
+    def build_bucket_network(seq_length):
+        """Build the eval net of the length bucket"""
+        origin_seq_length = opt.model['seq_length']
+        opt.model['seq_length'] = seq_length
+        try:
+            return build_model(opt, parallel_config)
+        finally:
+            opt.model['seq_length'] = origin_seq_length
+
+    if opt.arch in ('gpt', 'opt'):
+        model = build_length_bucketed_model(opt, eval_net, build_bucket_network, opt.model['seq_length'])
+    else:
+        model = Model(eval_net)
+    tokenizer = get_tokenizer(opt.vocab_path)
+    input_stream = open(opt.input_file, 'r') if getattr(opt, 'input_file', '-') != '-' else sys.stdin
+    output_stream = open(opt.output_file, 'w') if getattr(opt, 'output_file', '-') != '-' else sys.stdout
+    try:
+        batch_size = opt.model['global_batch_size'] // opt.speed_up['micro_batch_num']
+        score_jsonl(model, tokenizer, input_stream, output_stream, opt, batch_size)
+    finally:
+        for stream in (input_stream, output_stream):
+            if stream not in (sys.stdin, sys.stdout):
+                stream.close()
+    if isinstance(model, LengthBucketedModel):
+        opt.logger.info(f"The length bucket stats: {model.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default="configs/opt/opt.yaml", help='YAML config files')
+    parser.add_argument('--input_file', default="-", help='The JSONL file of the pairs, - for the stdin')
+    parser.add_argument('--output_file', default="-", help='The JSONL file of the scores, - for the stdout')
+    args = parse_with_config(parser)
+    args.logger = get_logger()
+    modify_args(args)
+    set_seed(args.seed)
+    args.eval = True
+    args.generate = False
+    args.score = True
+    run_score(args)
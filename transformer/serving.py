@@ -0,0 +1,580 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+
+"""
+Local HTTP inference server with dynamic batching
+
+The eval net is built and compiled once, and the requests arriving together are run as a batch. For example,
+serve the OPT generation on the localhost:
+
+    python -m transformer.serving --config=./transformer/configs/opt/opt.yaml \
+        --ckpt_path=./converted_mindspore_opt.ckpt --vocab_path=./vocab.json --port=8000 --max_wait_ms=10
+
+    curl -X POST http://127.0.0.1:8000/generate -d '{"prompt": "Hello world!"}'
+    curl http://127.0.0.1:8000/metrics
+
+The BERT classification net of the text classification task is served at /classify instead:
+
+    python -m transformer.serving --config=./transformer/configs/bert/task_classifier_config.yaml \
+        --ckpt_path=./classifier.ckpt --vocab_path=./vocab.json --port=8000
+
+    curl -X POST http://127.0.0.1:8000/classify -d '{"text": "Hello world!"}'
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from mindspore import load_checkpoint, load_param_into_net
+import mindspore.common.dtype as mstype
+from mindspore.common import set_seed
+from mindspore.common.tensor import Tensor
+from mindspore.train.model import Model
+
+from transformer.build_parallel_config import build_parallel_config
+from transformer.encoder_cache import build_encoder_cache
+from transformer.length_bucket import build_length_bucketed_model
+from transformer.logger import get_logger
+from transformer.models import build_model
+from transformer.models.build_model import get_downstream_config
+from transformer.predict import set_context_env, set_auto_parallel_context_env, modify_args, generate_padded_batch
+from transformer.prefix_cache import build_prefix_cache
+from transformer.tokenization import tokenization
+from transformer.utils import parse_with_config
+
+
+class ServingMetrics:
+    """
+    The metrics of the server: the number of the requests, the histogram of the batch sizes and the latency
+    percentiles of the recent requests, which are rendered in the Prometheus text format.
+
+    Args:
+        max_batch_size(int): The largest batch size, the histogram buckets are the powers of 2 up to it.
+        window(int): The number of the recent requests to calculate the latency percentiles. Default: 10000.
+    """
+    def __init__(self, max_batch_size, window=10000):
+        self.batch_buckets = sorted({2 ** i for i in range(max(max_batch_size, 1).bit_length())} |
+                                    {max_batch_size})
+        self.batch_counts = [0] * len(self.batch_buckets)
+        self.num_batches = 0
+        self.batch_size_sum = 0
+        self.num_requests = 0
+        self.num_errors = 0
+        self.latency = deque(maxlen=window)
+
+    def observe_batch(self, batch_size):
+        """Count a batch of the batch_size"""
+        self.batch_counts[bisect.bisect_left(self.batch_buckets, batch_size)] += 1
+        self.num_batches += 1
+        self.batch_size_sum += batch_size
+
+    def observe_request(self, latency, error=False):
+        """Record the latency of a finished request in seconds"""
+        self.num_requests += 1
+        self.num_errors += int(error)
+        self.latency.append(latency)
+
+    def observe_rejected(self):
+        """Count a request rejected before it was batched, which has no latency"""
+        self.num_requests += 1
+        self.num_errors += 1
+
+    def render(self, queue_depth):
+        """
+        Render the metrics in the Prometheus text format
+
+        Args:
+            queue_depth(int): The number of the requests waiting for a batch.
+
+        Returns:
+            text: str, the metrics text
+        """
+        lines = ["# TYPE serving_queue_depth gauge",
+                 f"serving_queue_depth {queue_depth}",
+                 "# TYPE serving_requests_total counter",
+                 f"serving_requests_total {self.num_requests}",
+                 "# TYPE serving_errors_total counter",
+                 f"serving_errors_total {self.num_errors}",
+                 "# TYPE serving_batch_size histogram"]
+        cumulative = 0
+        for bucket, count in zip(self.batch_buckets, self.batch_counts):
+            cumulative += count
+            lines.append(f'serving_batch_size_bucket{{le="{bucket}"}} {cumulative}')
+        lines.extend([f'serving_batch_size_bucket{{le="+Inf"}} {self.num_batches}',
+                      f"serving_batch_size_sum {self.batch_size_sum}",
+                      f"serving_batch_size_count {self.num_batches}",
+                      "# TYPE serving_latency_seconds summary"])
+        latency = np.array(self.latency)
+        for quantile in (0.5, 0.9, 0.99):
+            value = float(np.quantile(latency, quantile)) if latency.size else 0.0
+            lines.append(f'serving_latency_seconds{{quantile="{quantile}"}} {value:.6f}')
+        lines.extend([f"serving_latency_seconds_sum {float(latency.sum()):.6f}",
+                      f"serving_latency_seconds_count {latency.size}"])
+        return "\n".join(lines) + "\n"
+
+
+class DynamicBatcher:
+    """
+    Collect the concurrent requests into batches, and run each batch with a single call of run_batch. A batch is
+    run when it has max_batch_size requests, or max_wait_ms after its first request arrived. The batches run one
+    by one in a worker thread, so the event loop keeps accepting the requests while the graph runs, and the result
+    of each request is returned to its waiting coroutine.
+
+    Args:
+        run_batch(Callable): Take the list of the request items and return the list of their results. If it has a
+            validate method, which raises ValueError for an item it can not run, the item is checked by validate,
+            and the item returned by validate is queued instead.
+        max_batch_size(int): The largest number of the requests in a batch.
+        max_wait_ms(float): The longest time to wait for the other requests of a batch in milliseconds.
+        metrics(ServingMetrics): The metrics to record the batches and the requests. Default: None.
+    """
+    def __init__(self, run_batch, max_batch_size, max_wait_ms, metrics=None):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.metrics = metrics or ServingMetrics(max_batch_size)
+        self.queue = None
+        self.task = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def queue_depth(self):
+        """The number of the requests waiting for a batch"""
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def start(self):
+        """Start collecting the batches in the running event loop"""
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stop collecting the batches"""
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=True)
+
+    def validate(self, item):
+        """
+        Check a request before it is queued, so that an invalid request does not fail the batch it would join
+
+        Args:
+            item: The request item.
+
+        Returns:
+            item: the item to submit, which is prepared by the validate method of run_batch if it has one
+
+        Raises:
+            ValueError: If run_batch can not run the item.
+        """
+        validate = getattr(self.run_batch, "validate", None)
+        if validate is None:
+            return item
+        return validate(item)
+
+    async def submit(self, item):
+        """
+        Queue a request and wait for its result
+
+        Args:
+            item: The request item passed to run_batch.
+
+        Returns:
+            result: the result of the item returned by run_batch
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future, time.time()))
+        return await future
+
+    async def _collect(self):
+        """Wait for the first request, then the others until the batch is full or the wait time is over"""
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        """Run the collected batches one by one"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [item for item in await self._collect() if not item[1].cancelled()]
+            if not batch:
+                continue
+            items, futures, start_times = zip(*batch)
+            self.metrics.observe_batch(len(batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, list(items))
+            except Exception as error:  # pylint: disable=broad-except
+                for future, start_time in zip(futures, start_times):
+                    self.metrics.observe_request(time.time() - start_time, error=True)
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            for future, result, start_time in zip(futures, results, start_times):
+                self.metrics.observe_request(time.time() - start_time)
+                if not future.done():
+                    future.set_result(result)
+
+
+class GenerateHandler:
+    """
+    Generate the text of a batch of the {"prompt": str} requests with the GPT, OPT or T5 eval net. The prompts are
+    tokenized by validate before they are batched, and a batch is the list of their ids.
+
+    Args:
+        model(Model): The model wrapping the eval net built with generate=True.
+        opt(argparse.Namespace): The global configs.
+        batch_size(int): The batch size which the eval net is compiled with.
+        prefix_cache(PrefixKVCache): The cache of the keys and values of the processed prompts. Default: None.
+        encoder_cache(EncoderOutputCache): The cache of the encoder outputs of T5. Default: None.
+    """
+    def __init__(self, model, opt, batch_size, prefix_cache=None, encoder_cache=None):
+        self.model = model
+        self.opt = opt
+        self.batch_size = batch_size
+        self.prefix_cache = prefix_cache
+        self.encoder_cache = encoder_cache
+        self.tokenizer = tokenization.get_tokenizer(opt.vocab_path)
+
+    def validate(self, item):
+        """
+        Tokenize a {"prompt": str} request, so that an empty, too long or unknown prompt is rejected alone
+
+        Args:
+            item(dict): The request.
+
+        Returns:
+            input_ids: list of the ids of the prompt, which is queued instead of the request
+
+        Raises:
+            ValueError: If the prompt is not a string, is empty, is longer than the seq_length or has a token which
+                is not in the vocab.
+        """
+        if not isinstance(item, dict) or not isinstance(item.get("prompt"), str):
+            raise ValueError('The request should be a JSON object with the string "prompt"')
+        tokens = self.tokenizer.tokenize(item["prompt"])
+        if not tokens:
+            raise ValueError("The prompt is empty")
+        seq_length = self.opt.model['seq_length']
+        if len(tokens) > seq_length:
+            raise ValueError(f"The prompt has {len(tokens)} tokens, more than the seq_length {seq_length}")
+        try:
+            return tokenization.convert_tokens_to_ids(self.opt.vocab_path, tokens)
+        except KeyError as error:
+            raise ValueError(f"The token {error} of the prompt is not in the vocab") from error
+
+    def __call__(self, input_ids):
+        outputs = generate_padded_batch(input_ids, self.model, self.opt, self.batch_size, self.prefix_cache,
+                                        self.encoder_cache)
+        return [{"output": tokenization.convert_tokens_to_string(
+            tokenization.convert_ids_to_tokens(self.opt.vocab_path, ids))} for ids in outputs]
+
+
+class ClassifyHandler:
+    """
+    Classify a batch of the {"text": str, "text_pair": str} requests with a BERT classification net, such as the
+    BertCLSModel of the text classification task, whose inputs are the input_ids, the input_mask and the
+    token_type_id and whose outputs are the log probabilities of the labels. The text_pair is optional. The texts are
+    tokenized by validate before they are batched.
+
+    Args:
+        model(Model): The model wrapping the classification net.
+        vocab_file(str): The path to the vocab file of the tokenizer.
+        seq_length(int): The sequence length of the net.
+        batch_size(int): The batch size which the net is compiled with.
+        labels(list): The names of the labels. Default: None, which returns the label index.
+    """
+    def __init__(self, model, vocab_file, seq_length, batch_size, labels=None):
+        self.model = model
+        self.vocab_file = vocab_file
+        self.seq_length = seq_length
+        self.batch_size = batch_size
+        self.labels = labels
+        self.tokenizer = tokenization.get_tokenizer(vocab_file)
+
+    def validate(self, item):
+        """
+        Tokenize a {"text": str, "text_pair": str} request, so that an unknown text is rejected alone
+
+        Args:
+            item(dict): The request.
+
+        Returns:
+            encoded: tuple of the ids and the token types of the texts, which is queued instead of the request
+
+        Raises:
+            ValueError: If the texts are not strings or have a token which is not in the vocab.
+        """
+        if not isinstance(item, dict) or not isinstance(item.get("text"), str) or \
+                not isinstance(item.get("text_pair", ""), (str, type(None))):
+            raise ValueError('The request should be a JSON object with the string "text" and the optional string '
+                             '"text_pair"')
+        try:
+            return self._encode(item)
+        except KeyError as error:
+            raise ValueError(f"The token {error} of the text is not in the vocab") from error
+
+    def _encode(self, item):
+        """The ids and the token types of [CLS] text [SEP] text_pair [SEP], truncated to the seq_length"""
+        tokens_a = self.tokenizer.tokenize(item["text"])
+        tokens_b = self.tokenizer.tokenize(item["text_pair"]) if item.get("text_pair") else []
+        # Truncate the longer text first to fit the [CLS] and [SEP] tokens
+        max_tokens = self.seq_length - (3 if tokens_b else 2)
+        while len(tokens_a) + len(tokens_b) > max_tokens:
+            if len(tokens_a) >= len(tokens_b):
+                tokens_a.pop()
+            else:
+                tokens_b.pop()
+        tokens = ["[CLS]"] + tokens_a + ["[SEP]"]
+        token_type = [0] * len(tokens)
+        if tokens_b:
+            tokens += tokens_b + ["[SEP]"]
+            token_type += [1] * (len(tokens_b) + 1)
+        return tokenization.convert_tokens_to_ids(self.vocab_file, tokens), token_type
+
+    def __call__(self, requests):
+        input_ids = np.zeros((self.batch_size, self.seq_length), np.int32)
+        input_mask = np.zeros((self.batch_size, self.seq_length), np.int32)
+        token_type_id = np.zeros((self.batch_size, self.seq_length), np.int32)
+        for row, (ids, token_type) in enumerate(requests):
+            input_ids[row, :len(ids)] = ids
+            input_mask[row, :len(ids)] = 1
+            token_type_id[row, :len(ids)] = token_type
+        log_probs = self.model.predict(Tensor(input_ids, mstype.int32), Tensor(input_mask, mstype.int32),
+                                       Tensor(token_type_id, mstype.int32)).asnumpy()
+        outputs = []
+        for row in range(len(requests)):
+            label = int(np.argmax(log_probs[row]))
+            outputs.append({"label": self.labels[label] if self.labels else label,
+                            "log_probs": log_probs[row].tolist()})
+        return outputs
+
+
+class InferenceServer:
+    """
+    A minimal HTTP/1.1 server on asyncio, which passes the JSON body of the POST requests to the DynamicBatcher
+    of their path, and serves the metrics of all the batchers at GET /metrics.
+
+    Args:
+        batchers(dict): The DynamicBatcher of each path, such as {"/generate": batcher}.
+        host(str): The host to listen on. Default: "127.0.0.1".
+        port(int): The port to listen on. Default: 8000.
+    """
+    def __init__(self, batchers, host="127.0.0.1", port=8000):
+        self.batchers = batchers
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        """Start the batchers and listen on the port"""
+        for batcher in self.batchers.values():
+            batcher.start()
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Close the server and stop the batchers"""
+        self.server.close()
+        await self.server.wait_closed()
+        for batcher in self.batchers.values():
+            await batcher.stop()
+
+    async def serve_forever(self):
+        """Start the server and serve until it is cancelled"""
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+    def metrics(self):
+        """The metrics text of all the batchers labeled by their paths"""
+        texts = []
+        for path, batcher in self.batchers.items():
+            text = batcher.metrics.render(batcher.queue_depth)
+            lines = []
+            for line in text.splitlines():
+                if line.startswith("#"):
+                    if texts:
+                        continue
+                    lines.append(line)
+                    continue
+                name, value = line.rsplit(" ", 1)
+                if "{" in name:
+                    name = name.replace("{", f'{{path="{path}",', 1)
+                else:
+                    name = f'{name}{{path="{path}"}}'
+                lines.append(f"{name} {value}")
+            texts.append("\n".join(lines))
+        return "\n".join(texts) + "\n"
+
+    async def _dispatch(self, method, path, body):
+        """Return the status, the content type and the body of the response"""
+        if path == "/metrics":
+            if method != "GET":
+                return 405, "text/plain", "Method Not Allowed\n"
+            return 200, "text/plain; version=0.0.4", self.metrics()
+        batcher = self.batchers.get(path)
+        if batcher is None:
+            return 404, "text/plain", "Not Found\n"
+        if method != "POST":
+            return 405, "text/plain", "Method Not Allowed\n"
+        try:
+            item = json.loads(body)
+        except ValueError as error:
+            return 400, "application/json", json.dumps({"error": f"Invalid JSON body: {error}"})
+        try:
+            item = batcher.validate(item)
+        except ValueError as error:
+            batcher.metrics.observe_rejected()
+            return 400, "application/json", json.dumps({"error": str(error)})
+        try:
+            result = await batcher.submit(item)
+        except (KeyError, TypeError, ValueError) as error:
+            return 400, "application/json", json.dumps({"error": repr(error)})
+        except Exception as error:  # pylint: disable=broad-except
+            return 500, "application/json", json.dumps({"error": repr(error)})
+        return 200, "application/json", json.dumps(result)
+
+    async def _handle(self, reader, writer):
+        """Read a request and write its response"""
+        reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                   500: "Internal Server Error"}
+        try:
+            method, path, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, value = line.decode("latin-1").split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            status, content_type, payload = await self._dispatch(method, path.split("?", 1)[0], body)
+        except (ValueError, asyncio.IncompleteReadError):
+            status, content_type, payload = 400, "text/plain", "Bad Request\n"
+        payload = payload.encode("utf-8")
+        writer.write(f"HTTP/1.1 {status} {reasons[status]}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("latin-1") + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+def build_classify_handler(opt, parallel_config):
+    """
+    Build the BertCLSModel of the text classification task with the eval_batch_size, and its handler
+
+    Returns:
+        handler: ClassifyHandler, the handler of the /classify requests
+        batch_size: int, the batch size which the net is compiled with
+    """
+    # The classification net is defined by the task, which depends on the transformer package
+    from tasks.nlp.text_classification.src.finetune_eval_model import BertCLSModel
+    model_config = get_downstream_config(opt)
+    model_config.parallel_config = parallel_config
+    batch_size = opt.model['eval_batch_size']
+    model_config.batch_size = batch_size
+    net = BertCLSModel(model_config, False, num_labels=opt.num_class,
+                       assessment_method=opt.assessment_method.lower())
+    net.set_train(False)
+    opt.logger.info(f"Start to restore from the path {opt.ckpt_path}")
+    load_param_into_net(net, load_checkpoint(opt.ckpt_path))
+    handler = ClassifyHandler(Model(net), opt.vocab_path, opt.model['seq_length'], batch_size,
+                              getattr(opt, 'labels', None))
+    return handler, batch_size
+
+
+def build_generate_handler(opt, parallel_config):
+    """
+    Build the generation eval net of the GPT, OPT or T5 once, and its handler
+
+    Returns:
+        handler: GenerateHandler, the handler of the /generate requests
+        batch_size: int, the batch size which the eval net is compiled with
+    """
+    eval_net = build_model(opt, parallel_config)
+
+    opt.logger.info(f"Start to restore from the path {opt.ckpt_path}")
+    load_param_into_net(eval_net, load_checkpoint(opt.ckpt_path))
+
+    def build_bucket_network(seq_length):
+        """Build the eval net of the length bucket"""
+        origin_seq_length = opt.model['seq_length']
+        opt.model['seq_length'] = seq_length
+        try:
+            return build_model(opt, parallel_config)
+        finally:
+            opt.model['seq_length'] = origin_seq_length
+
+    if opt.arch in ('gpt', 'opt'):
+        model = build_length_bucketed_model(opt, eval_net, build_bucket_network, opt.model['seq_length'])
+    else:
+        model = Model(eval_net)
+    batch_size = opt.model['global_batch_size'] // opt.speed_up['micro_batch_num']
+    handler = GenerateHandler(model, opt, batch_size, build_prefix_cache(opt), build_encoder_cache(opt))
+    return handler, batch_size
+
+
+def run_serving(opt):
+    """Build the net of the arch once and serve it, BERT at /classify and the others at /generate"""
+    set_context_env(opt)
+    set_auto_parallel_context_env(opt)
+    parallel_config = build_parallel_config(opt)
+    if opt.arch == 'bert':
+        path = "/classify"
+        handler, batch_size = build_classify_handler(opt, parallel_config)
+    else:
+        path = "/generate"
+        handler, batch_size = build_generate_handler(opt, parallel_config)
+    batcher = DynamicBatcher(handler, batch_size, opt.max_wait_ms)
+    server = InferenceServer({path: batcher}, opt.host, opt.port)
+    opt.logger.info(f"Serving {path} on http://{opt.host}:{opt.port} with the batch size {batch_size}")
+    asyncio.run(server.serve_forever())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default="configs/opt/opt.yaml", help='YAML config files')
+    parser.add_argument('--host', default="127.0.0.1", help='The host to listen on')
+    parser.add_argument('--port', default=8000, type=int, help='The port to listen on')
+    parser.add_argument('--max_wait_ms', default=10.0, type=float,
+                        help='The longest time to wait for the other requests of a batch in milliseconds')
+    args = parse_with_config(parser)
+    args.logger = get_logger()
+    modify_args(args)
+    set_seed(args.seed)
+    args.eval = True
+    args.generate = True
+    run_serving(args)
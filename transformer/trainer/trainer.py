@@ -17,6 +17,7 @@ Used for gradient update. We want to use custom dtype for allreduce in data para
 """
 
 import argparse
+import copy
 import os
 import json
 from dataclasses import dataclass
@@ -46,7 +47,8 @@ from transformer.learning_rate import LearningRate
 from transformer.modules import override_attention
 from transformer.callback import LossCallBack
 from transformer.logger import get_logger
-from transformer.predict import generate_words, get_acc
+from transformer.predict import generate_file, generate_words, get_acc
+from transformer.length_bucket import LengthBucketedModel, build_length_bucketed_model
 
 from transformer.trainer.grad_accu_trainer import TrainAccuStepsWithLossScaleCell
 
@@ -463,14 +465,30 @@ class Trainer:
         # run training
         self.model_train(train_net, ds, callback)
 
+    def build_bucket_network(self, seq_length):
+        """build the eval net of the length bucket"""
+        model_config = copy.copy(self.model_config)
+        model_config.seq_length = seq_length
+        return self.build_model(model_config)
+
     def model_predict(self, inference_net):
         """model predict"""
-        model = Model(inference_net)
+        model = build_length_bucketed_model(self.config, inference_net, self.build_bucket_network,
+                                            getattr(self.model_config, 'seq_length', None))
         if self.config.generate:
             self.logger.info("Start to generate the words:")
-            generate_words(sample=self.config.input_samples,
-                           predict_model=model,
-                           opt=self.config)
+            encoder_cache = getattr(self, 'encoder_cache', None)
+            if getattr(self.config, 'input_file', ''):
+                stats = generate_file(self.config.input_file, self.config.output_file, model, self.config,
+                                      self.config.global_batch_size, encoder_cache=encoder_cache)
+                self.logger.info(f"The bulk generation stats: {stats}")
+            else:
+                generate_words(sample=self.config.input_samples,
+                               predict_model=model,
+                               opt=self.config,
+                               encoder_cache=encoder_cache)
+            if encoder_cache is not None:
+                self.logger.info(f"The encoder cache stats: {encoder_cache.stats()}")
         else:
             self.logger.info("Start to eval on the datasets.")
             self.config.get_eval_dataset = True
@@ -482,6 +500,8 @@ class Trainer:
             acc = get_acc(model, ds.create_tuple_iterator())
 
             self.logger.info(f"The accuracy is {acc}")
+        if isinstance(model, LengthBucketedModel):
+            self.logger.info(f"The length bucket stats: {model.stats()}")
 
     def predict(self):
         """Main predict process"""
@@ -496,6 +516,7 @@ class Trainer:
         model_config = self.check_and_build_model_config()
         parallel_config = self.build_parallel_config()
         model_config.parallel_config = parallel_config
+        self.model_config = model_config
 
         inference_net = self.build_model(model_config)
         self.logger.info(f"Build model finished")